@@ -0,0 +1 @@
+"""Benchmarks of kube-event-pipe, run against a fake API server."""
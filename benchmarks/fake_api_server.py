@@ -0,0 +1,233 @@
+"""A stand-in for the Kubernetes API server, serving generated events from `/api/v1/events`."""
+import json
+import time
+import random
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+
+log = logging.getLogger(__name__)
+
+
+EVENTS_PATH = '/api/v1/events'
+SENT_AT_ANNOTATION = 'benchmark/sent-at'
+# How long to sleep between sending batches of events which are due.
+SEND_INTERVAL_SEC = 0.005
+
+
+class EventStreamConfig(NamedTuple):
+    """Parameters of the generated event stream."""
+
+    # Events per second, across watch connections.
+    rate: float
+    total: int
+    payload_bytes: int
+    # Fraction of events repeating the identity of an earlier one.
+    duplicate_ratio: float
+    # Close watches after sending this many events, 0 for never.
+    reconnect_every: int
+    # Respond to every n-th watch with 410 Gone if it resumes from a resourceVersion, 0 for never.
+    gone_every: int
+    seed: int = 0
+
+
+class EventStream:
+    """
+    Events generated up front and sent at the configured rate, from the first watch on.
+
+    Event i has resourceVersion `i + 1`. Duplicates repeat the name and count of an earlier event,
+    so the expected output is the events with unique identities.
+    """
+
+    config: EventStreamConfig
+    identities: List[Tuple[str, int]]
+    unique_count: int
+    start_time: Optional[float]
+    watch_count: int
+
+    def __init__(self, config: EventStreamConfig):
+        """Generate event identities."""
+        self.config = config
+        rng = random.Random(config.seed)
+        self.identities = []
+        for i in range(config.total):
+            if self.identities and rng.random() < config.duplicate_ratio:
+                self.identities.append(rng.choice(self.identities))
+            else:
+                self.identities.append((f'benchmark-{i}', 1))
+        self.unique_count = len(set(self.identities))
+        self.padding = 'x' * config.payload_bytes
+        self.start_time = None
+        self.watch_count = 0
+        self._lock = threading.Lock()
+
+    def start_watch(self) -> int:
+        """Start sending events if not started yet, return the number of the watch."""
+        with self._lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+            self.watch_count += 1
+            return self.watch_count
+
+    def due_count(self) -> int:
+        """Return the number of events due to have been sent by now."""
+        if self.start_time is None:
+            return 0
+        return min(self.config.total, int((time.time() - self.start_time) * self.config.rate))
+
+    def event(self, i: int) -> dict:
+        """Return the i-th event object."""
+        name, count = self.identities[i]
+        return {
+            'kind': 'Event',
+            'apiVersion': 'v1',
+            'metadata': {
+                'name': name,
+                'namespace': 'default',
+                'uid': f'{name}-uid',
+                'resourceVersion': str(i + 1),
+                'annotations': {SENT_AT_ANNOTATION: repr(time.time())},
+            },
+            'involvedObject': {'kind': 'Pod', 'namespace': 'default', 'name': name},
+            'reason': 'Benchmark',
+            'message': self.padding,
+            'count': count,
+            'type': 'Normal',
+        }
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Serve event lists and watches from the server's EventStream."""
+
+    protocol_version = 'HTTP/1.1'
+    server: 'FakeApiServer'
+
+    def do_GET(self):
+        """List or watch events."""
+        url = urlparse(self.path)
+        if url.path != EVENTS_PATH:
+            self.send_error(404)
+            return
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if query.get('watch', '').lower() == 'true':
+            self.watch(query.get('resourceVersion'), query.get('allowWatchBookmarks') == 'true')
+        else:
+            self.list(int(query.get('limit', 0)), query.get('continue'))
+
+    def list(self, limit: int, continue_token: Optional[str]):
+        """Respond with events due so far, in pages of `limit` events if it's given."""
+        stream = self.server.stream
+        if continue_token:
+            # Pages after the first are of the list at its resourceVersion.
+            start, due = map(int, continue_token.split(':'))
+        else:
+            start, due = 0, stream.due_count()
+        end = min(due, start + limit) if limit else due
+        metadata = {'resourceVersion': str(due)}
+        if end < due:
+            metadata['continue'] = f'{end}:{due}'
+        body = json.dumps({
+            'kind': 'EventList',
+            'apiVersion': 'v1',
+            'metadata': metadata,
+            'items': [stream.event(i) for i in range(start, end)],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def watch(self, resource_version: Optional[str], bookmarks: bool):
+        """Stream events after the resourceVersion, or all events if it's not given."""
+        stream = self.server.stream
+        watch_number = stream.start_watch()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        gone_every = stream.config.gone_every
+        if resource_version and gone_every and watch_number % gone_every == 0:
+            log.info('Watch %s: responding with 410 Gone', watch_number)
+            self.write_chunk(self.watch_line('ERROR', {
+                'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'reason': 'Expired',
+                'message': 'too old resource version', 'code': 410,
+            }))
+            self.write_chunk(b'')
+            return
+
+        position = int(resource_version) if resource_version else 0
+        # Without a resourceVersion, events due so far are the initial state, which is sent whole.
+        end = max(position, 0 if resource_version else stream.due_count())
+        end = end + stream.config.reconnect_every if stream.config.reconnect_every else 0
+        try:
+            while position < stream.config.total:
+                due = min(stream.due_count(), end) if end else stream.due_count()
+                if due > position:
+                    self.write_chunk(b''.join(
+                        self.watch_line('ADDED', stream.event(i)) for i in range(position, due)))
+                    position = due
+                if end and position >= end:
+                    log.debug('Watch %s: closing at resourceVersion %s', watch_number, position)
+                    break
+                time.sleep(SEND_INTERVAL_SEC)
+            else:
+                # Keep the finished watch open, like an idle API server would.
+                while not self.server.closing.wait(SEND_INTERVAL_SEC * 100):
+                    if bookmarks:
+                        self.write_chunk(self.watch_line('BOOKMARK', {
+                            'kind': 'Event', 'apiVersion': 'v1',
+                            'metadata': {'resourceVersion': str(position)},
+                        }))
+            self.write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    @staticmethod
+    def watch_line(event_type: str, obj: dict) -> bytes:
+        """Encode a watch event line, formatted like the API server's."""
+        return b'{"type":"%s","object":%s}\n' % (
+            event_type.encode(), json.dumps(obj, separators=(',', ':')).encode())
+
+    def write_chunk(self, data: bytes):
+        """Write a chunk of a chunked response, an empty one ending it."""
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        """Log requests at the debug level, rather than to stderr."""
+        log.debug('Request: ' + format, *args)
+
+
+class FakeApiServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server serving an EventStream, with each connection handled in a thread."""
+
+    daemon_threads = True
+    stream: EventStream
+
+    def __init__(self, stream: EventStream, address: str = '127.0.0.1', port: int = 0):
+        """Bind to the address, on a random port by default."""
+        super().__init__((address, port), FakeApiHandler)
+        self.address = address
+        self.stream = stream
+        self.closing = threading.Event()
+
+    @property
+    def url(self) -> str:
+        """Return the URL of the server."""
+        return f'http://{self.address}:{self.server_port}'
+
+    def start(self):
+        """Serve from a background thread."""
+        threading.Thread(target=self.serve_forever, name='fake-api-server', daemon=True).start()
+
+    def stop(self):
+        """Stop serving and end open watches."""
+        self.closing.set()
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,221 @@
+"""
+Run kube-event-pipe against a fake API server and report throughput, latency, CPU and memory.
+
+Usage: `python -m benchmarks.run --rate 5000 --total 100000`. Pipeline settings are passed as
+environment variables, e.g. `--env KUBE_EVENT_PIPE_RAW_JSON=true`.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from typing import Dict, IO, List, NamedTuple, Optional, cast
+from benchmarks.fake_api_server import (
+    EventStream, EventStreamConfig, FakeApiServer, SENT_AT_ANNOTATION,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+PIPE_COMMAND = [sys.executable, '-c', 'from kube_event_pipe.main import main; main()']
+STOP_TIMEOUT_SEC = 10
+
+KUBECONFIG_TEMPLATE = '''\
+apiVersion: v1
+kind: Config
+clusters:
+- name: benchmark
+  cluster:
+    server: {url}
+contexts:
+- name: benchmark
+  context:
+    cluster: benchmark
+    user: benchmark
+current-context: benchmark
+users:
+- name: benchmark
+  user:
+    token: benchmark
+'''
+
+
+class Result(NamedTuple):
+    """Measurements of a benchmark run."""
+
+    events_expected: int
+    events_written: int
+    duration_sec: float
+    events_per_sec: float
+    latency_p50_sec: Optional[float]
+    latency_p99_sec: Optional[float]
+    cpu_sec: float
+    max_rss_kib: int
+    watches: int
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """Return the value at the fraction of sorted values, by the nearest rank."""
+    if not sorted_values:
+        return None
+    rank = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+class OutputReader:
+    """Read events written by kube-event-pipe, recording when each of them arrived."""
+
+    latencies: List[float]
+    first_read: Optional[float]
+    last_read: Optional[float]
+
+    def __init__(self, output: IO[bytes], expected: int):
+        """Start reading the output in a background thread."""
+        self.output = output
+        self.expected = expected
+        self.latencies = []
+        self.first_read = None
+        self.last_read = None
+        self.done = threading.Event()
+        threading.Thread(target=self.read, name='output-reader', daemon=True).start()
+
+    def read(self):
+        """Read lines until the expected number of events arrives or the output ends."""
+        for line in self.output:
+            now = time.time()
+            try:
+                event = json.loads(line)
+            except ValueError:
+                log.warning('Ignoring unexpected output: %r', line)
+                continue
+            if self.first_read is None:
+                self.first_read = now
+            self.last_read = now
+            sent_at = event['metadata'].get('annotations', {}).get(SENT_AT_ANNOTATION)
+            if sent_at is not None:
+                self.latencies.append(now - float(sent_at))
+            if len(self.latencies) >= self.expected:
+                break
+        self.done.set()
+
+
+def run_benchmark(
+    stream_config: EventStreamConfig,
+    env: Dict[str, str],
+    timeout_sec: float,
+    workdir: Path,
+) -> Result:
+    """Serve the event stream, pipe it with kube-event-pipe and measure the run."""
+    stream = EventStream(stream_config)
+    server = FakeApiServer(stream)
+    server.start()
+
+    kubeconfig = workdir / 'kubeconfig'
+    kubeconfig.write_text(KUBECONFIG_TEMPLATE.format(url=server.url))
+    persistence_path = workdir / 'state'
+    persistence_path.mkdir()
+    child_env = {
+        **os.environ,
+        'KUBECONFIG': str(kubeconfig),
+        'KUBE_EVENT_PIPE_DESTINATION': '-',
+        'KUBE_EVENT_PIPE_PERSISTENCE_PATH': str(persistence_path),
+        'KUBE_EVENT_PIPE_LOG_LEVEL': 'WARNING',
+        **env,
+    }
+
+    start = time.time()
+    process = subprocess.Popen(PIPE_COMMAND, env=child_env, stdout=subprocess.PIPE)
+    try:
+        reader = OutputReader(cast(IO[bytes], process.stdout), stream.unique_count)
+        if not reader.done.wait(timeout_sec):
+            log.warning('Timed out after %ss', timeout_sec)
+    finally:
+        process.terminate()
+        try:
+            process.wait(STOP_TIMEOUT_SEC)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        server.stop()
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # Throughput is measured from the first event sent, excluding interpreter startup.
+    first_sent = stream.start_time or start
+    duration = (reader.last_read or time.time()) - first_sent
+    latencies = sorted(reader.latencies)
+    return Result(
+        events_expected=stream.unique_count,
+        events_written=len(latencies),
+        duration_sec=duration,
+        events_per_sec=len(latencies) / duration if duration > 0 else 0.0,
+        latency_p50_sec=percentile(latencies, 0.5),
+        latency_p99_sec=percentile(latencies, 0.99),
+        cpu_sec=usage.ru_utime + usage.ru_stime,
+        # Linux reports the maximum resident set size in KiB.
+        max_rss_kib=usage.ru_maxrss,
+        watches=stream.watch_count,
+    )
+
+
+def parse_env(assignments: List[str]) -> Dict[str, str]:
+    """Parse `KEY=VALUE` assignments."""
+    env = {}
+    for assignment in assignments:
+        key, sep, value = assignment.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f'Expecting KEY=VALUE, got {assignment!r}')
+        env[key] = value
+    return env
+
+
+def main():
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=2000, help='events sent per second')
+    parser.add_argument('--total', type=int, default=20000, help='events sent in total')
+    parser.add_argument('--payload-bytes', type=int, default=256, help='size of event messages')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1,
+                        help='fraction of events repeating an earlier one')
+    parser.add_argument('--reconnect-every', type=int, default=0,
+                        help='close watches after this many events, 0 for never')
+    parser.add_argument('--gone-every', type=int, default=0,
+                        help='respond to every n-th watch with 410 Gone, 0 for never')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated events')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for events')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='environment variable for kube-event-pipe, may be repeated')
+    parser.add_argument('--json', type=Path, help='also write the results to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    stream_config = EventStreamConfig(
+        rate=args.rate,
+        total=args.total,
+        payload_bytes=args.payload_bytes,
+        duplicate_ratio=args.duplicate_ratio,
+        reconnect_every=args.reconnect_every,
+        gone_every=args.gone_every,
+        seed=args.seed,
+    )
+    with tempfile.TemporaryDirectory(prefix='kube-event-pipe-benchmark-') as workdir:
+        result = run_benchmark(stream_config, parse_env(args.env), args.timeout, Path(workdir))
+
+    for name, value in result._asdict().items():
+        print(f'{name:>16}: {value:.6g}' if isinstance(value, float) else f'{name:>16}: {value}')
+    if args.json:
+        args.json.write_text(json.dumps({
+            'stream': stream_config._asdict(), 'env': parse_env(args.env), **result._asdict(),
+        }, indent=2))
+    if result.events_written < result.events_expected:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
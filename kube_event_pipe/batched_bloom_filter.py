@@ -1,27 +1,140 @@
 """A wrapper for multiple bloom filters that are rotated periodically."""
+import os
 import time
 import logging
-from typing import TypeVar, List, Generic
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import blake2b
+from typing import TypeVar, List, Dict, Tuple, Generic, Optional, Sequence
 from pathlib import Path
 from pybloomfilter import BloomFilter  # type: ignore
+from kube_event_pipe import memory
 
 
 log = logging.getLogger(__name__)
 
 
-Element = TypeVar('Element')
+Element = TypeVar('Element', str, bytes)
+
+
+SATURATION_IGNORE = 'ignore'
+SATURATION_ROTATE = 'rotate'
+SATURATION_GROW = 'grow'
+SATURATION_POLICIES = (SATURATION_IGNORE, SATURATION_ROTATE, SATURATION_GROW)
+
+# Each filter chained to a saturated one is this many times larger, with an error rate this many
+# times lower, so the false positive rate of a batch stays under twice the configured one.
+GROWTH_FACTOR = 2
+ERROR_RATE_TIGHTENING = 0.5
+
+HASH_SEED_PERSONALIZATION = b'kube-event-pipe'
+
+
+class PyBloomFilter(BloomFilter):
+    """A pybloomfiltermmap3 filter, looking up and adding batches one element at a time."""
+
+    def contains_many(self, elements: Sequence) -> List[bool]:
+        """Check if each of the elements has been added to the filter."""
+        return [element in self for element in elements]
+
+    def add_many(self, elements: Sequence):
+        """Add the elements to the filter."""
+        for element in elements:
+            self.add(element)
+
+
+Filter = PyBloomFilter
+
+# The next filter is prepared under a name not matching `*.bloom`, so it's not loaded as a batch.
+PREPARED_FILE_NAME = 'next.bloom.prepared'
+
+
+def parse_filter_file_name(path: Path) -> Tuple[int, int]:
+    """
+    Parse a bloom filter file name into the batch timestamp and the filter's position in the batch.
+
+    The first filter of a batch is named `<unix_timestamp>.bloom`, ones chained to it when it's
+    saturated `<unix_timestamp>.<n>.bloom`.
+
+    :raise: ValueError
+    """
+    timestamp, _, position = path.stem.partition('.')
+    return int(timestamp), int(position or 0)
+
+
+def find_filter_files(directory: Path) -> Dict[int, Dict[int, Path]]:
+    """Return paths of bloom filter files in the directory, by batch timestamp and position."""
+    timestamp_to_paths: Dict[int, Dict[int, Path]] = {}
+    for path in directory.glob('*.bloom'):
+        try:
+            timestamp, position = parse_filter_file_name(path)
+        except ValueError:
+            log.info('Ignoring invalid file name (expecting <unix_timestamp>.bloom): %s', path)
+        else:
+            timestamp_to_paths.setdefault(timestamp, {})[position] = path
+    return timestamp_to_paths
+
+
+def create_filter(capacity: int, error_rate: float, path: Path) -> Filter:
+    """
+    Create a bloom filter file, hashing with the same seeds as all other filters of the error rate.
+
+    Filters of the same capacity and error rate, also from other directories, then set the same
+    bits for the same elements, so they can be merged by OR-ing their bits.
+    """
+    # The number of hashes only depends on the error rate, so a tiny in-memory filter tells it.
+    num_hashes = BloomFilter(1, error_rate).num_hashes
+    hash_seeds = [
+        int.from_bytes(
+            blake2b(b'%d' % i, digest_size=4, person=HASH_SEED_PERSONALIZATION).digest(),
+            'little')
+        for i in range(num_hashes)
+    ]
+    return PyBloomFilter(capacity, error_rate, str(path), hash_seeds=hash_seeds)
+
+
+def open_filter(path: Path, mode: str = 'rw') -> Filter:
+    """Open a bloom filter file, read-only if `mode` is `r`."""
+    return PyBloomFilter.open(str(path), mode)
+
+
+def prepare_filter(capacity: int, error_rate: float, path: Path):
+    """Create a bloom filter file ahead of its use, its disk blocks allocated and read in."""
+    create_filter(capacity, error_rate, path).close()
+    memory.preallocate(path)
 
 
 class BatchedBloomFilter(Generic[Element]):
-    """A wrapper for multiple persistent bloom filters that are rotated periodically."""
+    """
+    A wrapper for multiple persistent bloom filters that are rotated periodically.
+
+    Filters are grouped in batches, a new one started on each rotation, and only the most recent
+    batch is written to. Once its last filter holds as many elements as it has capacity for, the
+    saturation policy decides whether to let the false positive rate rise, to rotate early, or to
+    chain a larger filter to the batch.
+
+    Lookups touch filters at random, so the kernel is advised not to read ahead on page faults.
+    The filter written to is kept resident in memory.
 
-    batches: List[BloomFilter]
+    The filter of the next batch is prepared by a background thread, its disk blocks allocated and
+    read in, so a rotation only renames and maps it. Stale filters are closed and removed, and
+    memory hints applied, by the same thread.
+
+    Batches of elements, e.g. of replay, are looked up and added with `contains_many` and
+    `add_many`.
+    """
+
+    batches: List[List[Filter]]
     directory: Path
     filter_capacity: int
     filter_error_rate: float
     batch_count: int
     batch_duration_sec: int
+    saturation_policy: str
     last_batch_ts: int
+    recent_filter_count: int
+    resident_path: Optional[Path]
+    prepared_path: Path
 
     def __init__(
         self,
@@ -30,6 +143,7 @@ class BatchedBloomFilter(Generic[Element]):
         filter_error_rate: float,
         batch_count: int,
         batch_duration_sec: int,
+        saturation_policy: str = SATURATION_IGNORE,
     ):
         """Create a BatchedBloomFilter from a set of files, named `<unix_timestamp>.bloom`."""
         self.directory = directory
@@ -37,70 +151,193 @@ class BatchedBloomFilter(Generic[Element]):
         self.filter_error_rate = filter_error_rate
         self.batch_count = batch_count
         self.batch_duration_sec = batch_duration_sec
+        self.saturation_policy = saturation_policy
+        # Guards closing filters against reading their stats from another thread.
+        self._lock = threading.Lock()
+        self.resident_path = None
+        # A single thread, so tasks don't race each other, e.g. preparing the same file.
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bloom-rotation')
+        self.prepared_path = self.directory / PREPARED_FILE_NAME
+        self._prepared: Optional[Future] = None
+        if self.prepared_path.exists():
+            # Possibly of other parameters, or partially written.
+            self.prepared_path.unlink()
 
-        files = list(self.directory.glob('*.bloom'))
-
-        timestamps = []
-        timestamp_to_path = {}
-        for path in files:
-            try:
-                timestamp = int(path.stem)
-            except ValueError:
-                log.info('Ignoring invalid file name (expecting <unix_timestamp>.bloom): %s', path)
-            else:
-                timestamps.append(timestamp)
-                timestamp_to_path[timestamp] = path
-
-        recent_timestamps = sorted(timestamps)[-self.batch_count:]
+        timestamp_to_paths = find_filter_files(self.directory)
+        recent_timestamps = sorted(timestamp_to_paths)[-self.batch_count:]
         try:
             self.last_batch_ts = recent_timestamps[-1]
         except IndexError:
             self.last_batch_ts = 0
 
-        self.batches = [BloomFilter.open(str(timestamp_to_path[ts])) for ts in recent_timestamps]
+        self.batches = [
+            [open_filter(path) for _, path in sorted(timestamp_to_paths[ts].items())]
+            for ts in recent_timestamps
+        ]
         log.info('Found existing bloom filters: %s', dict(zip(recent_timestamps, self.batches)))
+        # The number of elements isn't persisted, so it's estimated from the bits set.
+        self.recent_filter_count = self.recent_filter.approx_len if self.batches else 0
         self.rotate_if_needed()
+        self._background.submit(self._apply_memory_hints)
+        self._prepare_next()
 
-    def rotate_if_needed(self):
+    def rotate_if_needed(self, force: bool = False):
         """Remove stale filters, create a new filter if needed, named `<unix_timestamp>.bloom`."""
         ts = int(time.time())
-        if ts - self.last_batch_ts > self.batch_duration_sec:
+        if force or ts - self.last_batch_ts > self.batch_duration_sec:
+            # Rotating early, we may be asked to rotate again within the same second.
+            ts = max(ts, self.last_batch_ts + 1)
             retained = self.batch_count - 1
-            stale = self.batches[:-retained]
-            self.batches = self.batches[-retained:]
-
-            for stale_bf in stale:
-                file_name = Path(stale_bf.filename)
-                stale_bf.close()
-                file_name.unlink()
-                log.info('Closed stale bloom filter: %s', file_name)
-
+            stale = self.batches[:-retained] if retained else self.batches
             bloom_filter_file = self.directory / f'{ts}.bloom'
-            self.batches.append(BloomFilter(
-                self.filter_capacity, self.filter_error_rate, str(bloom_filter_file)))
+            self.batches = (self.batches[-retained:] if retained else []) + [
+                [self._take_prepared(bloom_filter_file)]]
             self.last_batch_ts = ts
+            self.recent_filter_count = 0
             log.info('Created a new bloom filter: %s', bloom_filter_file)
 
-            log.info('Operating with filters: %r', [(bf.filename, bf) for bf in self.batches])
+            log.info('Operating with filters: %r',
+                     [(bf.filename, bf) for batch in self.batches for bf in batch])
+            if stale:
+                self._background.submit(self._remove_stale, stale)
+            self._background.submit(self._apply_memory_hints)
+            self._prepare_next()
+
+    def _prepare_next(self):
+        """Prepare the filter of the next batch in the background, unless it's been prepared."""
+        if self._prepared is None:
+            self._prepared = self._background.submit(
+                prepare_filter, self.filter_capacity, self.filter_error_rate, self.prepared_path)
+
+    def _take_prepared(self, path: Path) -> Filter:
+        """Move the prepared filter to the path and open it, or create one if it's not ready."""
+        prepared, self._prepared = self._prepared, None
+        if prepared is not None and prepared.done():
+            try:
+                prepared.result()
+                os.rename(str(self.prepared_path), str(path))
+                return open_filter(path)
+            except OSError as e:
+                log.warning('Could not use the prepared bloom filter: %s', e)
+        elif prepared is not None:
+            log.info('The next bloom filter is not prepared yet, creating it now')
+        return create_filter(self.filter_capacity, self.filter_error_rate, path)
+
+    def _remove_stale(self, stale: List[List[Filter]]):
+        """Close and remove filters of stale batches."""
+        with self._lock:
+            for stale_batch in stale:
+                for stale_bf in stale_batch:
+                    file_name = Path(stale_bf.filename)
+                    stale_bf.close()
+                    file_name.unlink()
+                    log.info('Closed stale bloom filter: %s', file_name)
+
+    def handle_saturation(self):
+        """Rotate or chain a larger filter if the most recent filter is full, as configured."""
+        recent_filter = self.recent_filter
+        if (self.recent_filter_count < recent_filter.capacity
+                or self.saturation_policy == SATURATION_IGNORE):
+            return
+
+        if self.saturation_policy == SATURATION_ROTATE:
+            log.warning('Bloom filter %s saturated with %s elements, rotating early',
+                        recent_filter.filename, self.recent_filter_count)
+            self.rotate_if_needed(force=True)
+            return
+
+        recent_batch = self.batches[-1]
+        bloom_filter_file = self.directory / f'{self.last_batch_ts}.{len(recent_batch)}.bloom'
+        capacity = recent_filter.capacity * GROWTH_FACTOR
+        error_rate = recent_filter.error_rate * ERROR_RATE_TIGHTENING
+        recent_batch.append(create_filter(capacity, error_rate, bloom_filter_file))
+        self.recent_filter_count = 0
+        log.warning('Bloom filter %s saturated, chained %s, capacity %s, error rate %s',
+                    recent_filter.filename, bloom_filter_file, capacity, error_rate)
+        self._background.submit(self._apply_memory_hints)
+
+    def _apply_memory_hints(self):
+        """Advise random access to all filters, keep only the one written to resident."""
+        for path in self.paths():
+            memory.advise(path, memory.MADV_RANDOM)
+        recent_path = Path(self.recent_filter.filename)
+        if recent_path != self.resident_path:
+            if self.resident_path is not None:
+                memory.release_resident(self.resident_path)
+            memory.keep_resident(recent_path)
+            self.resident_path = recent_path
 
     @property
     def recent_filter(self):
         """Return the most recent bloom filter, the one written to."""
-        return self.batches[-1]
+        return self.batches[-1][-1]
+
+    def paths(self) -> List[Path]:
+        """Return paths of all filter files."""
+        with self._lock:
+            return [Path(bf.filename) for batch in list(self.batches) for bf in list(batch)]
+
+    def filter_stats(self) -> List[Tuple[str, float, float]]:
+        """Return the file name, ratio of bits set and estimated false positive rate of filters."""
+        stats = []
+        with self._lock:
+            for batch in list(self.batches):
+                for bf in list(batch):
+                    fill_ratio = bf.bit_count / bf.num_bits
+                    stats.append((Path(bf.filename).name, fill_ratio, fill_ratio ** bf.num_hashes))
+        return stats
 
     def __contains__(self, element: Element):
         """Check if the element has been seen by any of the filters."""
-        for bf in self.batches:
-            if element in bf:
-                return True
+        for batch in self.batches:
+            for bf in batch:
+                if element in bf:
+                    return True
         return False
 
     def add(self, element: Element):
         """Add the element to the most recent filter."""
         self.rotate_if_needed()
+        self.handle_saturation()
         self.recent_filter.add(element)
+        self.recent_filter_count += 1
+
+    def contains_many(self, elements: Sequence[Element]) -> List[bool]:
+        """Check if each of the elements has been seen by any of the filters."""
+        found = [False] * len(elements)
+        for batch in self.batches:
+            for bf in batch:
+                found = [
+                    seen or hit for seen, hit in zip(found, bf.contains_many(elements))]
+        return found
+
+    def add_many(self, elements: Sequence[Element]):
+        """Add the elements to the most recent filter, as many as it has capacity for at a time."""
+        self.rotate_if_needed()
+        start = 0
+        while start < len(elements):
+            self.handle_saturation()
+            count = len(elements) - start
+            if self.saturation_policy != SATURATION_IGNORE:
+                # Saturation is handled before every filter is full.
+                count = min(count, max(self.recent_filter.capacity - self.recent_filter_count, 1))
+            self.recent_filter.add_many(elements[start:start + count])
+            self.recent_filter_count += count
+            start += count
+
+    def sync(self):
+        """Write the most recent batch, the only one written to, out to disk."""
+        for bf in self.batches[-1]:
+            bf.sync()
 
     def close(self):
-        """Close all bloom filter files."""
-        for bf in self.batches:
-            bf.close()
+        """Wait for background tasks, close all bloom filter files and remove the prepared one."""
+        self._background.shutdown(wait=True)
+        if self._prepared is not None and self.prepared_path.exists():
+            self.prepared_path.unlink()
+        self._prepared = None
+        with self._lock:
+            for batch in self.batches:
+                for bf in batch:
+                    bf.close()
+            self.batches = []
@@ -0,0 +1,84 @@
+"""Persistence of the last processed resourceVersion, letting restarts resume the watch."""
+import os
+import time
+import logging
+from typing import Callable, Optional
+from pathlib import Path
+
+
+log = logging.getLogger(__name__)
+
+
+RESOURCE_VERSION_FILE_NAME = 'resource_version'
+
+
+class ResourceVersionCheckpoint:
+    """
+    The last processed resourceVersion, saved in a file next to the bloom filters.
+
+    Saving is throttled to once per `interval_sec`, since resuming from a slightly older
+    resourceVersion only replays a few events, which are then skipped by the bloom filters.
+
+    `before_save` is called before saving, to write out events the resourceVersion covers.
+    """
+
+    path: Path
+    interval_sec: float
+    before_save: Optional[Callable[[], None]]
+    resource_version: Optional[str]
+    saved_resource_version: Optional[str]
+    last_save_time: float
+
+    def __init__(
+        self,
+        directory: Path,
+        interval_sec: float,
+        before_save: Optional[Callable[[], None]] = None,
+    ):
+        """Load the checkpoint from `<directory>/resource_version`, if present."""
+        self.path = directory / RESOURCE_VERSION_FILE_NAME
+        self.interval_sec = interval_sec
+        self.before_save = before_save
+        self.resource_version = self.load()
+        self.saved_resource_version = self.resource_version
+        self.last_save_time = time.monotonic()
+
+    def load(self) -> Optional[str]:
+        """Read the saved resourceVersion, return None if there's none."""
+        try:
+            resource_version = self.path.read_text().strip()
+        except FileNotFoundError:
+            return None
+        if not resource_version:
+            log.info('Ignoring empty resourceVersion checkpoint: %s', self.path)
+            return None
+        log.info('Loaded resourceVersion checkpoint: %s', resource_version)
+        return resource_version
+
+    def update(self, resource_version: str):
+        """Record a processed resourceVersion, saving it if the interval has passed."""
+        self.resource_version = resource_version
+        if time.monotonic() - self.last_save_time >= self.interval_sec:
+            self.save()
+
+    def save(self):
+        """Atomically replace the checkpoint file with the current resourceVersion."""
+        self.last_save_time = time.monotonic()
+        if self.resource_version is None or self.resource_version == self.saved_resource_version:
+            return
+        if self.before_save is not None:
+            self.before_save()
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(self.resource_version)
+        os.replace(str(tmp_path), str(self.path))
+        self.saved_resource_version = self.resource_version
+        log.debug('Saved resourceVersion checkpoint: %s', self.resource_version)
+
+    def clear(self):
+        """Forget the resourceVersion, e.g. when it has expired."""
+        self.resource_version = None
+        self.saved_resource_version = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,161 @@
+"""Watching many clusters, by kubeconfig context, in threads writing to a shared destination."""
+import re
+import sys
+import json
+import time
+import logging
+import threading
+from typing import Callable, List, Optional
+from pathlib import Path
+from kube_event_pipe.destination import Destination, FSYNC_GROUP, FSYNC_NEVER
+
+
+log = logging.getLogger(__name__)
+
+
+CLUSTER_FIELD = 'cluster'
+
+WATCHER_POLL_INTERVAL_SEC = 1.0
+WATCHER_STOP_TIMEOUT_SEC = 10.0
+
+
+def parse_contexts(spec: str) -> List[str]:
+    """Parse a comma-separated list of kubeconfig contexts, e.g. `prod,staging`, keeping order."""
+    contexts: List[str] = []
+    for context in spec.split(','):
+        if context.strip() and context.strip() not in contexts:
+            contexts.append(context.strip())
+    return contexts
+
+
+def cluster_persistence_path(persistence_path: Path, context: str) -> Path:
+    """
+    Return the directory of a cluster's filters and checkpoint, e.g. `cluster-prod` for `prod`.
+
+    Characters other than letters, digits, `.`, `_` and `-`, e.g. in `arn:aws:eks:...`, are
+    replaced with `_`.
+    """
+    path = persistence_path / f"cluster-{re.sub(r'[^A-Za-z0-9._-]', '_', context)}"
+    path.mkdir(exist_ok=True)
+    return path
+
+
+def tag_cluster(data: bytes, tag: bytes) -> bytes:
+    """Add a field to a JSON object, given as `"<name>":<value>`, without re-encoding it."""
+    if data[1:].lstrip().startswith(b'}'):
+        return b'{' + tag + data[1:]
+    return b'{' + tag + b',' + data[1:]
+
+
+class ClusterDestination:
+    """
+    The destination of a cluster's events: the shared destination, with the cluster tagged on lines.
+
+    Group commit isn't supported, since the shared destination can't tell which cluster synced
+    events came from, so with `FSYNC_GROUP` events are marked as seen right away, and batches are
+    fsynced by the shared destination.
+    """
+
+    destination: Destination
+    cluster: str
+    tag: bytes
+    fsync_policy: str
+    on_sync: Optional[Callable[[int], None]]
+
+    def __init__(self, destination: Destination, cluster: str):
+        """Write lines tagged with `cluster`, in the `cluster` field, to `destination`."""
+        self.destination = destination
+        self.cluster = cluster
+        self.tag = b'"%s":%s' % (CLUSTER_FIELD.encode(), json.dumps(cluster).encode())
+        self.fsync_policy = (
+            FSYNC_NEVER if destination.fsync_policy == FSYNC_GROUP else destination.fsync_policy)
+        self.on_sync = None
+
+    def write(self, data: bytes, event_time: Optional[float] = None, events: int = 1):
+        """Buffer a JSON line in the shared destination, tagged with the cluster."""
+        self.destination.write(tag_cluster(data, self.tag), event_time, events)
+
+    def flush(self):
+        """Write out all buffered events, also of other clusters."""
+        self.destination.flush()
+
+    def close(self):
+        """Write out buffered events, leaving the shared destination open for other clusters."""
+        self.destination.flush()
+
+
+def call_when_set(event: threading.Event, function: Callable[[], None]):
+    """Call a function once the event is set, from a daemon thread."""
+    def wait():
+        event.wait()
+        function()
+
+    threading.Thread(target=wait, name='call-when-set', daemon=True).start()
+
+
+class ClusterSupervisor:
+    """
+    Runs a watcher thread per kubeconfig context.
+
+    If a watcher stops, the remaining ones are stopped and the supervisor exits with an error.
+    Watchers are stopped by setting the event they are given, and return once they have written
+    out their events and saved their checkpoints.
+    """
+
+    worker: Callable[[str, threading.Event], None]
+    contexts: List[str]
+    threads: List[threading.Thread]
+    stopping: threading.Event
+
+    def __init__(self, worker: Callable[[str, threading.Event], None], contexts: List[str]):
+        """Prepare to run `worker(context, stopping)` for each context."""
+        self.worker = worker
+        self.contexts = contexts
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def run(self):
+        """Start the watchers and supervise them until terminated."""
+        for context in self.contexts:
+            thread = threading.Thread(
+                target=self._watch, args=(context,), name=f'cluster-{context}', daemon=True)
+            thread.start()
+            log.info('Started watcher of context %s', context)
+            self.threads.append(thread)
+
+        try:
+            dead: List[threading.Thread] = []
+            while not dead:
+                # Sleeping, unlike joining, is interrupted by signals on all Python versions.
+                time.sleep(WATCHER_POLL_INTERVAL_SEC)
+                dead = [thread for thread in self.threads if not thread.is_alive()]
+        except (SystemExit, KeyboardInterrupt):
+            log.info('Stopping cluster watchers')
+            self._stop()
+            raise
+
+        for dead_thread in dead:
+            log.error('Watcher %s stopped', dead_thread.name)
+        self._stop()
+        sys.exit(1)
+
+    def _watch(self, context: str):
+        try:
+            self.worker(context, self.stopping)
+        except Exception:
+            log.exception('Watcher of context %s failed', context)
+
+    def _stop(self):
+        """
+        Ask the watchers to stop, for them to save their checkpoints, and wait for them.
+
+        A watcher blocked reading from the API server with the kubernetes client only stops once
+        it receives something, e.g. a bookmark, so those which don't stop in time are abandoned.
+        They resume from their last checkpoint, replaying events which the filters then skip.
+        """
+        self.stopping.set()
+        deadline = time.monotonic() + WATCHER_STOP_TIMEOUT_SEC
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+            if thread.is_alive():
+                log.warning('Watcher %s did not stop in time, abandoning it', thread.name)
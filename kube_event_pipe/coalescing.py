@@ -0,0 +1,208 @@
+"""Coalescing storms of events about the same object and reason into summaries."""
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence, Tuple
+from kube_event_pipe import metrics
+from kube_event_pipe.source import event_time, event_timestamp
+
+
+log = logging.getLogger(__name__)
+
+
+# The JSON to write, the time the event occurred at, and the number of events it stands for.
+Line = Tuple[bytes, Optional[float], int]
+
+SUMMARY_FIELD = 'coalesced'
+# Time between checks for windows which ended while no events come.
+EXPIRY_INTERVAL_SEC = 1.0
+
+
+def storm_key(event_obj: dict) -> Tuple:
+    """Return the object an event is about, by uid if it's set, and the event's reason."""
+    involved = event_obj.get('involvedObject') or event_obj.get('regarding') or {}
+    obj = involved.get('uid') or (
+        involved.get('kind'), involved.get('namespace'), involved.get('name'))
+    return obj, event_obj.get('reason')
+
+
+class Window:
+    """Repeats of an event held since the last line written about its object and reason."""
+
+    opened_at: float
+    written_count: Optional[int]
+    held: int
+    identities: List[bytes]
+    first_timestamp: Optional[str]
+    last_obj: Optional[dict]
+    last_count: Optional[int]
+
+    def __init__(
+        self, opened_at: float, written_count: Optional[int], identities: Sequence[bytes] = (),
+    ):
+        """Open an empty window, after a line about an event of `written_count` was written."""
+        self.opened_at = opened_at
+        self.written_count = written_count
+        self.held = 0
+        # Of held events, then of events about to be held.
+        self.identities = list(identities)
+        self.first_timestamp = None
+        self.last_obj = None
+        self.last_count = None
+
+
+class Coalescer:
+    """
+    Holds repeated events about the same object and reason, writing a summary of them.
+
+    The first event about an object and reason is written as it is and opens a window of
+    `window_sec`. Events about the same object and reason within the window are held. Once it
+    ends, the most recent held event is written with a summary in the `coalesced` field: the
+    number of held events, the increase of `count` since the last line, the first and last
+    timestamp and a sample message. A new window is then opened, so a continuing storm results in
+    a summary per window. Windows without held events are closed.
+
+    Windows which ended are closed by `expired`, which pipelines call before deduplicating each
+    event, and periodically while no events come, writing the summaries in order with events. New
+    events are passed to `hold` before they're recorded as seen, and identities of held events are
+    passed to `on_release` once their summary is written, so they can be recorded then. The
+    resourceVersion to checkpoint doesn't pass held events either, see `resume_version`.
+    """
+
+    window_sec: float
+    windows: 'OrderedDict[Tuple, Window]'
+    holding: 'OrderedDict[Tuple, Optional[str]]'
+    resource_version: Optional[str]
+    on_release: Optional[Callable[[List[bytes]], None]]
+
+    def __init__(self, window_sec: float):
+        """Coalesce events within `window_sec` of the first one about their object and reason."""
+        self.window_sec = window_sec
+        self.windows = OrderedDict()
+        # Keys of windows holding events, by the time they started to, with the resourceVersion
+        # processed before.
+        self.holding = OrderedDict()
+        self.resource_version = None
+        self.on_release = None
+        # Held by pipelines from closing windows until events are written, and reentrant, since
+        # deduplicating events asks `hold`.
+        self.lock = threading.RLock()
+
+    def hold(self, event_obj: dict, event_identity: bytes) -> bool:
+        """
+        Return whether a new event is going to be held, keeping its identity if so.
+
+        The identity is released with the summary of the event, or when the event is written as it
+        is, if its window ends before the event is passed in.
+        """
+        with self.lock:
+            window = self.windows.get(storm_key(event_obj))
+            if window is None:
+                return False
+            window.identities.append(event_identity)
+            return True
+
+    def __call__(self, event_obj: dict, event_data: Optional[bytes]) -> List[Line]:
+        """
+        Return lines to write: the event, unless it's held.
+
+        Windows which ended are expected to be closed with `expired` before the event was
+        deduplicated. Events seen before, for which `event_data` is None, are neither written nor
+        held.
+        """
+        with self.lock:
+            now = time.monotonic()
+            lines: List[Line] = []
+            resource_version = self.resource_version
+            self.resource_version = event_obj['metadata'].get('resourceVersion')
+            if event_data is None:
+                return lines
+
+            key = storm_key(event_obj)
+            window = self.windows.get(key)
+            if window is None:
+                self.windows[key] = Window(now, event_obj.get('count'))
+                lines.append((event_data, event_time(event_obj), 1))
+                return lines
+
+            window.held += 1
+            if window.held == 1:
+                self.holding[key] = resource_version
+            if window.first_timestamp is None:
+                window.first_timestamp = event_timestamp(event_obj)
+            window.last_obj = event_obj
+            window.last_count = event_obj.get('count')
+            metrics.EVENTS_COALESCED.inc()
+            return lines
+
+    def resume_version(self, resource_version: str) -> str:
+        """
+        Return the resourceVersion to checkpoint, once events up to `resource_version` passed.
+
+        While events are held, that's the one passed in before the first of them, so they're listed
+        again if the process crashes before their summary is written.
+        """
+        with self.lock:
+            for held_since in self.holding.values():
+                if held_since is not None:
+                    return held_since
+            return resource_version
+
+    def expired(self, now: float) -> List[Line]:
+        """Close windows which ended by `now`, return summaries of their held events."""
+        with self.lock:
+            lines = []
+            windows = self.windows
+            # Windows are ordered by the time they were opened at.
+            while windows:
+                key, window = next(iter(windows.items()))
+                if now - window.opened_at < self.window_sec:
+                    break
+                del windows[key]
+                self.holding.pop(key, None)
+                # Events about to be held are held in the next window, or written as they are.
+                pending = window.identities[window.held:]
+                if window.held:
+                    lines.append(self.summary(window))
+                    windows[key] = Window(now, window.last_count, pending)
+                else:
+                    self._release(pending)
+            return lines
+
+    def drain(self) -> List[Line]:
+        """Close all windows, return summaries of their held events."""
+        with self.lock:
+            lines = []
+            for window in self.windows.values():
+                if window.held:
+                    lines.append(self.summary(window))
+                self._release(window.identities[window.held:])
+            self.windows.clear()
+            self.holding.clear()
+            return lines
+
+    def summary(self, window: Window) -> Line:
+        """Return the most recent held event, with a summary of all held events, releasing them."""
+        event_obj = window.last_obj
+        assert event_obj is not None
+        count = window.last_count
+        summary = {
+            'events': window.held,
+            'countDelta': (
+                count - window.written_count
+                if isinstance(count, int) and isinstance(window.written_count, int) else None
+            ),
+            'firstTimestamp': window.first_timestamp,
+            'lastTimestamp': event_timestamp(event_obj),
+            'sampleMessage': event_obj.get('message'),
+        }
+        log.debug('Coalesced %s events: %s', window.held, storm_key(event_obj))
+        self._release(window.identities[:window.held])
+        data = json.dumps({**event_obj, SUMMARY_FIELD: summary}).encode()
+        return data, event_time(event_obj), window.held
+
+    def _release(self, identities: List[bytes]):
+        if identities and self.on_release is not None:
+            self.on_release(identities)
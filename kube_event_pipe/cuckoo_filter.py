@@ -0,0 +1,287 @@
+"""A persistent cuckoo filter whose entries expire after a sliding time window."""
+import os
+import math
+import mmap
+import time
+import random
+import struct
+import hashlib
+import logging
+from typing import Generic, List, Sequence, Tuple, TypeVar
+from pathlib import Path
+from kube_event_pipe import memory
+
+
+log = logging.getLogger(__name__)
+
+
+Element = TypeVar('Element', str, bytes)
+
+
+CUCKOO_FILE_NAME = 'events_seen.cuckoo'
+CUCKOO_MAGIC = b'KEPCUCK1'
+# Magic, bucket count, fingerprint bits, tag bits, window, last tick, sweep position.
+HEADER_FORMAT = '<8sQBBxxIqQ'
+BUCKET_SIZE = 4
+MAX_LOAD_FACTOR = 0.95
+MAX_KICKS = 500
+MAX_FINGERPRINT_BITS = 24
+MIN_TAG_BITS = 4
+# A 64-bit bucket index followed by the fingerprint.
+DIGEST_SIZE = 16
+
+
+def cuckoo_filter_geometry(capacity: int, error_rate: float) -> Tuple[int, int, int]:
+    """
+    Return the number of buckets, and bits of the fingerprint and time tag of each entry.
+
+    Entries are 16 bits wide if a fingerprint of 12 bits or less gives the error rate, which leaves
+    at least 4 bits for the time tag, or 32 bits wide otherwise.
+    """
+    bucket_count = math.ceil(capacity / BUCKET_SIZE / MAX_LOAD_FACTOR)
+    # A lookup compares fingerprints of two buckets.
+    fingerprint_bits = min(
+        MAX_FINGERPRINT_BITS, max(1, math.ceil(math.log2(2 * BUCKET_SIZE / error_rate))))
+    entry_bits = 16 if fingerprint_bits <= 16 - MIN_TAG_BITS else 32
+    return bucket_count, fingerprint_bits, entry_bits - fingerprint_bits
+
+
+def cuckoo_filter_capacity(memory_bytes: int, error_rate: float) -> int:
+    """Return the number of elements a cuckoo filter of the size holds with the error rate."""
+    _, fingerprint_bits, tag_bits = cuckoo_filter_geometry(1, error_rate)
+    return int(memory_bytes * 8 // (fingerprint_bits + tag_bits) * MAX_LOAD_FACTOR)
+
+
+class SlidingCuckooFilter(Generic[Element]):
+    """
+    A cuckoo filter of elements seen within the last `window_sec`, stored in an mmapped file.
+
+    Each entry holds a fingerprint of the element and a time tag, the tick it was added in, modulo
+    the tag size. The window is half the tag range, in ticks. Entries older than the window are
+    ignored by lookups, reused by inserts and cleared by a sweep, which goes through all buckets
+    often enough for tags never to wrap around.
+
+    All of the filter is written to, so all of it is kept resident.
+    """
+
+    path: Path
+    window_sec: int
+    bucket_count: int
+    fingerprint_bits: int
+    tag_bits: int
+    last_tick: int
+    sweep_position: int
+    insert_failures: int
+
+    def __init__(
+        self,
+        directory: Path,
+        filter_capacity: int,
+        filter_error_rate: float,
+        batch_count: int,
+        batch_duration_sec: int,
+    ):
+        """
+        Open the filter in `<directory>/events_seen.cuckoo`, creating it if needed.
+
+        The filter holds elements seen in the last `batch_count * batch_duration_sec` - the longest
+        rotated bloom filters would remember them for - and up to `batch_count * filter_capacity`
+        of them.
+        """
+        self.path = directory / CUCKOO_FILE_NAME
+        self.window_sec = batch_count * batch_duration_sec
+        self.bucket_count, self.fingerprint_bits, self.tag_bits = cuckoo_filter_geometry(
+            batch_count * filter_capacity, filter_error_rate)
+        entry_bits = self.fingerprint_bits + self.tag_bits
+
+        self.fingerprint_mask = (1 << self.fingerprint_bits) - 1
+        self.tag_mask = (1 << self.tag_bits) - 1
+        self.window_ticks = 1 << (self.tag_bits - 1)
+        self.tick_sec = self.window_sec / self.window_ticks
+        # An expired entry must be swept before its tag wraps around.
+        self.sweep_ticks = (1 << self.tag_bits) - self.window_ticks - 3
+        self.insert_failures = 0
+
+        self.data_offset = mmap.PAGESIZE
+        entry_bytes = entry_bits // 8
+        file_size = self.data_offset + self.bucket_count * BUCKET_SIZE * entry_bytes
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing_size = os.fstat(fd).st_size
+            if existing_size != file_size:
+                if existing_size:
+                    log.warning('Discarding cuckoo filter of a different size: %s', self.path)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, file_size)
+            self.mmap = mmap.mmap(fd, file_size)
+        finally:
+            os.close(fd)
+        memory.advise(self.path, memory.MADV_RANDOM)
+        memory.keep_resident(self.path)
+        self.entries = memoryview(self.mmap)[self.data_offset:].cast(
+            'H' if entry_bytes == 2 else 'I')
+
+        self.last_tick = self._tick()
+        self.sweep_position = 0
+        if not self._read_header():
+            self._sweep(0, self.bucket_count, gap=self.window_ticks + 1)
+            self._write_header()
+        log.info('Opened cuckoo filter %s: %s buckets, %s bit fingerprints, %s ticks of %.1fs',
+                 self.path, self.bucket_count, self.fingerprint_bits, self.window_ticks,
+                 self.tick_sec)
+        self._advance()
+
+    def _read_header(self) -> bool:
+        """Read the sweep state, return whether the header was valid."""
+        (
+            magic, bucket_count, fingerprint_bits, tag_bits, window_sec, last_tick, sweep_position,
+        ) = struct.unpack_from(HEADER_FORMAT, self.mmap)
+        if magic != CUCKOO_MAGIC:
+            return False
+        if (bucket_count, fingerprint_bits, tag_bits, window_sec) != (
+                self.bucket_count, self.fingerprint_bits, self.tag_bits, self.window_sec):
+            log.warning('Discarding cuckoo filter of a different geometry: %s', self.path)
+            return False
+        self.last_tick = last_tick
+        self.sweep_position = sweep_position
+        return True
+
+    def _write_header(self):
+        struct.pack_into(
+            HEADER_FORMAT, self.mmap, 0,
+            CUCKOO_MAGIC, self.bucket_count, self.fingerprint_bits, self.tag_bits, self.window_sec,
+            self.last_tick, self.sweep_position)
+
+    def _tick(self) -> int:
+        return int(time.time() / self.tick_sec)
+
+    def paths(self) -> List[Path]:
+        """Return the path of the filter file."""
+        return [self.path]
+
+    def _advance(self):
+        """Sweep buckets as due since the last tick."""
+        tick = self._tick()
+        gap = tick - self.last_tick
+        if gap <= 0:
+            return
+        self.last_tick = tick
+        if gap == 1:
+            chunk = math.ceil(self.bucket_count / self.sweep_ticks)
+            end = min(self.sweep_position + chunk, self.bucket_count)
+            self._sweep(self.sweep_position, end, gap)
+            self.sweep_position = end % self.bucket_count
+        else:
+            # Nothing was added or swept for a while, e.g. the process wasn't running.
+            log.info('Sweeping cuckoo filter %s after %s ticks', self.path, gap)
+            self._sweep(0, self.bucket_count, gap)
+            self.sweep_position = 0
+        self._write_header()
+
+    def _sweep(self, start_bucket: int, end_bucket: int, gap: int):
+        """
+        Clear expired entries.
+
+        All entries were added at least `gap` ticks ago, so ones that seem more recent have tags
+        that have wrapped around.
+        """
+        entries = self.entries
+        tick = self.last_tick
+        tag_mask = self.tag_mask
+        window_ticks = self.window_ticks
+        if gap > window_ticks:
+            bucket_bytes = BUCKET_SIZE * entries.itemsize
+            start = self.data_offset + start_bucket * bucket_bytes
+            self.mmap[start:start + (end_bucket - start_bucket) * bucket_bytes] = bytes(
+                (end_bucket - start_bucket) * bucket_bytes)
+            return
+        for i in range(start_bucket * BUCKET_SIZE, end_bucket * BUCKET_SIZE):
+            entry = entries[i]
+            if entry:
+                age = (tick - entry) & tag_mask
+                if age > window_ticks or age < gap:
+                    entries[i] = 0
+
+    def _probe(self, element: Element) -> Tuple[int, int]:
+        """Return the primary bucket and the fingerprint of the element."""
+        if isinstance(element, bytes) and len(element) >= DIGEST_SIZE:
+            # Long enough bytes are event identity digests, uniformly distributed already.
+            digest = int.from_bytes(element[:DIGEST_SIZE], 'little')
+        else:
+            data = element.encode() if isinstance(element, str) else element
+            digest = int.from_bytes(
+                hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest(), 'little')
+        fingerprint = (digest >> 64) & self.fingerprint_mask or 1
+        return (digest & 0xffffffffffffffff) % self.bucket_count, fingerprint
+
+    def _alternate_bucket(self, bucket: int, fingerprint: int) -> int:
+        """Return the other bucket of a fingerprint. Works both ways, for any bucket count."""
+        fingerprint_hash = (fingerprint * 0x5bd1e995) & 0xffffffff
+        return (fingerprint_hash - bucket) % self.bucket_count
+
+    def __contains__(self, element: Element) -> bool:
+        """Check if the element has been seen within the window."""
+        self._advance()
+        bucket, fingerprint = self._probe(element)
+        entries = self.entries
+        tick = self.last_tick
+        for b in (bucket, self._alternate_bucket(bucket, fingerprint)):
+            for entry in entries[b * BUCKET_SIZE:(b + 1) * BUCKET_SIZE]:
+                if (entry >> self.tag_bits == fingerprint
+                        and (tick - entry) & self.tag_mask <= self.window_ticks):
+                    return True
+        return False
+
+    def add(self, element: Element):
+        """Add the element, tagged with the current tick."""
+        self._advance()
+        bucket, fingerprint = self._probe(element)
+        entry = fingerprint << self.tag_bits | self.last_tick & self.tag_mask
+        alternate = self._alternate_bucket(bucket, fingerprint)
+        if self._insert_into(bucket, entry) or self._insert_into(alternate, entry):
+            return
+
+        # Relocate entries to their other buckets, to make space.
+        entries = self.entries
+        bucket = random.choice((bucket, alternate))
+        for _ in range(MAX_KICKS):
+            i = bucket * BUCKET_SIZE + random.randrange(BUCKET_SIZE)
+            entry, entries[i] = entries[i], entry
+            bucket = self._alternate_bucket(bucket, entry >> self.tag_bits)
+            if self._insert_into(bucket, entry):
+                return
+
+        self.insert_failures += 1
+        log.warning('Cuckoo filter %s full, dropped an entry (%s so far)',
+                    self.path, self.insert_failures)
+
+    def contains_many(self, elements: Sequence[Element]) -> List[bool]:
+        """Check if each of the elements has been seen, one by one."""
+        return [element in self for element in elements]
+
+    def add_many(self, elements: Sequence[Element]):
+        """Add the elements, one by one."""
+        for element in elements:
+            self.add(element)
+
+    def _insert_into(self, bucket: int, entry: int) -> bool:
+        """Put the entry into an empty or expired slot of the bucket, if there is one."""
+        entries = self.entries
+        for i in range(bucket * BUCKET_SIZE, (bucket + 1) * BUCKET_SIZE):
+            existing = entries[i]
+            if not existing or (self.last_tick - existing) & self.tag_mask > self.window_ticks:
+                entries[i] = entry
+                return True
+        return False
+
+    def sync(self):
+        """Write changed pages of the filter out to disk. The header is kept up to date."""
+        self.mmap.flush()
+
+    def close(self):
+        """Write the filter out and unmap it."""
+        self._write_header()
+        self.entries.release()
+        self.mmap.flush()
+        self.mmap.close()
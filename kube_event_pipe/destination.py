@@ -0,0 +1,205 @@
+"""Buffered writing of events to the destination file."""
+import os
+import time
+import errno
+import logging
+import threading
+from typing import IO, Callable, List, Optional
+from pathlib import Path
+from kube_event_pipe import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+FSYNC_NEVER = 'never'
+FSYNC_BATCH = 'batch'
+FSYNC_INTERVAL = 'interval'
+FSYNC_GROUP = 'group'
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_BATCH, FSYNC_INTERVAL, FSYNC_GROUP)
+
+
+def open_destination(destination_path: Path) -> IO[bytes]:
+    """Open a normal file for appending and a pipe for writing."""
+    try:
+        destination_file = destination_path.open('ab')
+    except OSError as e:
+        if e.errno != errno.ESPIPE:
+            raise
+        destination_file = destination_path.open('wb')
+    return destination_file
+
+
+class Destination:
+    """
+    The destination file, with events buffered and written in batches.
+
+    The buffer is flushed when it reaches `max_buffered_events` or `max_buffered_bytes`, and by
+    a background thread, every `flush_interval_sec`. Flushed batches are fsynced according to
+    `fsync_policy`, one of `FSYNC_POLICIES`. With `FSYNC_GROUP`, each batch is fsynced like with
+    `FSYNC_BATCH`, then `on_sync` is called with the number of events it stands for, to commit
+    them.
+
+    The file can be reopened, e.g. after log rotation, with `request_reopen`, which is safe to call
+    from signal handlers. It's opened with `open_file`, `open_destination` by default.
+    """
+
+    path: Path
+    open_file: Callable[[Path], IO[bytes]]
+    file: IO[bytes]
+    flush_interval_sec: float
+    max_buffered_bytes: int
+    max_buffered_events: int
+    fsync_policy: str
+    fsync_interval_sec: float
+    on_sync: Optional[Callable[[int], None]]
+    buffer: List[bytes]
+    buffered_event_times: List[float]
+    buffered_bytes: int
+    buffered_lines: int
+    buffered_events: int
+    unsynced: bool
+    last_fsync_time: float
+    reopen_requested: bool
+    error: Optional[Exception]
+
+    def __init__(
+        self,
+        path: Path,
+        flush_interval_sec: float,
+        max_buffered_bytes: int,
+        max_buffered_events: int,
+        fsync_policy: str = FSYNC_NEVER,
+        fsync_interval_sec: float = 1.0,
+        open_file: Callable[[Path], IO[bytes]] = open_destination,
+    ):
+        """Open the destination file and start flushing it periodically."""
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy: {fsync_policy!r}')
+        self.path = path
+        self.flush_interval_sec = flush_interval_sec
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_buffered_events = max_buffered_events
+        self.fsync_policy = fsync_policy
+        self.fsync_interval_sec = fsync_interval_sec
+        self.open_file = open_file
+        self.on_sync = None
+
+        self.file = open_file(path)
+        self.buffer = []
+        self.buffered_event_times = []
+        self.buffered_bytes = 0
+        self.buffered_lines = 0
+        self.buffered_events = 0
+        self.unsynced = False
+        self.last_fsync_time = time.monotonic()
+        self.reopen_requested = False
+        self.error = None
+
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, name='destination-flusher', daemon=True)
+        self._flusher.start()
+
+    def write(
+        self, data: bytes, event_time: Optional[float] = None, events: int = 1, lines: int = 1,
+    ):
+        """
+        Buffer a JSON line, flushing the buffer if it's full.
+
+        `event_time`, the Unix time the event last occurred at, is used to measure the lag of
+        writing it. `events` is the number of events the line stands for, e.g. a summary of
+        coalesced events, passed on to `on_sync`. `data` may also be `lines` lines, e.g. a batch
+        written by a shard worker, without the last newline.
+        """
+        start = time.monotonic()
+        if self.error is not None:
+            raise self.error
+        if self.reopen_requested:
+            self.reopen()
+        with self._lock:
+            self.buffer.append(data)
+            if event_time is not None:
+                self.buffered_event_times.append(event_time)
+            self.buffered_bytes += len(data) + 1
+            self.buffered_lines += lines
+            self.buffered_events += events
+            if (self.buffered_lines >= self.max_buffered_events
+                    or self.buffered_bytes >= self.max_buffered_bytes):
+                self._flush()
+        metrics.WRITE_LATENCY.observe(time.monotonic() - start)
+
+    def flush(self):
+        """Write out all buffered events."""
+        with self._lock:
+            self._flush()
+
+    def request_reopen(self):
+        """Reopen the file before writing the next event."""
+        self.reopen_requested = True
+
+    def reopen(self):
+        """Drain the buffer, then close and reopen the file, e.g. after log rotation."""
+        log.info('Log rotation. Reopening file: %s.', self.path)
+        self.reopen_requested = False
+        with self._lock:
+            self._flush()
+            self.file.close()
+            self.file = self.open_file(self.path)
+
+    def close(self):
+        """Stop the background flushing, drain the buffer and close the file."""
+        self._closed.set()
+        self._flusher.join()
+        with self._lock:
+            self._flush()
+            self.file.close()
+
+    def _flush(self):
+        if self.buffer:
+            start = time.monotonic()
+            line_count = self.buffered_lines
+            buffered_events = self.buffered_events
+            # Not appended to the buffer, which is written again if writing it fails.
+            self.file.write(b'\n'.join(self.buffer) + b'\n')
+            self.file.flush()
+            self.buffer = []
+            self.buffered_bytes = 0
+            self.buffered_lines = 0
+            self.buffered_events = 0
+            self.unsynced = True
+            if self.fsync_policy in (FSYNC_BATCH, FSYNC_GROUP):
+                self._fsync()
+            if self.fsync_policy == FSYNC_GROUP and self.on_sync is not None:
+                self.on_sync(buffered_events)
+
+            metrics.FLUSH_LATENCY.observe(time.monotonic() - start)
+            metrics.EVENTS_WRITTEN.inc(line_count)
+            now = time.time()
+            for event_time in self.buffered_event_times:
+                metrics.EVENT_LAG.observe(now - event_time)
+            self.buffered_event_times = []
+
+        if (self.fsync_policy == FSYNC_INTERVAL and self.unsynced
+                and time.monotonic() - self.last_fsync_time >= self.fsync_interval_sec):
+            self._fsync()
+
+    def _fsync(self):
+        try:
+            os.fsync(self.file.fileno())
+        except OSError as e:
+            # Pipes and character devices, like stdout, can't be synced.
+            if e.errno != errno.EINVAL:
+                raise
+        self.unsynced = False
+        self.last_fsync_time = time.monotonic()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval_sec):
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception('Failed to flush %s', self.path)
+                self.error = e
+                return
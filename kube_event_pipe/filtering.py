@@ -0,0 +1,66 @@
+"""Selecting events to pipe: by the API server where possible, locally otherwise."""
+from typing import Callable, FrozenSet, List, Optional
+
+
+def parse_names(spec: str) -> FrozenSet[str]:
+    """Parse a comma-separated list of names, e.g. `kube-system,monitoring`."""
+    return frozenset(name.strip() for name in spec.split(',') if name.strip())
+
+
+class EventFilter:
+    """
+    Selects events by namespace and reason, and with field and label selectors.
+
+    Selectors are applied by the API server, so unwanted events aren't even sent. Excluded
+    namespaces and reasons, and a single included one, are added to the field selector. Lists of
+    included namespaces and reasons can't be expressed with a field selector, so they're applied
+    locally, by `accept`.
+    """
+
+    include_namespaces: FrozenSet[str]
+    exclude_namespaces: FrozenSet[str]
+    include_reasons: FrozenSet[str]
+    exclude_reasons: FrozenSet[str]
+    field_selector: Optional[str]
+    label_selector: Optional[str]
+
+    def __init__(
+        self,
+        include_namespaces: FrozenSet[str] = frozenset(),
+        exclude_namespaces: FrozenSet[str] = frozenset(),
+        include_reasons: FrozenSet[str] = frozenset(),
+        exclude_reasons: FrozenSet[str] = frozenset(),
+        field_selector: str = '',
+        label_selector: str = '',
+    ):
+        """Select events from included namespaces and with included reasons, if any are given."""
+        self.include_namespaces = include_namespaces
+        self.exclude_namespaces = exclude_namespaces
+        self.include_reasons = include_reasons
+        self.exclude_reasons = exclude_reasons
+
+        fields: List[str] = [field_selector] if field_selector else []
+        for field, included, excluded in [
+            ('metadata.namespace', include_namespaces, exclude_namespaces),
+            ('reason', include_reasons, exclude_reasons),
+        ]:
+            if len(included) == 1:
+                fields.append(f'{field}={next(iter(included))}')
+            fields.extend(f'{field}!={name}' for name in sorted(excluded))
+        self.field_selector = ','.join(fields) or None
+        self.label_selector = label_selector or None
+
+    @property
+    def accept(self) -> Optional[Callable[[dict], bool]]:
+        """Return a predicate of event objects, or None if the API server selects all events."""
+        include_namespaces = self.include_namespaces if len(self.include_namespaces) > 1 else None
+        include_reasons = self.include_reasons if len(self.include_reasons) > 1 else None
+        if include_namespaces is None and include_reasons is None:
+            return None
+
+        def accept(event_obj: dict) -> bool:
+            if (include_namespaces is not None
+                    and event_obj['metadata'].get('namespace', '') not in include_namespaces):
+                return False
+            return include_reasons is None or event_obj.get('reason') in include_reasons
+        return accept
@@ -0,0 +1,108 @@
+"""Event identities: fixed-width digests of the fields which tell repeated events apart."""
+import time
+import logging
+from hashlib import blake2b
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+IDENTITY_NAME_COUNT = 'name-count'
+IDENTITY_UID_COUNT = 'uid-count'
+IDENTITY_UID_RESOURCE_VERSION = 'uid-resource-version'
+IDENTITIES = (IDENTITY_NAME_COUNT, IDENTITY_UID_COUNT, IDENTITY_UID_RESOURCE_VERSION)
+
+# 160 bits: collisions are negligible, and filters can use them without hashing again.
+DIGEST_SIZE = 20
+IDENTITY_FILE_NAME = 'identity'
+# Files of filters, whose identities may predate digests.
+FILTER_FILE_PATTERNS = ('*.bloom', 'events_seen.ring', 'events_seen.cuckoo')
+
+
+def name_count_key(event_obj: dict) -> str:
+    """Return `<name>-<count>`, the identity used before digests."""
+    return f"{event_obj['metadata']['name']}-{event_obj.get('count')}"
+
+
+def uid_count_key(event_obj: dict) -> str:
+    """Return `<uid>-<count>`, unique even if events are deleted and created with the same name."""
+    return f"{event_obj['metadata']['uid']}-{event_obj.get('count')}"
+
+
+def uid_resource_version_key(event_obj: dict) -> str:
+    """
+    Return `<uid>-<resourceVersion>`, for events counting repeats in `series`, not `count`.
+
+    Every update of an event changes its resourceVersion, so this tells apart all of them.
+    """
+    metadata = event_obj['metadata']
+    return f"{metadata['uid']}-{metadata['resourceVersion']}"
+
+
+IDENTITY_KEYS: Dict[str, Callable[[dict], str]] = {
+    IDENTITY_NAME_COUNT: name_count_key,
+    IDENTITY_UID_COUNT: uid_count_key,
+    IDENTITY_UID_RESOURCE_VERSION: uid_resource_version_key,
+}
+
+
+def make_identity(strategy: str) -> Callable[[dict], bytes]:
+    """Make a function returning the digest of an event object's identity."""
+    key = IDENTITY_KEYS[strategy]
+
+    def identity(event_obj: dict) -> bytes:
+        return blake2b(key(event_obj).encode(), digest_size=DIGEST_SIZE).digest()
+    return identity
+
+
+def read_identity_file(directory: Path) -> Tuple[Optional[str], float]:
+    """
+    Return the identity strategy recorded in a persistence directory, None if there's none.
+
+    Also return the Unix time until which filters may contain `<name>-<count>` strings, or 0.0.
+    """
+    try:
+        lines = (directory / IDENTITY_FILE_NAME).read_text().split()
+    except FileNotFoundError:
+        return None, 0.0
+    if not lines:
+        return None, 0.0
+    try:
+        legacy_until = float(lines[1]) if len(lines) > 1 else 0.0
+    except ValueError:
+        log.warning('Ignoring invalid time of identities written before digests: %r', lines[1])
+        legacy_until = 0.0
+    return lines[0], legacy_until
+
+
+def write_identity_file(directory: Path, strategy: str, legacy_until: float = 0.0):
+    """Record the identity strategy, and the time filters may contain strings until, if any."""
+    content = f'{strategy}\n{legacy_until}' if legacy_until else strategy
+    (directory / IDENTITY_FILE_NAME).write_text(content)
+
+
+def check_identity_strategy(persistence_path: Path, strategy: str, legacy_sec: float) -> float:
+    """
+    Record the identity strategy in the persistence directory, warn if it has changed.
+
+    Return the Unix time until which filters may contain `<name>-<count>` strings, written before
+    identities were digests, or 0.0 if they don't. Filters hold them for `legacy_sec` after the
+    first run with digests. The time is recorded with the strategy, so it survives restarts.
+    """
+    previous, recorded_until = read_identity_file(persistence_path)
+    legacy_until = recorded_until
+    if previous is None and any(
+            True for pattern in FILTER_FILE_PATTERNS for _ in persistence_path.glob(pattern)):
+        legacy_until = time.time() + legacy_sec
+    elif previous is not None and previous != strategy:
+        log.warning('Event identity changed from %s to %s, events seen before may be written again',
+                    previous, strategy)
+    if legacy_until <= time.time():
+        legacy_until = 0.0
+    else:
+        log.info('Filters contain identities written before digests, checking them too')
+    if (previous, recorded_until) != (strategy, legacy_until):
+        write_identity_file(persistence_path, strategy, legacy_until)
+    return legacy_until
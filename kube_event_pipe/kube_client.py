@@ -0,0 +1,342 @@
+"""
+A minimal client for watching events, without importing the kubernetes package.
+
+Only the credentials most clusters use are supported: tokens, client certificates and basic auth,
+from kubeconfig or the in-cluster service account. Kubeconfigs using exec or auth-provider plugins
+raise UnsupportedConfig, so the kubernetes client can be used instead.
+"""
+import os
+import ssl
+import json
+import base64
+import socket
+import logging
+import tempfile
+from http.client import HTTPConnection, HTTPSConnection, HTTPResponse, HTTPException
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping, NamedTuple, Optional
+from urllib.parse import urlencode, urlsplit
+
+
+log = logging.getLogger(__name__)
+
+
+EVENTS_PATH = '/api/v1/events'
+DEFAULT_KUBECONFIG = '~/.kube/config'
+SERVICE_ACCOUNT_DIR = Path('/var/run/secrets/kubernetes.io/serviceaccount')
+READ_SIZE = 64 * 1024
+
+
+class ApiError(Exception):
+    """An error response from the API server, either to the request or as a watch event."""
+
+    status: int
+    reason: str
+    headers: Optional[Mapping[str, str]]
+
+    def __init__(self, status: int, reason: str, headers: Optional[Mapping[str, str]] = None):
+        """Set the HTTP status code, reason and, of error responses, headers."""
+        super().__init__(f'({status}) {reason}')
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+
+class ConfigError(Exception):
+    """No usable kubeconfig or in-cluster configuration was found."""
+
+
+class UnsupportedConfig(ConfigError):
+    """The configuration needs the kubernetes client, e.g. for an auth plugin."""
+
+
+class ClusterConfig(NamedTuple):
+    """Where and how to connect to the API server."""
+
+    server: str
+    ssl_context: Optional[ssl.SSLContext]
+    # Tokens of service accounts are rotated, so they're read from the file for every request.
+    token_file: Optional[Path]
+    headers: Dict[str, str]
+
+
+def load_config(environ=os.environ, context: Optional[str] = None) -> ClusterConfig:
+    """
+    Load kubeconfig or, failing that, in-cluster config, like the kubernetes client does.
+
+    If `context` is given, it's used instead of the current context, and kubeconfig is required.
+
+    :raise: ConfigError
+    """
+    paths = [
+        Path(path).expanduser()
+        for path in environ.get('KUBECONFIG', DEFAULT_KUBECONFIG).split(os.pathsep) if path
+    ]
+    existing = [path for path in paths if path.is_file()]
+    if existing:
+        return load_kubeconfig(existing, context)
+    if context is not None:
+        raise ConfigError(f'No kubeconfig found in {paths} for context {context!r}')
+    if 'KUBERNETES_SERVICE_HOST' in environ:
+        return load_incluster_config(environ)
+    raise ConfigError(f'No kubeconfig found in {paths} and not running in a cluster')
+
+
+def load_kubeconfig(paths: List[Path], context_name: Optional[str] = None) -> ClusterConfig:
+    """
+    Load the named or current context of kubeconfig files, the first definition of a name winning.
+
+    :raise: ConfigError
+    """
+    # PyYAML is a dependency of the kubernetes client, but much cheaper to import.
+    import yaml  # type: ignore
+
+    current_context: Optional[str] = None
+    named: Dict[str, Dict[str, dict]] = {'clusters': {}, 'contexts': {}, 'users': {}}
+    for path in paths:
+        kubeconfig = yaml.safe_load(path.read_text()) or {}
+        current_context = current_context or kubeconfig.get('current-context')
+        for section, entries in named.items():
+            singular = section[:-1]
+            for entry in kubeconfig.get(section) or []:
+                item = dict(entry.get(singular) or {})
+                # Relative file paths are relative to the kubeconfig which sets them.
+                item['_directory'] = path.parent
+                entries.setdefault(entry['name'], item)
+
+    context_name = context_name or current_context
+    if context_name is None:
+        raise ConfigError(f'No current-context set in {paths}')
+    try:
+        context = named['contexts'][context_name]
+        cluster = named['clusters'][context['cluster']]
+        user = named['users'].get(context.get('user', ''), {})
+    except KeyError as e:
+        raise ConfigError(f'Missing kubeconfig entry for context {context_name!r}: {e}') from e
+
+    for plugin in ('exec', 'auth-provider'):
+        if plugin in user:
+            raise UnsupportedConfig(f'The kubeconfig user uses an {plugin!r} plugin')
+
+    headers = {}
+    if user.get('token'):
+        headers['Authorization'] = f"Bearer {user['token']}"
+    elif user.get('username'):
+        credentials = f"{user['username']}:{user.get('password', '')}".encode()
+        headers['Authorization'] = f'Basic {base64.b64encode(credentials).decode()}'
+    token_file = user.get('tokenFile')
+
+    server = cluster['server']
+    ssl_context = None
+    if urlsplit(server).scheme == 'https':
+        if cluster.get('insecure-skip-tls-verify'):
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        else:
+            ssl_context = ssl.create_default_context(
+                cafile=resolve(cluster, 'certificate-authority'),
+                cadata=decode(cluster, 'certificate-authority-data'),
+            )
+        certificate = read_file_or_data(user, 'client-certificate')
+        key = read_file_or_data(user, 'client-key')
+        if certificate is not None and key is not None:
+            load_cert_chain(ssl_context, certificate, key)
+
+    return ClusterConfig(
+        server=server.rstrip('/'),
+        ssl_context=ssl_context,
+        token_file=Path(user['_directory'], token_file) if token_file else None,
+        headers=headers,
+    )
+
+
+def load_incluster_config(environ=os.environ) -> ClusterConfig:
+    """Load the API server address from the environment and the service account's credentials."""
+    host = environ['KUBERNETES_SERVICE_HOST']
+    port = environ.get('KUBERNETES_SERVICE_PORT', '443')
+    if ':' in host:
+        host = f'[{host}]'
+    return ClusterConfig(
+        server=f'https://{host}:{port}',
+        ssl_context=ssl.create_default_context(cafile=str(SERVICE_ACCOUNT_DIR / 'ca.crt')),
+        token_file=SERVICE_ACCOUNT_DIR / 'token',
+        headers={},
+    )
+
+
+def resolve(entry: dict, key: str) -> Optional[str]:
+    """Return the path the entry has under the key, relative to its kubeconfig, if it has one."""
+    if not entry.get(key):
+        return None
+    return str(Path(entry['_directory'], entry[key]).expanduser())
+
+
+def decode(entry: dict, key: str) -> Optional[str]:
+    """Return the base64-encoded PEM the entry has under the key, if it has one."""
+    if not entry.get(key):
+        return None
+    return base64.b64decode(entry[key]).decode()
+
+
+def read_file_or_data(entry: dict, key: str) -> Optional[bytes]:
+    """Return the contents of `<key>-data` or the file at `<key>`."""
+    data = decode(entry, f'{key}-data')
+    if data is not None:
+        return data.encode()
+    path = resolve(entry, key)
+    return Path(path).read_bytes() if path is not None else None
+
+
+def load_cert_chain(ssl_context: ssl.SSLContext, certificate: bytes, key: bytes):
+    """Load the client certificate and key, which the ssl module only reads from files."""
+    with tempfile.TemporaryDirectory(prefix='kube-event-pipe-') as directory:
+        certificate_path = Path(directory, 'client.crt')
+        key_path = Path(directory, 'client.key')
+        certificate_path.write_bytes(certificate)
+        key_path.write_bytes(key)
+        ssl_context.load_cert_chain(str(certificate_path), str(key_path))
+
+
+class Response:
+    """A streamed response, read like the urllib3 responses of the kubernetes client."""
+
+    def __init__(self, response: HTTPResponse, connection: HTTPConnection):
+        """Wrap the response, read from the connection."""
+        self.response = response
+        self.connection = connection
+
+    @property
+    def data(self) -> bytes:
+        """Read the whole body."""
+        return self.response.read()
+
+    def read_chunked(self, decode_content: bool = False) -> Iterator[bytes]:
+        """Return the body as it's received, with the chunked transfer encoding decoded."""
+        while True:
+            data = self.response.read1(READ_SIZE)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        """Close the response, and the connection unless the response was read to the end."""
+        if not self.response.isclosed():
+            self.connection.close()
+        self.response.close()
+
+    def release_conn(self):
+        """Do nothing, the connection is reused by the client."""
+
+
+class KubeClient:
+    """Watches events over a single keep-alive connection to the API server."""
+
+    config: ClusterConfig
+    connection: Optional[HTTPConnection]
+
+    def __init__(self, config: ClusterConfig):
+        """Set up the client, connecting on the first request."""
+        self.config = config
+        self.connection = None
+
+    @classmethod
+    def from_environment(cls, context: Optional[str] = None) -> 'KubeClient':
+        """
+        Create a client from kubeconfig, of the given or current context, or in-cluster config.
+
+        :raise: ConfigError
+        """
+        return cls(load_config(context=context))
+
+    def connect(self) -> HTTPConnection:
+        """Return the open connection, or a new one."""
+        if self.connection is None:
+            url = urlsplit(self.config.server)
+            if url.scheme == 'https':
+                self.connection = HTTPSConnection(url.netloc, context=self.config.ssl_context)
+            else:
+                self.connection = HTTPConnection(url.netloc)
+        return self.connection
+
+    def request_headers(self) -> Dict[str, str]:
+        """Return headers with the current credentials."""
+        headers = {'Accept': 'application/json', **self.config.headers}
+        if self.config.token_file is not None:
+            headers['Authorization'] = f'Bearer {self.config.token_file.read_text().strip()}'
+        return headers
+
+    def list_event_for_all_namespaces(
+        self,
+        watch: bool = False,
+        resource_version: Optional[str] = None,
+        allow_watch_bookmarks: bool = False,
+        field_selector: Optional[str] = None,
+        label_selector: Optional[str] = None,
+        limit: Optional[int] = None,
+        _continue: Optional[str] = None,
+        _preload_content: bool = True,
+    ) -> Response:
+        """
+        List or watch events from all namespaces, like CoreV1Api does with `_preload_content=False`.
+
+        The kubernetes client's models aren't supported, so `_preload_content` must be false.
+
+        :raise: ApiError
+        :raise: ValueError, if `_preload_content` is true.
+        """
+        if _preload_content:
+            raise ValueError('Only _preload_content=False is supported')
+        query = {
+            'watch': 'true' if watch else None,
+            'resourceVersion': resource_version,
+            'allowWatchBookmarks': 'true' if allow_watch_bookmarks else None,
+            'fieldSelector': field_selector,
+            'labelSelector': label_selector,
+            'limit': limit,
+            'continue': _continue,
+        }
+        query = {key: value for key, value in query.items() if value is not None}
+        path = f'{urlsplit(self.config.server).path}{EVENTS_PATH}?{urlencode(query)}'
+
+        connection = self.connect()
+        try:
+            connection.request('GET', path, headers=self.request_headers())
+            response = connection.getresponse()
+        except (OSError, HTTPException):
+            # The server may have closed the idle connection, so retry once on a new one.
+            self.close()
+            connection = self.connect()
+            connection.request('GET', path, headers=self.request_headers())
+            response = connection.getresponse()
+
+        if response.status != 200:
+            body = response.read()
+            try:
+                reason = json.loads(body)['message']
+            except (ValueError, KeyError, TypeError):
+                reason = response.reason
+            raise ApiError(response.status, reason, dict(response.getheaders()))
+        return Response(response, connection)
+
+    def interrupt(self):
+        """
+        Shut down the connection from another thread, ending a response being read from it.
+
+        The socket is shut down rather than closed, which doesn't wake up a blocked read, and
+        without TLS close_notify, which would race the reading thread.
+        """
+        connection = self.connection
+        sock = connection.sock if connection is not None else None
+        if sock is None:
+            return
+        try:
+            socket.socket.shutdown(sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """Close the connection."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
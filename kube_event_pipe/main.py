@@ -1,173 +1,615 @@
 """Entry point."""
 import logging
-import json
 import sys
 import signal
-import errno
+import threading
 from os import environ
-from typing import TypeVar, Callable, Union, IO
+from typing import (
+    TypeVar, Callable, Dict, Iterator, Union, Sequence, NamedTuple, Optional, IO, cast,
+)
 from datetime import timedelta
+from functools import partial
+from importlib import import_module
 from pathlib import Path
-from kube_event_pipe.batched_bloom_filter import BatchedBloomFilter  # type: ignore
-from kubernetes import client, config, watch  # type: ignore
+from multiprocessing import Queue
+from kube_event_pipe import memory, metrics
+from kube_event_pipe.batched_bloom_filter import (  # type: ignore
+    BatchedBloomFilter, SATURATION_POLICIES, SATURATION_IGNORE, SATURATION_GROW,
+)
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.clusters import (
+    ClusterDestination, ClusterSupervisor, call_when_set, cluster_persistence_path, parse_contexts,
+)
+from kube_event_pipe.coalescing import Coalescer
+from kube_event_pipe.cuckoo_filter import SlidingCuckooFilter, cuckoo_filter_capacity
+from kube_event_pipe.destination import Destination, FSYNC_POLICIES, FSYNC_NEVER, FSYNC_GROUP
+from kube_event_pipe.filtering import EventFilter, parse_names
+from kube_event_pipe.identity import (
+    IDENTITIES, IDENTITY_NAME_COUNT, check_identity_strategy, make_identity,
+)
+from kube_event_pipe.kube_client import KubeClient, ConfigError
+from kube_event_pipe.pipeline import Deduplicator, AsyncPipeline, EventsSeen, run_pipeline
+from kube_event_pipe.profiling import profile_on_signals
+from kube_event_pipe.ring_bloom_filter import RingBloomFilter
+from kube_event_pipe.shedding import LoadShedder
+from kube_event_pipe.sharding import (
+    ShardAssignment, ShardCheckpoint, ShardSupervisor, MergedOutput, parse_shard_namespaces,
+    receive_events, shard_destination_path, shard_persistence_path,
+    SHARD_OUTPUTS, SHARD_OUTPUT_MERGED, SHARD_OUTPUT_SEPARATE,
+)
+from kube_event_pipe.source import WatchedEvent, watch_events
 
 DEFAULT_DESTINATION = '-'
 DEFAULT_LOG_LEVEL = 'INFO'
 DEFAULT_PERSISTENCE_PATH = '.'
+FILTER_ENGINE_BATCHED = 'batched'
+FILTER_ENGINE_RING = 'ring'
+FILTER_ENGINE_CUCKOO = 'cuckoo'
+FILTER_ENGINES = (FILTER_ENGINE_BATCHED, FILTER_ENGINE_RING, FILTER_ENGINE_CUCKOO)
+WATCH_CLIENT_KUBERNETES = 'kubernetes'
+WATCH_CLIENT_BUILTIN = 'builtin'
+WATCH_CLIENTS = (WATCH_CLIENT_KUBERNETES, WATCH_CLIENT_BUILTIN)
+# Commands other than watching, each a module with a `main(argv)` function.
+COMMANDS = ('replay', 'state')
+
 DEFAULT_CAPACITY = '1_000_000'
 DEFAULT_ERROR_RATE = '0.01'
+DEFAULT_MEMORY_BUDGET = '0'
 DEFAULT_BATCH_COUNT = '3'
 DEFAULT_BATCH_DURATION = str(int(timedelta(hours=1).total_seconds()))
+DEFAULT_FILTER_ENGINE = FILTER_ENGINE_BATCHED
+DEFAULT_FILTER_SATURATION = SATURATION_IGNORE
+DEFAULT_RECENT_CACHE_SIZE = '0'
+DEFAULT_IDENTITY = IDENTITY_NAME_COUNT
+DEFAULT_CHECKPOINT_INTERVAL = '5'
+DEFAULT_RAW_JSON = 'false'
+DEFAULT_WATCH_CLIENT = WATCH_CLIENT_KUBERNETES
+DEFAULT_CONTEXTS = ''
+DEFAULT_FIELD_SELECTOR = ''
+DEFAULT_LABEL_SELECTOR = ''
+DEFAULT_INCLUDE_NAMESPACES = ''
+DEFAULT_EXCLUDE_NAMESPACES = ''
+DEFAULT_INCLUDE_REASONS = ''
+DEFAULT_EXCLUDE_REASONS = ''
+DEFAULT_COALESCE_WINDOW = '0'
+DEFAULT_SHED_LAG = '0'
+DEFAULT_SHED_REASONS = ''
+DEFAULT_SHED_SAMPLE = '10'
+DEFAULT_FLUSH_INTERVAL = '1'
+DEFAULT_FLUSH_MAX_BYTES = str(1024 * 1024)
+DEFAULT_FLUSH_MAX_EVENTS = '1000'
+DEFAULT_FSYNC = FSYNC_NEVER
+DEFAULT_FSYNC_INTERVAL = '1'
+DEFAULT_ASYNC_PIPELINE = 'false'
+DEFAULT_QUEUE_SIZE = '10000'
+DEFAULT_QUEUE_LOG_INTERVAL = '10'
+DEFAULT_SHARDS = '1'
+DEFAULT_SHARD_NAMESPACES = ''
+DEFAULT_SHARD_OUTPUT = SHARD_OUTPUT_MERGED
+DEFAULT_METRICS_PORT = '0'
 
 ENV_DESTINATION = 'KUBE_EVENT_PIPE_DESTINATION'
 ENV_LOG_LEVEL = 'KUBE_EVENT_PIPE_LOG_LEVEL'
 ENV_PERSISTENCE_PATH = 'KUBE_EVENT_PIPE_PERSISTENCE_PATH'
 ENV_FILTER_CAPACITY = 'KUBE_EVENT_PIPE_FILTER_CAPACITY'
 ENV_FILTER_ERROR_RATE = 'KUBE_EVENT_PIPE_FILTER_ERROR_RATE'
+ENV_MEMORY_BUDGET = 'KUBE_EVENT_PIPE_MEMORY_BUDGET'
 ENV_BATCH_COUNT = 'KUBE_EVENT_PIPE_BATCH_COUNT'
 ENV_BATCH_DURATION_SEC = 'KUBE_EVENT_PIPE_BATCH_DURATION_SEC'
+ENV_FILTER_ENGINE = 'KUBE_EVENT_PIPE_FILTER_ENGINE'
+ENV_FILTER_SATURATION = 'KUBE_EVENT_PIPE_FILTER_SATURATION'
+ENV_RECENT_CACHE_SIZE = 'KUBE_EVENT_PIPE_RECENT_CACHE_SIZE'
+ENV_IDENTITY = 'KUBE_EVENT_PIPE_IDENTITY'
+ENV_CHECKPOINT_INTERVAL_SEC = 'KUBE_EVENT_PIPE_CHECKPOINT_INTERVAL_SEC'
+ENV_RAW_JSON = 'KUBE_EVENT_PIPE_RAW_JSON'
+ENV_WATCH_CLIENT = 'KUBE_EVENT_PIPE_WATCH_CLIENT'
+ENV_CONTEXTS = 'KUBE_EVENT_PIPE_CONTEXTS'
+ENV_FIELD_SELECTOR = 'KUBE_EVENT_PIPE_FIELD_SELECTOR'
+ENV_LABEL_SELECTOR = 'KUBE_EVENT_PIPE_LABEL_SELECTOR'
+ENV_INCLUDE_NAMESPACES = 'KUBE_EVENT_PIPE_INCLUDE_NAMESPACES'
+ENV_EXCLUDE_NAMESPACES = 'KUBE_EVENT_PIPE_EXCLUDE_NAMESPACES'
+ENV_INCLUDE_REASONS = 'KUBE_EVENT_PIPE_INCLUDE_REASONS'
+ENV_EXCLUDE_REASONS = 'KUBE_EVENT_PIPE_EXCLUDE_REASONS'
+ENV_COALESCE_WINDOW_SEC = 'KUBE_EVENT_PIPE_COALESCE_WINDOW_SEC'
+ENV_SHED_LAG_SEC = 'KUBE_EVENT_PIPE_SHED_LAG_SEC'
+ENV_SHED_REASONS = 'KUBE_EVENT_PIPE_SHED_REASONS'
+ENV_SHED_SAMPLE = 'KUBE_EVENT_PIPE_SHED_SAMPLE'
+ENV_FLUSH_INTERVAL_SEC = 'KUBE_EVENT_PIPE_FLUSH_INTERVAL_SEC'
+ENV_FLUSH_MAX_BYTES = 'KUBE_EVENT_PIPE_FLUSH_MAX_BYTES'
+ENV_FLUSH_MAX_EVENTS = 'KUBE_EVENT_PIPE_FLUSH_MAX_EVENTS'
+ENV_FSYNC = 'KUBE_EVENT_PIPE_FSYNC'
+ENV_FSYNC_INTERVAL_SEC = 'KUBE_EVENT_PIPE_FSYNC_INTERVAL_SEC'
+ENV_ASYNC_PIPELINE = 'KUBE_EVENT_PIPE_ASYNC_PIPELINE'
+ENV_QUEUE_SIZE = 'KUBE_EVENT_PIPE_QUEUE_SIZE'
+ENV_QUEUE_LOG_INTERVAL_SEC = 'KUBE_EVENT_PIPE_QUEUE_LOG_INTERVAL_SEC'
+ENV_SHARDS = 'KUBE_EVENT_PIPE_SHARDS'
+ENV_SHARD_NAMESPACES = 'KUBE_EVENT_PIPE_SHARD_NAMESPACES'
+ENV_SHARD_OUTPUT = 'KUBE_EVENT_PIPE_SHARD_OUTPUT'
+ENV_METRICS_PORT = 'KUBE_EVENT_PIPE_METRICS_PORT'
 
 log = logging.getLogger(__name__)
 
 
+class Settings(NamedTuple):
+    """Configuration, read from the environment."""
+
+    destination_path: Path
+    log_level: str
+    persistence_path: Path
+    filter_capacity: int
+    filter_error_rate: float
+    memory_budget: int
+    batch_count: int
+    batch_duration_sec: int
+    filter_engine: str
+    filter_saturation: str
+    recent_cache_size: int
+    identity: str
+    checkpoint_interval_sec: float
+    raw_json: bool
+    watch_client: str
+    contexts: str
+    field_selector: str
+    label_selector: str
+    include_namespaces: str
+    exclude_namespaces: str
+    include_reasons: str
+    exclude_reasons: str
+    coalesce_window_sec: float
+    shed_lag_sec: float
+    shed_reasons: str
+    shed_sample: int
+    flush_interval_sec: float
+    flush_max_bytes: int
+    flush_max_events: int
+    fsync_policy: str
+    fsync_interval_sec: float
+    async_pipeline: bool
+    queue_size: int
+    queue_log_interval_sec: float
+    shards: int
+    shard_namespaces: str
+    shard_output: str
+    metrics_port: int
+
+
 def signal_to_system_exit(signum, frame):
     """Raise SystemExit."""
     sys.stderr.write(f'Caught signal {signum}. Exiting.\n')
     sys.exit(0)
 
 
-def open_destination(destination_path: Path) -> IO:
-    """Open a normal file for appending and a pipe for writing."""
-    try:
-        destination_file = destination_path.open('a')
-    except OSError as e:
-        if e.errno != errno.ESPIPE:
-            raise
-        destination_file = destination_path.open('w')
-    return destination_file
-
-
-def pipe_events(
-    destination_path: Path,
-    persistence_path: Path,
-    filter_capacity: int,
-    filter_error_rate: float,
-    batch_count: int,
-    batch_duration_sec: int,
-):
-    """List and watch, deduplicate, and write events to stdout."""
-    events_seen: BatchedBloomFilter[str] = BatchedBloomFilter(
-        directory=persistence_path,
-        filter_capacity=filter_capacity,
-        filter_error_rate=filter_error_rate,
-        batch_count=batch_count,
-        batch_duration_sec=batch_duration_sec,
+def open_settings_destination(settings: Settings, destination_path: Path, **kwargs) -> Destination:
+    """Open the destination, buffered as configured."""
+    return Destination(
+        destination_path,
+        flush_interval_sec=settings.flush_interval_sec,
+        max_buffered_bytes=settings.flush_max_bytes,
+        max_buffered_events=settings.flush_max_events,
+        fsync_policy=settings.fsync_policy,
+        fsync_interval_sec=settings.fsync_interval_sec,
+        **kwargs,
     )
 
-    destination_file = open_destination(destination_path)
-    reopen_file = False
 
+def reopen_on_sighup(destination: Destination):
+    """Reopen the destination file on SIGHUP, to support external log rotation."""
     def reopen(signum, frame):
         sys.stderr.write(
-            f'Caught SIGHUP. Will close and reopen {destination_path} on the next event.\n')
-        nonlocal reopen_file
-        reopen_file = True
+            f'Caught SIGHUP. Will close and reopen {destination.path} on the next event.\n')
+        destination.request_reopen()
 
     signal.signal(signal.SIGHUP, reopen)
 
-    kube_api = client.CoreV1Api()
-    watcher = watch.Watch()
-    events = watcher.stream(kube_api.list_event_for_all_namespaces)
+
+def budget_filter_capacity(settings: Settings) -> int:
+    """
+    Return the capacity of each filter generation, for filters of all shards to fit in budget.
+
+    With many clusters, filters of all of them fit in the budget. The batched engine also keeps
+    the filter of the next batch, prepared ahead of rotations, so it counts as a generation.
+    """
+    clusters = len(parse_contexts(settings.contexts)) or 1
+    generations = settings.batch_count
+    if settings.filter_engine == FILTER_ENGINE_BATCHED:
+        generations += 1
+    generation_bytes = settings.memory_budget // settings.shards // clusters // generations
+    if settings.filter_engine == FILTER_ENGINE_CUCKOO:
+        return cuckoo_filter_capacity(generation_bytes, settings.filter_error_rate)
+    return memory.bloom_filter_capacity(generation_bytes, settings.filter_error_rate)
+
+
+def open_events_seen(persistence_path: Path, settings: Settings) -> EventsSeen:
+    """Open the filter of seen events, of the configured engine."""
+    engines: Dict[str, Callable[..., EventsSeen]] = {
+        FILTER_ENGINE_BATCHED: partial(
+            BatchedBloomFilter[bytes], saturation_policy=settings.filter_saturation),
+        FILTER_ENGINE_RING: RingBloomFilter,
+        FILTER_ENGINE_CUCKOO: SlidingCuckooFilter,
+    }
+    return engines[settings.filter_engine](
+        directory=persistence_path,
+        filter_capacity=settings.filter_capacity,
+        filter_error_rate=settings.filter_error_rate,
+        batch_count=settings.batch_count,
+        batch_duration_sec=settings.batch_duration_sec,
+    )
+
+
+def make_event_filter(settings: Settings) -> EventFilter:
+    """Make the filter of events by namespace and reason, and with selectors, as configured."""
+    return EventFilter(
+        include_namespaces=parse_names(settings.include_namespaces),
+        exclude_namespaces=parse_names(settings.exclude_namespaces),
+        include_reasons=parse_names(settings.include_reasons),
+        exclude_reasons=parse_names(settings.exclude_reasons),
+        field_selector=settings.field_selector,
+        label_selector=settings.label_selector,
+    )
+
+
+def watch_settings_events(
+    kube_api,
+    checkpoint: ResourceVersionCheckpoint,
+    settings: Settings,
+    stop: Optional[threading.Event] = None,
+    parse: bool = True,
+) -> Iterator[WatchedEvent]:
+    """
+    Watch events with the configured selectors, resuming from the checkpoint, until stopped.
+
+    If `parse` is false, events are watched raw, and only peeked at, see `peek_event`.
+    """
+    event_filter = make_event_filter(settings)
+    log.info('Watching events with field selector %r, label selector %r',
+             event_filter.field_selector, event_filter.label_selector)
+    # The built-in client doesn't deserialize events into models.
+    raw = settings.raw_json or isinstance(kube_api, KubeClient) or not parse
+    return watch_events(
+        kube_api, checkpoint, raw=raw,
+        field_selector=event_filter.field_selector, label_selector=event_filter.label_selector,
+        stop=stop, parse=parse)
+
+
+def pipe_events(
+    kube_api,
+    destination: Destination,
+    persistence_path: Path,
+    settings: Settings,
+    cluster: Optional[str] = None,
+    checkpoint: Optional[ResourceVersionCheckpoint] = None,
+    events: Optional[Iterator[WatchedEvent]] = None,
+    stop: Optional[threading.Event] = None,
+):
+    """
+    List and watch, deduplicate, and write events to the destination, until interrupted.
+
+    `cluster` names the cluster in metrics, if it's one of many. The watch ends once `stop` is set.
+    If `events` are given, e.g. by a
+    shard supervisor, they are piped instead of the watch, and processed resourceVersions are
+    recorded in `checkpoint`. Errors, e.g. of the watch, are raised once events received so far
+    are written out and filters are closed.
+    """
+    event_filter = make_event_filter(settings)
+    # Checked before filters are created, to tell if they were written with string identities.
+    legacy_until = check_identity_strategy(
+        persistence_path, settings.identity, settings.batch_count * settings.batch_duration_sec)
+    events_seen = open_events_seen(persistence_path, settings)
+    if isinstance(events_seen, BatchedBloomFilter):
+        metrics.collect_filter_stats(events_seen.filter_stats, cluster)
+    metrics.collect_filter_residency(lambda: memory.resident_bytes(events_seen.paths()), cluster)
+    log.info('Filter bytes resident in memory: %s', memory.resident_bytes(events_seen.paths()))
+
+    if checkpoint is None:
+        # Saving a resourceVersion implies all events up to it have been written out.
+        checkpoint = ResourceVersionCheckpoint(
+            persistence_path, settings.checkpoint_interval_sec, before_save=destination.flush)
+
+    shed = LoadShedder(
+        settings.shed_lag_sec, parse_names(settings.shed_reasons), settings.shed_sample,
+    ) if settings.shed_lag_sec else None
+    coalesce = Coalescer(settings.coalesce_window_sec) if settings.coalesce_window_sec else None
+    deduplicate = Deduplicator(
+        events_seen,
+        accept=event_filter.accept,
+        recent_cache_size=settings.recent_cache_size,
+        identity=make_identity(settings.identity),
+        legacy_until=legacy_until,
+        group_commit=destination.fsync_policy == FSYNC_GROUP,
+        shed=shed,
+        hold=coalesce.hold if coalesce is not None else None,
+    )
+    if deduplicate.group_commit:
+        # Events are only marked as seen once they have been written and synced.
+        destination.on_sync = deduplicate.commit
+    if coalesce is not None:
+        # Held events are only marked as seen once their summary is written.
+        coalesce.on_release = deduplicate.release
+    if events is None:
+        events = watch_settings_events(kube_api, checkpoint, settings, stop)
     try:
-        skipped = 0
         log.info('Watching events...')
-        for event in events:
-            # Support for log rotation.
-            if reopen_file:
-                log.info('Log rotation. Reopening file: %s.', destination_path)
-                destination_file.close()
-                destination_file = open_destination(destination_path)
-                reopen_file = False
-
-            event_obj = event['object']
-            # We pass a string as event identity because otherwise standard Python's `hash` function
-            # is used, rather than a dedicated hash functions.
-            event_identity = f'{event_obj.metadata.name}-{event_obj.count}'
-
-            if event_identity in events_seen:
-                skipped += 1
-                log.debug('Skipped repeated event: %s: %r', event_identity, event_obj.message)
-                continue
-            else:
-                if skipped > 0:
-                    log.info('New event seen, after skipping %s previously seen events', skipped)
-                skipped = 0
-                log.debug('Logging event: %s: %r', event_identity, event_obj.message)
-
-            event_data = event['raw_object']
-            events_seen.add(event_identity)
-            json.dump(event_data, destination_file)
-            destination_file.write('\n')
-            destination_file.flush()
+        if settings.async_pipeline:
+            AsyncPipeline(
+                deduplicate, destination, checkpoint,
+                queue_size=settings.queue_size,
+                log_interval_sec=settings.queue_log_interval_sec,
+                coalesce=coalesce,
+            ).run(events)
+        else:
+            run_pipeline(events, deduplicate, destination, checkpoint, coalesce)
     except (SystemExit, KeyboardInterrupt):
         log.info('Terminating')
-        events_seen.close()
-        return
+    finally:
+        # Also when the watch fails, events already marked as seen are written out.
+        try:
+            if coalesce is not None:
+                for data, occurred_at, event_count in coalesce.drain():
+                    destination.write(data, occurred_at, event_count)
+                # No longer held back by held events.
+                if coalesce.resource_version is not None:
+                    checkpoint.update(coalesce.resource_version)
+            if shed is not None:
+                shed.log_summary()
+            # The checkpoint isn't saved if events up to it can't be written out.
+            destination.flush()
+            checkpoint.save()
+        finally:
+            try:
+                destination.close()
+            finally:
+                events_seen.close()
+
+
+def run_shard(settings: Settings, shard: int, input_queue: Queue, output_queue: Queue):
+    """Run a shard worker process, piping the events the supervisor routes to the shard."""
+    logging.basicConfig(level=settings.log_level, format=f'shard-{shard}:%(message)s')
+    signal.signal(signal.SIGTERM, signal_to_system_exit)
+    signal.signal(signal.SIGQUIT, signal_to_system_exit)
+
+    if settings.shard_output == SHARD_OUTPUT_MERGED:
+        # The supervisor flushes and syncs the destination.
+        destination = open_settings_destination(
+            settings._replace(fsync_policy=FSYNC_NEVER),
+            settings.destination_path,
+            open_file=lambda path: cast(IO[bytes], MergedOutput(output_queue)),
+        )
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    else:
+        destination = open_settings_destination(
+            settings, shard_destination_path(settings.destination_path, shard))
+        reopen_on_sighup(destination)
+    profile_on_signals(shard_persistence_path(settings.persistence_path, shard))
+
+    if settings.metrics_port:
+        metrics.serve_metrics(settings.metrics_port + shard)
+
+    persistence_path = shard_persistence_path(settings.persistence_path, shard)
+    checkpoint = ShardCheckpoint(
+        persistence_path, settings.checkpoint_interval_sec, shard, output_queue,
+        before_save=destination.flush)
+    pipe_events(
+        None,
+        destination,
+        persistence_path,
+        settings,
+        checkpoint=checkpoint,
+        events=receive_events(input_queue, checkpoint),
+    )
+
+
+def run_cluster(
+    settings: Settings, destination: Destination, context: str, stopping: threading.Event,
+):
+    """Run a watcher thread, writing events of the context's cluster to the shared destination."""
+    kube_api = connect_kube_api(settings, context)
+    if isinstance(kube_api, KubeClient):
+        # Ends a watch blocked reading from the API server, so it stops right away.
+        call_when_set(stopping, kube_api.interrupt)
+    pipe_events(
+        kube_api,
+        cast(Destination, ClusterDestination(destination, context)),
+        cluster_persistence_path(settings.persistence_path, context),
+        settings,
+        cluster=context,
+        stop=stopping,
+    )
 
 
 Num = TypeVar('Num', bound=Union[int, float])
 
 
-def env_get_positive_number(key: str, default: str, constructor: Callable[[str], Num]) -> Num:
+def env_get_positive_number(
+    key: str, default: str, constructor: Callable[[str], Num], allow_zero: bool = False,
+) -> Num:
     """Parse the named environment variable as the given number type."""
     val = None
     try:
         val = constructor(environ.get(key, default))
-        if val <= 0:
+        if val < 0 or (val == 0 and not allow_zero):
             raise ValueError
     except ValueError:
-        log.error('Environment variable %r must be a positive %s, is %r', key, constructor, val)
+        log.error('Environment variable %r must be a %s %s, is %r',
+                  key, 'non-negative' if allow_zero else 'positive', constructor, val)
         exit(1)
     return val
 
 
-def main():
-    """Run kube-event-pipe."""
-    log_level = environ.get('KUBE_EVENT_PIPE_LOG_LEVEL', DEFAULT_LOG_LEVEL).upper()
-    logging.basicConfig(level=log_level)
+def env_get_bool(key: str, default: str) -> bool:
+    """Parse the named environment variable as a boolean flag."""
+    val = environ.get(key, default).lower()
+    if val in ('1', 'true', 'yes'):
+        return True
+    if val in ('0', 'false', 'no'):
+        return False
+    log.error('Environment variable %r must be true or false, is %r', key, val)
+    exit(1)
+
+
+def env_get_choice(key: str, default: str, choices: Sequence[str]) -> str:
+    """Parse the named environment variable as one of the choices."""
+    val = environ.get(key, default).lower()
+    if val not in choices:
+        log.error('Environment variable %r must be one of %s, is %r', key, choices, val)
+        exit(1)
+    return val
 
-    signal.signal(signal.SIGTERM, signal_to_system_exit)
-    signal.signal(signal.SIGQUIT, signal_to_system_exit)
 
+def read_settings() -> Settings:
+    """Read and log the configuration."""
     destination = environ.get(ENV_DESTINATION, DEFAULT_DESTINATION)
-    persistence_path = Path(environ.get(ENV_PERSISTENCE_PATH, DEFAULT_PERSISTENCE_PATH)).resolve()
-    filter_capacity = env_get_positive_number(
-        ENV_FILTER_CAPACITY, DEFAULT_CAPACITY, constructor=int)
-    filter_error_rate = env_get_positive_number(
-        ENV_FILTER_ERROR_RATE, DEFAULT_ERROR_RATE, constructor=float)
-    batch_count = env_get_positive_number(
-        ENV_BATCH_COUNT, DEFAULT_BATCH_COUNT, constructor=int)
-    batch_duration_sec = env_get_positive_number(
-        ENV_BATCH_DURATION_SEC, DEFAULT_BATCH_DURATION, constructor=int)
-
-    log.info(
-        'kube-event-pipe configuration: '
-        '%s: %s, '
-        '%s: %s, '
-        '%s: %s, '
-        '%s: %s, '
-        '%s: %s, '
-        '%s: %s, '
-        '%s: %s',
-        ENV_DESTINATION, destination,
-        ENV_LOG_LEVEL, log_level,
-        ENV_PERSISTENCE_PATH, persistence_path,
-        ENV_FILTER_CAPACITY, filter_capacity,
-        ENV_FILTER_ERROR_RATE, filter_error_rate,
-        ENV_BATCH_COUNT, batch_count,
-        ENV_BATCH_DURATION_SEC, batch_duration_sec,
+    if destination == '-':
+        destination = '/dev/stdout'
+
+    settings = Settings(
+        destination_path=Path(destination),
+        log_level=environ.get(ENV_LOG_LEVEL, DEFAULT_LOG_LEVEL).upper(),
+        persistence_path=Path(
+            environ.get(ENV_PERSISTENCE_PATH, DEFAULT_PERSISTENCE_PATH)).resolve(),
+        filter_capacity=env_get_positive_number(
+            ENV_FILTER_CAPACITY, DEFAULT_CAPACITY, constructor=int),
+        filter_error_rate=env_get_positive_number(
+            ENV_FILTER_ERROR_RATE, DEFAULT_ERROR_RATE, constructor=float),
+        memory_budget=env_get_positive_number(
+            ENV_MEMORY_BUDGET, DEFAULT_MEMORY_BUDGET, constructor=int, allow_zero=True),
+        batch_count=env_get_positive_number(
+            ENV_BATCH_COUNT, DEFAULT_BATCH_COUNT, constructor=int),
+        batch_duration_sec=env_get_positive_number(
+            ENV_BATCH_DURATION_SEC, DEFAULT_BATCH_DURATION, constructor=int),
+        filter_engine=env_get_choice(ENV_FILTER_ENGINE, DEFAULT_FILTER_ENGINE, FILTER_ENGINES),
+        filter_saturation=env_get_choice(
+            ENV_FILTER_SATURATION, DEFAULT_FILTER_SATURATION, SATURATION_POLICIES),
+        recent_cache_size=env_get_positive_number(
+            ENV_RECENT_CACHE_SIZE, DEFAULT_RECENT_CACHE_SIZE, constructor=int, allow_zero=True),
+        identity=env_get_choice(ENV_IDENTITY, DEFAULT_IDENTITY, IDENTITIES),
+        checkpoint_interval_sec=env_get_positive_number(
+            ENV_CHECKPOINT_INTERVAL_SEC, DEFAULT_CHECKPOINT_INTERVAL, constructor=float),
+        raw_json=env_get_bool(ENV_RAW_JSON, DEFAULT_RAW_JSON),
+        watch_client=env_get_choice(ENV_WATCH_CLIENT, DEFAULT_WATCH_CLIENT, WATCH_CLIENTS),
+        contexts=environ.get(ENV_CONTEXTS, DEFAULT_CONTEXTS),
+        field_selector=environ.get(ENV_FIELD_SELECTOR, DEFAULT_FIELD_SELECTOR),
+        label_selector=environ.get(ENV_LABEL_SELECTOR, DEFAULT_LABEL_SELECTOR),
+        include_namespaces=environ.get(ENV_INCLUDE_NAMESPACES, DEFAULT_INCLUDE_NAMESPACES),
+        exclude_namespaces=environ.get(ENV_EXCLUDE_NAMESPACES, DEFAULT_EXCLUDE_NAMESPACES),
+        include_reasons=environ.get(ENV_INCLUDE_REASONS, DEFAULT_INCLUDE_REASONS),
+        exclude_reasons=environ.get(ENV_EXCLUDE_REASONS, DEFAULT_EXCLUDE_REASONS),
+        coalesce_window_sec=env_get_positive_number(
+            ENV_COALESCE_WINDOW_SEC, DEFAULT_COALESCE_WINDOW, constructor=float, allow_zero=True),
+        shed_lag_sec=env_get_positive_number(
+            ENV_SHED_LAG_SEC, DEFAULT_SHED_LAG, constructor=float, allow_zero=True),
+        shed_reasons=environ.get(ENV_SHED_REASONS, DEFAULT_SHED_REASONS),
+        shed_sample=env_get_positive_number(ENV_SHED_SAMPLE, DEFAULT_SHED_SAMPLE, constructor=int),
+        flush_interval_sec=env_get_positive_number(
+            ENV_FLUSH_INTERVAL_SEC, DEFAULT_FLUSH_INTERVAL, constructor=float),
+        flush_max_bytes=env_get_positive_number(
+            ENV_FLUSH_MAX_BYTES, DEFAULT_FLUSH_MAX_BYTES, constructor=int),
+        flush_max_events=env_get_positive_number(
+            ENV_FLUSH_MAX_EVENTS, DEFAULT_FLUSH_MAX_EVENTS, constructor=int),
+        fsync_policy=env_get_choice(ENV_FSYNC, DEFAULT_FSYNC, FSYNC_POLICIES),
+        fsync_interval_sec=env_get_positive_number(
+            ENV_FSYNC_INTERVAL_SEC, DEFAULT_FSYNC_INTERVAL, constructor=float),
+        async_pipeline=env_get_bool(ENV_ASYNC_PIPELINE, DEFAULT_ASYNC_PIPELINE),
+        queue_size=env_get_positive_number(ENV_QUEUE_SIZE, DEFAULT_QUEUE_SIZE, constructor=int),
+        queue_log_interval_sec=env_get_positive_number(
+            ENV_QUEUE_LOG_INTERVAL_SEC, DEFAULT_QUEUE_LOG_INTERVAL, constructor=float),
+        shards=env_get_positive_number(ENV_SHARDS, DEFAULT_SHARDS, constructor=int),
+        shard_namespaces=environ.get(ENV_SHARD_NAMESPACES, DEFAULT_SHARD_NAMESPACES),
+        shard_output=env_get_choice(ENV_SHARD_OUTPUT, DEFAULT_SHARD_OUTPUT, SHARD_OUTPUTS),
+        metrics_port=env_get_positive_number(
+            ENV_METRICS_PORT, DEFAULT_METRICS_PORT, constructor=int, allow_zero=True),
     )
 
+    if settings.shed_lag_sec and not settings.async_pipeline:
+        log.error('Environment variable %r needs %r, to measure how long events wait',
+                  ENV_SHED_LAG_SEC, ENV_ASYNC_PIPELINE)
+        exit(1)
+
+    if settings.memory_budget:
+        clusters = len(parse_contexts(settings.contexts)) or 1
+        settings = settings._replace(filter_capacity=budget_filter_capacity(settings))
+        if settings.filter_capacity < 1:
+            log.error('Environment variable %r is too low to hold any events in %s filters',
+                      ENV_MEMORY_BUDGET, settings.batch_count * settings.shards * clusters)
+            exit(1)
+        log.info('Filter capacity of %s fits the memory budget of %s bytes',
+                 settings.filter_capacity, settings.memory_budget)
+        if settings.filter_saturation == SATURATION_GROW:
+            log.warning('Filters chained to saturated ones are not counted in the memory budget')
+
+    configuration = [
+        (ENV_DESTINATION, settings.destination_path),
+        (ENV_LOG_LEVEL, settings.log_level),
+        (ENV_PERSISTENCE_PATH, settings.persistence_path),
+        (ENV_FILTER_CAPACITY, settings.filter_capacity),
+        (ENV_FILTER_ERROR_RATE, settings.filter_error_rate),
+        (ENV_MEMORY_BUDGET, settings.memory_budget),
+        (ENV_BATCH_COUNT, settings.batch_count),
+        (ENV_BATCH_DURATION_SEC, settings.batch_duration_sec),
+        (ENV_FILTER_ENGINE, settings.filter_engine),
+        (ENV_FILTER_SATURATION, settings.filter_saturation),
+        (ENV_RECENT_CACHE_SIZE, settings.recent_cache_size),
+        (ENV_IDENTITY, settings.identity),
+        (ENV_CHECKPOINT_INTERVAL_SEC, settings.checkpoint_interval_sec),
+        (ENV_RAW_JSON, settings.raw_json),
+        (ENV_WATCH_CLIENT, settings.watch_client),
+        (ENV_CONTEXTS, settings.contexts),
+        (ENV_FIELD_SELECTOR, settings.field_selector),
+        (ENV_LABEL_SELECTOR, settings.label_selector),
+        (ENV_INCLUDE_NAMESPACES, settings.include_namespaces),
+        (ENV_EXCLUDE_NAMESPACES, settings.exclude_namespaces),
+        (ENV_INCLUDE_REASONS, settings.include_reasons),
+        (ENV_EXCLUDE_REASONS, settings.exclude_reasons),
+        (ENV_COALESCE_WINDOW_SEC, settings.coalesce_window_sec),
+        (ENV_SHED_LAG_SEC, settings.shed_lag_sec),
+        (ENV_SHED_REASONS, settings.shed_reasons),
+        (ENV_SHED_SAMPLE, settings.shed_sample),
+        (ENV_FLUSH_INTERVAL_SEC, settings.flush_interval_sec),
+        (ENV_FLUSH_MAX_BYTES, settings.flush_max_bytes),
+        (ENV_FLUSH_MAX_EVENTS, settings.flush_max_events),
+        (ENV_FSYNC, settings.fsync_policy),
+        (ENV_FSYNC_INTERVAL_SEC, settings.fsync_interval_sec),
+        (ENV_ASYNC_PIPELINE, settings.async_pipeline),
+        (ENV_QUEUE_SIZE, settings.queue_size),
+        (ENV_QUEUE_LOG_INTERVAL_SEC, settings.queue_log_interval_sec),
+        (ENV_SHARDS, settings.shards),
+        (ENV_SHARD_NAMESPACES, settings.shard_namespaces),
+        (ENV_SHARD_OUTPUT, settings.shard_output),
+        (ENV_METRICS_PORT, settings.metrics_port),
+    ]
+    log.info('kube-event-pipe configuration: %s',
+             ', '.join(f'{key}: {value}' for key, value in configuration))
+    return settings
+
+
+def connect_kube_api(settings: Settings, context: Optional[str] = None):
+    """
+    Return the configured client to watch events with, of the kubeconfig context if it's given.
+
+    The kubernetes package is only imported if its client is used, also when the built-in client
+    doesn't support the configuration.
+    """
+    if settings.watch_client == WATCH_CLIENT_BUILTIN:
+        try:
+            kube_client = KubeClient.from_environment(context)
+        except ConfigError as e:
+            log.warning('Falling back to the kubernetes client: %s', e)
+        else:
+            log.info('Watching events from %s with the built-in client', kube_client.config.server)
+            return kube_client
+
+    from kubernetes import client, config  # type: ignore
+    if context is not None:
+        # Not the default configuration, which all clusters would share.
+        api_client = config.new_client_from_config(context=context)
+        log.info('Loaded kubeconfig context %s', context)
+        return client.CoreV1Api(api_client)
+    load_kube_config()
+    return client.CoreV1Api()
+
+
+def load_kube_config():
+    """Load kubeconfig or, failing that, in-cluster config."""
+    from kubernetes import config  # type: ignore
     try:
         config.load_kube_config()
         log.info("Loaded kubeconfig")
@@ -175,15 +617,90 @@ def main():
         config.load_incluster_config()
         log.info("Loaded in-cluster config")
 
-    if destination == '-':
-        destination = '/dev/stdout'
-    destination_path = Path(destination)
 
-    pipe_events(
-        destination_path=destination_path,
-        persistence_path=persistence_path,
-        filter_capacity=filter_capacity,
-        filter_error_rate=filter_error_rate,
-        batch_count=batch_count,
-        batch_duration_sec=batch_duration_sec,
-    )
+def main():
+    """Run kube-event-pipe, or the command given as the first argument."""
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        logging.basicConfig(level=environ.get(ENV_LOG_LEVEL, DEFAULT_LOG_LEVEL).upper())
+        import_module(f'kube_event_pipe.{sys.argv[1]}').main(sys.argv[2:])  # type: ignore
+        return
+
+    log_level = environ.get(ENV_LOG_LEVEL, DEFAULT_LOG_LEVEL).upper()
+    logging.basicConfig(level=log_level)
+
+    signal.signal(signal.SIGTERM, signal_to_system_exit)
+    signal.signal(signal.SIGQUIT, signal_to_system_exit)
+
+    settings = read_settings()
+
+    contexts = parse_contexts(settings.contexts)
+    if contexts:
+        if settings.shards > 1:
+            log.error('%r and %r are mutually exclusive', ENV_CONTEXTS, ENV_SHARDS)
+            exit(1)
+        if len({cluster_persistence_path(settings.persistence_path, c) for c in contexts}) < len(
+                contexts):
+            log.error('Contexts in %r must differ in more than special characters', ENV_CONTEXTS)
+            exit(1)
+        if settings.fsync_policy == FSYNC_GROUP:
+            log.warning('Group commit is not supported with many clusters, fsyncing batches')
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter('%(threadName)s:%(message)s'))
+        if settings.metrics_port:
+            metrics.serve_metrics(settings.metrics_port)
+
+        destination = open_settings_destination(settings, settings.destination_path)
+        reopen_on_sighup(destination)
+        profile_on_signals(settings.persistence_path)
+        try:
+            ClusterSupervisor(partial(run_cluster, settings, destination), contexts).run()
+        finally:
+            destination.close()
+        return
+
+    if settings.shards > 1:
+        try:
+            assignment = ShardAssignment(
+                settings.shards, parse_shard_namespaces(settings.shard_namespaces))
+        except ValueError as e:
+            log.error('Invalid %r: %s', ENV_SHARD_NAMESPACES, e)
+            exit(1)
+        destination_path = settings.destination_path
+        if settings.shard_output == SHARD_OUTPUT_SEPARATE and (
+                destination_path.parent == Path('/dev')
+                or destination_path.exists() and not destination_path.is_file()):
+            # E.g. stdout, next to which per-shard files would be created in /dev.
+            log.error('%r must be %r unless the destination is a regular file, is %s',
+                      ENV_SHARD_OUTPUT, SHARD_OUTPUT_MERGED, destination_path)
+            exit(1)
+        if settings.metrics_port:
+            metrics.serve_metrics(settings.metrics_port + settings.shards)
+
+        kube_api = connect_kube_api(settings)
+        # Passed on to the workers too, by the supervisor.
+        profile_on_signals(settings.persistence_path)
+        merged_destination = None
+        if settings.shard_output == SHARD_OUTPUT_MERGED:
+            merged_destination = open_settings_destination(settings, settings.destination_path)
+        # Saving a resourceVersion implies all workers have written out events up to it.
+        checkpoint = ResourceVersionCheckpoint(
+            settings.persistence_path, settings.checkpoint_interval_sec,
+            before_save=merged_destination.flush if merged_destination is not None else None)
+        try:
+            ShardSupervisor(
+                partial(run_shard, settings), assignment, merged_destination, checkpoint,
+                queue_size=settings.queue_size,
+            ).run(watch_settings_events(kube_api, checkpoint, settings, parse=False))
+        finally:
+            if merged_destination is not None:
+                merged_destination.close()
+        return
+
+    if settings.metrics_port:
+        metrics.serve_metrics(settings.metrics_port)
+
+    kube_api = connect_kube_api(settings)
+    destination = open_settings_destination(settings, settings.destination_path)
+    reopen_on_sighup(destination)
+    profile_on_signals(settings.persistence_path)
+    pipe_events(kube_api, destination, settings.persistence_path, settings)
@@ -0,0 +1,133 @@
+"""Memory of filters: sizing them to a budget, and controlling which of their pages are resident."""
+import os
+import math
+import mmap
+import ctypes
+import ctypes.util
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+PROC_MAPS = Path('/proc/self/maps')
+PROC_SMAPS = Path('/proc/self/smaps')
+MADV_RANDOM: int = getattr(mmap, 'MADV_RANDOM', 1)
+MADV_WILLNEED: int = getattr(mmap, 'MADV_WILLNEED', 3)
+
+# A mapped address range and the offset in the file it starts at.
+Mapping = Tuple[int, int, int]
+
+
+def bloom_filter_capacity(memory_bytes: int, error_rate: float) -> int:
+    """Return the number of elements a bloom filter of the size holds with the error rate."""
+    return int(memory_bytes * 8 * math.log(2) ** 2 / -math.log(error_rate))
+
+
+def mapped_ranges(path: Path) -> List[Mapping]:
+    """Return address ranges the file is mapped at in this process, none if they can't be read."""
+    target = str(path.resolve())
+    ranges = []
+    try:
+        with PROC_MAPS.open() as maps:
+            for line in maps:
+                fields = line.split(maxsplit=5)
+                if len(fields) == 6 and fields[5].rstrip('\n') == target:
+                    start, end = (int(address, 16) for address in fields[0].split('-'))
+                    ranges.append((start, end, int(fields[2], 16)))
+    except OSError:
+        pass
+    return ranges
+
+
+def resident_bytes(paths: Iterable[Path]) -> Dict[str, int]:
+    """Return the number of bytes of each file mapped and resident in memory, by file name."""
+    names = {str(path.resolve()): path.name for path in paths}
+    resident = dict.fromkeys(names.values(), 0)
+    try:
+        with PROC_SMAPS.open() as smaps:
+            name = None
+            for line in smaps:
+                fields = line.split(maxsplit=5)
+                if fields and not fields[0].endswith(':'):
+                    name = names.get(fields[5].rstrip('\n')) if len(fields) == 6 else None
+                elif name is not None and fields[0] == 'Rss:':
+                    resident[name] += int(fields[1]) * 1024
+    except OSError:
+        pass
+    return resident
+
+
+_libc: Optional[ctypes.CDLL] = None
+
+
+def libc() -> ctypes.CDLL:
+    """Load the C library, for madvise and mlock."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+def _page_ranges(path: Path, offset: int, length: Optional[int]) -> List[Tuple[int, int]]:
+    """Return page-aligned addresses and lengths of the part of the file mapped."""
+    ranges = []
+    for start, end, file_offset in mapped_ranges(path):
+        part_start = max(start, start + offset - file_offset)
+        part_end = end if length is None else min(end, start + offset + length - file_offset)
+        part_start -= part_start % mmap.PAGESIZE
+        if part_end > part_start:
+            ranges.append((part_start, part_end - part_start))
+    return ranges
+
+
+def advise(path: Path, advice: int, offset: int = 0, length: Optional[int] = None) -> bool:
+    """Give the kernel advice on using the mapped part of the file, return whether it was taken."""
+    ranges = _page_ranges(path, offset, length)
+    for address, size in ranges:
+        if libc().madvise(ctypes.c_void_p(address), ctypes.c_size_t(size), advice) != 0:
+            log.debug('madvise(%s) of %s failed: %s', advice, path, ctypes.get_errno())
+            return False
+    return bool(ranges)
+
+
+def keep_resident(path: Path, offset: int = 0, length: Optional[int] = None):
+    """
+    Lock the mapped part of the file in memory.
+
+    If it can't be locked, e.g. with a low RLIMIT_MEMLOCK, it's only read in ahead of use.
+    """
+    for address, size in _page_ranges(path, offset, length):
+        if libc().mlock(ctypes.c_void_p(address), ctypes.c_size_t(size)) != 0:
+            log.info('Could not lock %s in memory (errno %s), reading it in instead',
+                     path, ctypes.get_errno())
+            advise(path, MADV_WILLNEED, offset, length)
+            return
+
+
+def release_resident(path: Path, offset: int = 0, length: Optional[int] = None):
+    """Unlock the mapped part of the file, letting its pages be evicted."""
+    for address, size in _page_ranges(path, offset, length):
+        libc().munlock(ctypes.c_void_p(address), ctypes.c_size_t(size))
+
+
+def preallocate(path: Path):
+    """
+    Allocate disk blocks of the file and read it into the page cache, ahead of writes to it.
+
+    Writes to the pages mapped then neither wait for the disk nor fail on a full one.
+    """
+    fd = os.open(str(path), os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError as e:
+                log.debug('Could not allocate %s: %s', path, e)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
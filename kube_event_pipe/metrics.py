@@ -0,0 +1,255 @@
+"""Pipeline metrics, served over HTTP in the Prometheus text format."""
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS_SEC = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS_SEC = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+Labels = Dict[str, str]
+
+
+def format_labels(labels: Labels) -> str:
+    """Format labels as `{name="value",...}`, or an empty string if there are none."""
+    if not labels:
+        return ''
+    escaped = (
+        value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for value in labels.values()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    """A named metric, which renders its samples in the text format."""
+
+    name: str
+    documentation: str
+    type: str
+
+    def __init__(self, name: str, documentation: str):
+        """Register the metric."""
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def expose(self) -> List[str]:
+        """Return lines of the text format, with the metric's help, type and samples."""
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+            *self.samples(),
+        ]
+
+    def samples(self) -> List[str]:
+        """Return sample lines."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        """Register the counter, starting at 0."""
+        super().__init__(name, documentation)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        """Increase the count."""
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> List[str]:
+        """Return the count."""
+        return [f'{self.name} {self.value}']
+
+
+class Histogram(Metric):
+    """Counts of observed values in cumulative buckets, with their sum."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float]):
+        """Register the histogram, with the given bucket upper bounds."""
+        super().__init__(name, documentation)
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Count a value in its bucket."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self) -> List[str]:
+        """Return cumulative bucket counts, the count and the sum of observations."""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip([*map(str, self.buckets), '+Inf'], counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_count {cumulative}')
+        lines.append(f'{self.name}_sum {total}')
+        return lines
+
+
+class GaugeFamily(Metric):
+    """Gauges with labels, read by calling `collect` on each scrape."""
+
+    type = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        collect: Callable[[], Iterable[Tuple[Labels, float]]],
+    ):
+        """Register gauges, whose labels and values are returned by `collect`."""
+        super().__init__(name, documentation)
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        """Return the collected values."""
+        return [f'{self.name}{format_labels(labels)} {value}' for labels, value in self.collect()]
+
+
+REGISTRY: List[Metric] = []
+
+
+def render() -> bytes:
+    """Render all registered metrics in the text format."""
+    lines = [line for metric in list(REGISTRY) for line in metric.expose()]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+EVENTS_RECEIVED = Counter(
+    'kube_event_pipe_events_received_total', 'Events received from the watch.')
+EVENTS_DEDUPLICATED = Counter(
+    'kube_event_pipe_events_deduplicated_total', 'Events skipped because they were seen before.')
+EVENTS_IGNORED = Counter(
+    'kube_event_pipe_events_ignored_total',
+    'Events skipped because they were filtered out locally.')
+EVENTS_COALESCED = Counter(
+    'kube_event_pipe_events_coalesced_total',
+    'Events held as repeats about the same object and reason, and written as summaries.')
+EVENTS_SHED = Counter(
+    'kube_event_pipe_events_shed_total',
+    'New events dropped because the pipeline lagged behind the watch.')
+EVENTS_WRITTEN = Counter(
+    'kube_event_pipe_events_written_total', 'Events written to the destination.')
+WRITE_LATENCY = Histogram(
+    'kube_event_pipe_write_seconds',
+    'Time taken to pass an event to the destination, including flushing a full buffer.',
+    LATENCY_BUCKETS_SEC)
+FLUSH_LATENCY = Histogram(
+    'kube_event_pipe_flush_seconds',
+    'Time taken to write out a batch of buffered events, including fsync.',
+    LATENCY_BUCKETS_SEC)
+EVENT_LAG = Histogram(
+    'kube_event_pipe_event_lag_seconds',
+    'Time between the last occurrence of an event and writing it out.',
+    LAG_BUCKETS_SEC)
+FILTER_FILL_RATIO = GaugeFamily(
+    'kube_event_pipe_filter_fill_ratio', 'Ratio of bits set in each bloom filter.', lambda: [])
+FILTER_FALSE_POSITIVE_RATE = GaugeFamily(
+    'kube_event_pipe_filter_false_positive_rate',
+    'False positive rate of each bloom filter, estimated from the ratio of bits set.', lambda: [])
+FILTER_RESIDENT_BYTES = GaugeFamily(
+    'kube_event_pipe_filter_resident_bytes',
+    'Bytes of each filter file resident in memory, as mapped by the process.', lambda: [])
+WATCH_RECONNECTS = Counter(
+    'kube_event_pipe_watch_reconnects_total',
+    'Watches resumed after being closed or after the connection failed.')
+WATCH_RELISTS = Counter(
+    'kube_event_pipe_watch_relists_total', 'Watches started by listing all events.')
+WATCH_RELIST_DURATION = Histogram(
+    'kube_event_pipe_watch_relist_seconds',
+    'Time taken to list all events, including processing them.',
+    LAG_BUCKETS_SEC)
+
+
+_filter_stats: Dict[Optional[str], Callable[[], Iterable[Tuple[str, float, float]]]] = {}
+_resident_bytes: Dict[Optional[str], Callable[[], Dict[str, int]]] = {}
+
+
+def cluster_labels(cluster: Optional[str], labels: Labels) -> Labels:
+    """Add the `cluster` label to labels of a cluster's gauges, if it's one of many."""
+    return labels if cluster is None else {'cluster': cluster, **labels}
+
+
+def collect_filter_stats(
+    filter_stats: Callable[[], Iterable[Tuple[str, float, float]]], cluster: Optional[str] = None,
+):
+    """
+    Collect bloom filter gauges from `filter_stats`, returning names, fill and error rates.
+
+    Gauges of filters of many clusters are collected together, labelled with `cluster`.
+    """
+    _filter_stats[cluster] = filter_stats
+    FILTER_FILL_RATIO.collect = lambda: [
+        (cluster_labels(source, {'filter': name}), fill_ratio)
+        for source, stats in list(_filter_stats.items()) for name, fill_ratio, _ in stats()]
+    FILTER_FALSE_POSITIVE_RATE.collect = lambda: [
+        (cluster_labels(source, {'filter': name}), error_rate)
+        for source, stats in list(_filter_stats.items()) for name, _, error_rate in stats()]
+
+
+def collect_filter_residency(
+    resident_bytes: Callable[[], Dict[str, int]], cluster: Optional[str] = None,
+):
+    """Collect filter residency gauges from `resident_bytes`, returning bytes by file name."""
+    _resident_bytes[cluster] = resident_bytes
+    FILTER_RESIDENT_BYTES.collect = lambda: [
+        (cluster_labels(source, {'file': name}), size)
+        for source, residency in list(_resident_bytes.items())
+        for name, size in residency().items()]
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server handling each request in a daemon thread."""
+
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Respond to any GET request with the metrics."""
+
+    def do_GET(self):
+        """Send the metrics."""
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests at the debug level, rather than to stderr."""
+        log.debug('Metrics request: ' + format, *args)
+
+
+def serve_metrics(port: int, address: str = '') -> MetricsServer:
+    """Serve metrics on the port from a background thread."""
+    server = MetricsServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    log.info('Serving metrics on port %s', server.server_address[1])
+    return server
@@ -0,0 +1,529 @@
+"""Deduplication of watched events and pipelines passing them from the watch to the destination."""
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from kube_event_pipe import metrics
+from kube_event_pipe.profiling import (
+    STAGE_TIMERS, STAGE_FILTER_ADD, STAGE_FILTER_LOOKUP, STAGE_IDENTITY, STAGE_SERIALIZE,
+    STAGE_WATCH_READ, STAGE_WRITE, timed_iter,
+)
+from kube_event_pipe.batched_bloom_filter import BatchedBloomFilter  # type: ignore
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.coalescing import EXPIRY_INTERVAL_SEC, Coalescer, Line
+from kube_event_pipe.cuckoo_filter import SlidingCuckooFilter
+from kube_event_pipe.destination import Destination
+from kube_event_pipe.identity import IDENTITY_NAME_COUNT, make_identity, name_count_key
+from kube_event_pipe.ring_bloom_filter import RingBloomFilter
+from kube_event_pipe.shedding import LoadShedder
+from kube_event_pipe.source import BOOKMARK, WatchedEvent, event_time
+
+
+log = logging.getLogger(__name__)
+
+
+# Filters of seen event identities.
+EventsSeen = Union[BatchedBloomFilter, RingBloomFilter, SlidingCuckooFilter]
+
+# A resourceVersion, if any, with the JSON to write, the time the event occurred at and the number
+# of events the JSON stands for, or None if the event was skipped or held.
+Record = Tuple[Optional[str], Optional[bytes], Optional[float], int]
+
+
+class Deduplicator:
+    """
+    Skip events seen before, encode new events as JSON.
+
+    Events are identified by a digest, computed once and looked up in all filters. Identities seen
+    most recently can be kept in an exact LRU cache, checked before `events_seen`. Repeats, which
+    come in bursts after relisting, are then answered without probing the filters and without their
+    false positives.
+
+    Until `legacy_until`, events not found by their digest are also looked up by `<name>-<count>`,
+    the identity filters were written with before digests.
+
+    With `group_commit`, identities of new events are kept pending, and only added to `events_seen`
+    by `commit`, once the events have been written out. A crash then can't leave an event marked as
+    seen without it having been written. Commits may come from another thread, e.g. one flushing
+    the destination, so filters are only used with the lock held.
+
+    New events `shed` returns true for are dropped without recording them, so they can still be
+    written if they're listed again, e.g. after the watch expired.
+
+    New events `hold` returns true for, e.g. ones coalescing is about to hold, are only kept in
+    memory, until their identities are passed to `release`, once they're written. A crash then
+    can't leave them marked as seen while held.
+    """
+
+    events_seen: EventsSeen
+    accept: Optional[Callable[[dict], bool]]
+    identity: Callable[[dict], bytes]
+    recent_cache_size: int
+    legacy_until: float
+    group_commit: bool
+    shed: Optional[LoadShedder]
+    hold: Optional[Callable[[dict, bytes], bool]]
+    recent: 'OrderedDict[bytes, None]'
+    pending: 'OrderedDict[bytes, None]'
+    held: Dict[bytes, None]
+    skipped: int
+    recent_hits: int
+
+    def __init__(
+        self,
+        events_seen: EventsSeen,
+        accept: Optional[Callable[[dict], bool]] = None,
+        recent_cache_size: int = 0,
+        identity: Optional[Callable[[dict], bytes]] = None,
+        legacy_until: float = 0.0,
+        group_commit: bool = False,
+        shed: Optional[LoadShedder] = None,
+        hold: Optional[Callable[[dict, bytes], bool]] = None,
+    ):
+        """
+        Deduplicate events against `events_seen`, ignoring ones `accept` returns false for.
+
+        Up to `recent_cache_size` identities are cached, none if it's 0. Events are identified by
+        name and count, unless another `identity` is given.
+        """
+        self.events_seen = events_seen
+        self.accept = accept
+        self.identity = identity or make_identity(IDENTITY_NAME_COUNT)
+        self.recent_cache_size = recent_cache_size
+        self.legacy_until = legacy_until
+        self.group_commit = group_commit
+        self.shed = shed
+        self.hold = hold
+        self.recent = OrderedDict()
+        self.pending = OrderedDict()
+        self.held = {}
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.recent_hits = 0
+
+    def __call__(self, event: WatchedEvent) -> Optional[bytes]:
+        """
+        Return the event as JSON, or None if it has been seen before, isn't accepted or is shed.
+
+        Bookmarks are always skipped, only their resourceVersion is checkpointed.
+        """
+        if event.type == BOOKMARK:
+            return None
+        event_obj = event.obj
+        metrics.EVENTS_RECEIVED.inc()
+        if self.accept is not None and not self.accept(event_obj):
+            metrics.EVENTS_IGNORED.inc()
+            return None
+
+        start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+        event_identity = self.identity(event_obj)
+        if start:
+            STAGE_TIMERS.record(STAGE_IDENTITY, start)
+        with self._lock:
+            seen = self._seen(event_identity) or self._seen_legacy(event_obj)
+            shed = not seen and self.shed is not None and self.shed(event_obj)
+        if not seen and not shed:
+            # Not asked with the lock held, since releasing held events takes it.
+            held = self.hold is not None and self.hold(event_obj, event_identity)
+            with self._lock:
+                if held:
+                    self.held[event_identity] = None
+                else:
+                    self._record(event_identity)
+        if shed:
+            return None
+        if seen:
+            self.skipped += 1
+            metrics.EVENTS_DEDUPLICATED.inc()
+            log.debug('Skipped repeated event: %s-%s: %r', event_obj['metadata'].get('name'),
+                      event_obj.get('count'), event_obj.get('message'))
+            return None
+
+        if self.skipped > 0:
+            log.info('New event seen, after skipping %s previously seen events', self.skipped)
+        self.skipped = 0
+        log.debug('Logging event: %s-%s: %r', event_obj['metadata'].get('name'),
+                  event_obj.get('count'), event_obj.get('message'))
+
+        event_data = event.data
+        if event_data is None:
+            start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+            event_data = json.dumps(event_obj).encode()
+            if start:
+                STAGE_TIMERS.record(STAGE_SERIALIZE, start)
+        return event_data
+
+    def first_seen_many(self, identities: Sequence[bytes]) -> List[bool]:
+        """
+        Return whether each identity is seen for the first time, recording ones which are.
+
+        Identities not seen recently are looked up in and added to `events_seen` in a batch. Of
+        identities repeated in the batch, only the first one can be seen for the first time.
+        """
+        first = [False] * len(identities)
+        with self._lock:
+            # Identities to look up, and where they're first in the batch.
+            unknown: Dict[bytes, int] = {}
+            for i, event_identity in enumerate(identities):
+                if event_identity not in unknown and not self._seen_recently(event_identity):
+                    unknown[event_identity] = i
+
+            start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+            seen = self.events_seen.contains_many(list(unknown))
+            if start:
+                STAGE_TIMERS.record(STAGE_FILTER_LOOKUP, start)
+            new = []
+            for (event_identity, i), was_seen in zip(unknown.items(), seen):
+                if not was_seen:
+                    first[i] = True
+                    new.append(event_identity)
+                self._cache(event_identity)
+
+            if self.group_commit:
+                self.pending.update(dict.fromkeys(new))
+            else:
+                start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+                self.events_seen.add_many(new)
+                if start:
+                    STAGE_TIMERS.record(STAGE_FILTER_ADD, start)
+        return first
+
+    def release(self, identities: Sequence[bytes]):
+        """Record identities of held events, once they're written, e.g. in a summary."""
+        with self._lock:
+            for event_identity in identities:
+                self.held.pop(event_identity, None)
+                self._record(event_identity)
+
+    def commit(self, count: int):
+        """
+        Add identities of the `count` oldest pending events to `events_seen`, then sync it.
+
+        Events must be written out in the order they were returned in, so the oldest pending
+        identities are the ones of events written out.
+        """
+        with self._lock:
+            start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+            for _ in range(min(count, len(self.pending))):
+                event_identity, _ = self.pending.popitem(last=False)
+                self.events_seen.add(event_identity)
+            if start:
+                STAGE_TIMERS.record(STAGE_FILTER_ADD, start)
+        self.events_seen.sync()
+
+    def _seen(self, event_identity: bytes) -> bool:
+        if self._seen_recently(event_identity):
+            return True
+        start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+        seen = event_identity in self.events_seen
+        if start:
+            STAGE_TIMERS.record(STAGE_FILTER_LOOKUP, start)
+        if seen:
+            self._cache(event_identity)
+        return seen
+
+    def _seen_recently(self, event_identity: bytes) -> bool:
+        """Check the cache of recently seen identities, and ones pending commit or held."""
+        if event_identity in self.recent:
+            self.recent.move_to_end(event_identity)
+            self.recent_hits += 1
+            return True
+        return event_identity in self.pending or event_identity in self.held
+
+    def _seen_legacy(self, event_obj: dict) -> bool:
+        if not self.legacy_until:
+            return False
+        if time.time() > self.legacy_until:
+            log.info('Filters no longer contain identities written before digests')
+            self.legacy_until = 0.0
+            return False
+        return name_count_key(event_obj) in self.events_seen
+
+    def _record(self, event_identity: bytes):
+        if self.group_commit:
+            self.pending[event_identity] = None
+        else:
+            start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+            self.events_seen.add(event_identity)
+            if start:
+                STAGE_TIMERS.record(STAGE_FILTER_ADD, start)
+        self._cache(event_identity)
+
+    def _cache(self, event_identity: bytes):
+        if self.recent_cache_size:
+            self.recent[event_identity] = None
+            if len(self.recent) > self.recent_cache_size:
+                self.recent.popitem(last=False)
+
+
+def run_pipeline(
+    events: Iterator[WatchedEvent],
+    deduplicate: Deduplicator,
+    destination: Destination,
+    checkpoint: ResourceVersionCheckpoint,
+    coalesce: Optional[Coalescer] = None,
+):
+    """
+    Deduplicate and write events one by one, coalescing them if `coalesce` is given.
+
+    Summaries of coalescing windows which ended are written before the next event is deduplicated,
+    or by a background thread while no events come, with the coalescer's lock held until the event
+    is written. Lines are then written in the order their identities are recorded in, which group
+    commit relies on.
+    """
+    if coalesce is None:
+        for event in timed_iter(events, STAGE_WATCH_READ):
+            event_data = deduplicate(event)
+            start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+            if event_data is not None:
+                destination.write(event_data, event_time(event.obj))
+            if start:
+                STAGE_TIMERS.record(STAGE_WRITE, start)
+            checkpoint.update(event.obj['metadata']['resourceVersion'])
+        return
+
+    stop = threading.Event()
+    expirer = threading.Thread(
+        target=_expire_periodically, args=(coalesce, destination, stop), name='coalesce-expirer',
+        daemon=True)
+    expirer.start()
+    try:
+        for event in timed_iter(events, STAGE_WATCH_READ):
+            with coalesce.lock:
+                _write_lines(destination, coalesce.expired(time.monotonic()))
+                event_data = deduplicate(event)
+                start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+                _write_lines(destination, coalesce(event.obj, event_data))
+                if start:
+                    STAGE_TIMERS.record(STAGE_WRITE, start)
+                checkpoint.update(coalesce.resume_version(event.obj['metadata']['resourceVersion']))
+    finally:
+        stop.set()
+        expirer.join()
+
+
+def _write_lines(destination: Destination, lines: List[Line]):
+    for data, occurred_at, event_count in lines:
+        destination.write(data, occurred_at, event_count)
+
+
+def _expire_periodically(coalesce: Coalescer, destination: Destination, stop: threading.Event):
+    """Write summaries of coalescing windows which ended while no events came, in a thread."""
+    while not stop.wait(EXPIRY_INTERVAL_SEC):
+        try:
+            with coalesce.lock:
+                _write_lines(destination, coalesce.expired(time.monotonic()))
+        except Exception:
+            log.exception('Failed to write coalesced events')
+            return
+
+
+class _End:
+    """Marks the end of the watch, possibly with an exception."""
+
+    def __init__(self, exception: Optional[BaseException] = None):
+        self.exception = exception
+
+
+class AsyncPipeline:
+    """
+    Watch, deduplication and write stages, connected by bounded queues.
+
+    The blocking watch and writes run in their own threads, so a slow destination doesn't stall
+    reading from the watch until the queues fill up. When they do, the watch thread blocks, which
+    applies backpressure to the API server connection.
+
+    Events are coalesced after deduplication, if `coalesce` is given. Summaries of windows which
+    ended are queued to be written by the deduplication stage, before the next event is
+    deduplicated, or while waiting for events, so they're written in order with events. The time
+    events waited to be deduplicated is the lag of the deduplicator's load shedder, if it has one.
+    """
+
+    deduplicate: Deduplicator
+    destination: Destination
+    checkpoint: ResourceVersionCheckpoint
+    queue_size: int
+    log_interval_sec: float
+    coalesce: Optional[Coalescer]
+    backpressure: bool
+
+    def __init__(
+        self,
+        deduplicate: Deduplicator,
+        destination: Destination,
+        checkpoint: ResourceVersionCheckpoint,
+        queue_size: int,
+        log_interval_sec: float,
+        coalesce: Optional[Coalescer] = None,
+    ):
+        """Set up the stages, without starting them."""
+        self.deduplicate = deduplicate
+        self.destination = destination
+        self.checkpoint = checkpoint
+        self.queue_size = queue_size
+        self.log_interval_sec = log_interval_sec
+        self.coalesce = coalesce
+        self.backpressure = False
+
+        self.loop = asyncio.new_event_loop()
+        # Queues are bound to the loop set here.
+        asyncio.set_event_loop(self.loop)
+        self.watch_queue: asyncio.Queue = asyncio.Queue()
+        self.write_queue: asyncio.Queue = asyncio.Queue(queue_size)
+        # The watch thread can't await putting into a bounded queue, so it acquires a slot first.
+        self.watch_slots = threading.BoundedSemaphore(queue_size)
+        self.write_executor = ThreadPoolExecutor(1, thread_name_prefix='writer')
+        self.tasks: List[asyncio.Task] = []
+
+    def run(self, events: Iterator[WatchedEvent]):
+        """
+        Run until the watch ends or fails, or until interrupted, e.g. with SystemExit.
+
+        Deduplicated events already in the write queue are written before returning.
+        """
+        try:
+            self.loop.run_until_complete(self._run(events))
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+            self.write_executor.shutdown(wait=True)
+            self._write(self._drain_write_queue())
+            self.loop.close()
+
+    async def _run(self, events: Iterator[WatchedEvent]):
+        self.tasks = [
+            self.loop.create_task(self._deduplicate_stage()),
+            self.loop.create_task(self._write_stage()),
+            self.loop.create_task(self._log_queue_depths()),
+        ]
+        watch_thread = threading.Thread(
+            target=self._watch, args=(events,), name='watcher', daemon=True)
+        watch_thread.start()
+        await asyncio.gather(*self.tasks[:2])
+
+    def _watch(self, events: Iterator[WatchedEvent]):
+        """Read the watch in a thread, passing events to the loop."""
+        end = _End()
+        try:
+            for event in timed_iter(events, STAGE_WATCH_READ):
+                self.watch_slots.acquire()
+                # Stamped with the time it was read at, to measure the lag of deduplication.
+                self.loop.call_soon_threadsafe(
+                    self.watch_queue.put_nowait, (time.monotonic(), event))
+        except BaseException as e:
+            end = _End(e)
+        try:
+            self.loop.call_soon_threadsafe(self.watch_queue.put_nowait, end)
+        except RuntimeError:
+            # The loop is closed, nobody is waiting for the end of the watch.
+            pass
+
+    async def _deduplicate_stage(self):
+        while True:
+            if self.coalesce is None:
+                item = await self.watch_queue.get()
+            else:
+                item = await self._get_coalescing()
+            if isinstance(item, _End):
+                await self.write_queue.put(item)
+                if item.exception is not None:
+                    raise item.exception
+                return
+            self.watch_slots.release()
+
+            read_at, event = item
+            if self.deduplicate.shed is not None:
+                self.deduplicate.shed.update(time.monotonic() - read_at)
+
+            event_data = self.deduplicate(event)
+            resource_version = event.obj['metadata']['resourceVersion']
+            if self.coalesce is None:
+                await self._put((
+                    resource_version,
+                    event_data,
+                    event_time(event.obj) if event_data is not None else None,
+                    1,
+                ))
+                continue
+
+            lines = self.coalesce(event.obj, event_data)
+            resource_version = self.coalesce.resume_version(resource_version)
+            for data, occurred_at, event_count in lines:
+                await self._put((resource_version, data, occurred_at, event_count))
+            if not lines:
+                await self._put((resource_version, None, None, 0))
+
+    async def _get_coalescing(self):
+        """Return the next item of the watch queue, queueing summaries of windows which ended."""
+        assert self.coalesce is not None
+        while True:
+            item = None
+            if not self.watch_queue.empty():
+                item = self.watch_queue.get_nowait()
+            else:
+                try:
+                    item = await asyncio.wait_for(self.watch_queue.get(), EXPIRY_INTERVAL_SEC)
+                except asyncio.TimeoutError:
+                    pass
+            # Expired before deduplicating the next event, so summaries are queued before it.
+            for data, occurred_at, event_count in self.coalesce.expired(time.monotonic()):
+                await self._put((None, data, occurred_at, event_count))
+            if item is not None:
+                return item
+
+    async def _put(self, record: Record):
+        if self.write_queue.full():
+            if not self.backpressure:
+                log.warning('Write queue full (%s events), applying backpressure to the watch',
+                            self.queue_size)
+            self.backpressure = True
+            await self.write_queue.put(record)
+        else:
+            if self.backpressure:
+                log.info('Write queue no longer full, releasing backpressure')
+            self.backpressure = False
+            self.write_queue.put_nowait(record)
+
+    async def _write_stage(self):
+        while True:
+            records = [await self.write_queue.get()]
+            records.extend(self._drain_write_queue())
+            # Records taken from the queue are written even if the stage is cancelled, rather than
+            # dropped with the job, if the writer hadn't started it yet.
+            await asyncio.shield(
+                self.loop.run_in_executor(self.write_executor, self._write, records))
+            if isinstance(records[-1], _End):
+                return
+
+    def _drain_write_queue(self) -> List:
+        records = []
+        while not self.write_queue.empty():
+            records.append(self.write_queue.get_nowait())
+        return records
+
+    def _write(self, records: List[Union[Record, _End]]):
+        for record in records:
+            if isinstance(record, _End):
+                continue
+            resource_version, event_data, occurred_at, event_count = record
+            if event_data is not None:
+                start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+                self.destination.write(event_data, occurred_at, event_count)
+                if start:
+                    STAGE_TIMERS.record(STAGE_WRITE, start)
+            if resource_version is not None:
+                self.checkpoint.update(resource_version)
+
+    async def _log_queue_depths(self):
+        while True:
+            await asyncio.sleep(self.log_interval_sec)
+            watch_depth = self.watch_queue.qsize()
+            write_depth = self.write_queue.qsize()
+            level = logging.INFO if watch_depth or write_depth else logging.DEBUG
+            log.log(level, 'Queue depths: watch %s/%s, write %s/%s',
+                    watch_depth, self.queue_size, write_depth, self.queue_size)
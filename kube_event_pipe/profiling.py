@@ -0,0 +1,191 @@
+"""On-demand profiling: sampling stacks and timing stages of the hot path, toggled by signals."""
+import sys
+import time
+import signal
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, TypeVar
+
+
+SAMPLE_INTERVAL_SEC = 0.01
+
+STAGE_WATCH_READ = 'watch_read'
+STAGE_IDENTITY = 'identity'
+STAGE_FILTER_LOOKUP = 'filter_lookup'
+STAGE_FILTER_ADD = 'filter_add'
+STAGE_SERIALIZE = 'serialize'
+STAGE_WRITE = 'write'
+STAGES = (
+    STAGE_WATCH_READ, STAGE_IDENTITY, STAGE_FILTER_LOOKUP, STAGE_FILTER_ADD, STAGE_SERIALIZE,
+    STAGE_WRITE,
+)
+
+Item = TypeVar('Item')
+
+
+class StageTimers:
+    """
+    Cumulative time spent in, and number of calls of, stages of the hot path.
+
+    Callers only read the clock and call `record` while `enabled` is set, so timers cost a single
+    attribute lookup per stage otherwise. Stages may be timed from many threads, e.g. of clusters,
+    at the cost of an occasionally lost update.
+    """
+
+    enabled: bool
+    seconds: Dict[str, float]
+    calls: Dict[str, int]
+
+    def __init__(self):
+        """Create disabled timers."""
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        """Zero all timers."""
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+
+    def record(self, stage: str, start: float):
+        """Add the time since `start`, read from `time.perf_counter`, to the stage."""
+        self.seconds[stage] += time.perf_counter() - start
+        self.calls[stage] += 1
+
+    def format(self) -> List[str]:
+        """Format timers as lines of the stage, calls, total and mean time per call."""
+        lines = [f'{"stage":<14}{"calls":>12}{"total_sec":>12}{"mean_usec":>12}']
+        for stage in STAGES:
+            calls = self.calls[stage]
+            mean_usec = self.seconds[stage] / calls * 1e6 if calls else 0.0
+            lines.append(f'{stage:<14}{calls:>12}{self.seconds[stage]:>12.3f}{mean_usec:>12.1f}')
+        return lines
+
+
+STAGE_TIMERS = StageTimers()
+
+
+def timed_iter(items: Iterator[Item], stage: str) -> Iterator[Item]:
+    """Yield items, timing how long each takes to be produced while timers are enabled."""
+    items = iter(items)
+    while True:
+        start = time.perf_counter() if STAGE_TIMERS.enabled else 0.0
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        if start:
+            STAGE_TIMERS.record(stage, start)
+        yield item
+
+
+def collapse_stack(frame) -> str:
+    """Format the stack of the frame, outermost first, as `func (file:line);...`."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        path = Path(code.co_filename)
+        names.append(f"{code.co_name} ({'/'.join(path.parts[-2:])}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """
+    Samples stacks of all threads in a background thread, counting collapsed stacks.
+
+    Samples are of wall-clock time, so threads waiting, e.g. for the watch to send events, show up
+    in them too. Collapsed stacks, `thread;func (file:line);... count`, are read by flame graph
+    tools.
+    """
+
+    interval_sec: float
+    stacks: 'Counter[str]'
+    samples: int
+    started_at: float
+
+    def __init__(self, interval_sec: float = SAMPLE_INTERVAL_SEC):
+        """Prepare to sample every `interval_sec`."""
+        self.interval_sec = interval_sec
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        """Return whether the profiler is sampling."""
+        return self._thread is not None
+
+    def start(self):
+        """Start sampling and timing stages, from zero."""
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = time.time()
+        STAGE_TIMERS.reset()
+        STAGE_TIMERS.enabled = True
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and timing stages."""
+        STAGE_TIMERS.enabled = False
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def dump(self, directory: Path) -> Path:
+        """
+        Write collapsed stacks to `profile-<unix_timestamp>.folded`, return its path.
+
+        Stage timers are written next to them, to `profile-<unix_timestamp>.stages`.
+        """
+        duration = time.time() - self.started_at
+        path = directory / f'profile-{int(self.started_at)}.folded'
+        path.write_text(''.join(
+            f'{stack} {count}\n' for stack, count in sorted(self.stacks.items())))
+        path.with_suffix('.stages').write_text('\n'.join([
+            f'# {duration:.3f}s, {self.samples} samples every {self.interval_sec}s',
+            *STAGE_TIMERS.format(),
+        ]) + '\n')
+        return path
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval_sec):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    name = names.get(thread_id, str(thread_id))
+                    self.stacks[f'{name};{collapse_stack(frame)}'] += 1
+            self.samples += 1
+
+
+def profile_on_signals(directory: Path):
+    """Start profiling on SIGUSR1, stop and write the profile to the directory on SIGUSR2."""
+    profiler = Profiler()
+
+    def start(signum, frame):
+        if profiler.running:
+            sys.stderr.write('Caught SIGUSR1. Already profiling.\n')
+            return
+        sys.stderr.write('Caught SIGUSR1. Profiling until SIGUSR2.\n')
+        profiler.start()
+
+    def stop(signum, frame):
+        if not profiler.running:
+            sys.stderr.write('Caught SIGUSR2. Not profiling.\n')
+            return
+        profiler.stop()
+        try:
+            path = profiler.dump(directory)
+        except OSError as e:
+            sys.stderr.write(f'Caught SIGUSR2. Could not write the profile: {e}\n')
+        else:
+            sys.stderr.write(f'Caught SIGUSR2. Wrote the profile to {path}.\n')
+
+    signal.signal(signal.SIGUSR1, start)
+    signal.signal(signal.SIGUSR2, stop)
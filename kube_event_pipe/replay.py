@@ -0,0 +1,241 @@
+"""
+Deduplicating archived events offline, e.g. previous output or `kubectl get events -o json`.
+
+Usage: `kube-event-pipe replay [--output PATH] [--filters DIR] [--workers N] FILE...`. Filters
+are configured by the same environment variables as the watch.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import AsyncResult
+from pathlib import Path
+from typing import IO, Callable, Deque, Iterator, List, Optional, Sequence, Tuple
+from kube_event_pipe.identity import check_identity_strategy, make_identity
+from kube_event_pipe.main import open_events_seen, open_settings_destination, read_settings
+from kube_event_pipe.pipeline import Deduplicator
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore
+
+
+log = logging.getLogger(__name__)
+
+
+CHUNK_BYTES = 1024 * 1024
+CHUNK_EVENTS = 1000
+CHUNKS_PER_WORKER = 2
+
+
+def list_items(document) -> list:
+    """Return events of a JSON array, an object with `items`, or of a single event object."""
+    if isinstance(document, list):
+        return document
+    if isinstance(document, dict):
+        return document.get('items', [document])
+    raise ValueError(f'Expecting a JSON object or array, got {type(document).__name__}')
+
+
+def read_chunks(stream: IO[bytes]) -> Iterator[List[bytes]]:
+    """
+    Read JSON lines, or a JSON list of events, in chunks of lines of about `CHUNK_BYTES`.
+
+    A list, unlike lines, is read whole. Its events are encoded as lines, in chunks of
+    `CHUNK_EVENTS`.
+    """
+    first = stream.readline()
+    while first and not first.strip():
+        first = stream.readline()
+    if not first:
+        return
+    try:
+        first_obj = json_loads(first)
+    except ValueError:
+        first_obj = None
+
+    if isinstance(first_obj, dict) and 'items' not in first_obj:
+        yield [first]
+        while True:
+            lines = stream.readlines(CHUNK_BYTES)
+            if not lines:
+                return
+            yield lines
+
+    document = first_obj if first_obj is not None else json_loads(first + stream.read())
+    items = list_items(document)
+    for start in range(0, len(items), CHUNK_EVENTS):
+        yield [json.dumps(item).encode() for item in items[start:start + CHUNK_EVENTS]]
+
+
+def open_input(path: str) -> IO[bytes]:
+    """Open an input file, `-` being stdin."""
+    if path == '-':
+        return sys.stdin.buffer
+    return open(path, 'rb')
+
+
+_identity: Optional[Callable[[dict], bytes]] = None
+
+
+def init_worker(identity_strategy: str):
+    """Prepare a worker to identify events by the strategy."""
+    global _identity
+    _identity = make_identity(identity_strategy)
+
+
+def identify(lines: List[bytes]) -> List[Optional[bytes]]:
+    """Return identities of events on the lines, None for lines which aren't events."""
+    identity = _identity
+    assert identity is not None
+    identities: List[Optional[bytes]] = []
+    for line in lines:
+        try:
+            identities.append(identity(json_loads(line)))
+        except (ValueError, KeyError, TypeError):
+            identities.append(None)
+    return identities
+
+
+class Replay:
+    """
+    Deduplicates events from files, writing new ones in the order they were read in.
+
+    Lines are parsed and identified in chunks by `workers` processes, a few chunks ahead of
+    deduplication, which is sequential, a chunk at a time, so the identities of a chunk are looked
+    up and added in a batch. Lines are written as they were read, without re-encoding.
+    """
+
+    deduplicate: Deduplicator
+    write: Callable[[bytes], None]
+    identity_strategy: str
+    workers: int
+    events: int
+    written: int
+    duplicates: int
+    invalid: int
+
+    def __init__(
+        self,
+        deduplicate: Deduplicator,
+        write: Callable[[bytes], None],
+        identity_strategy: str,
+        workers: int = 1,
+    ):
+        """Pass new events to `write`, parsing them in `workers` processes if there's over 1."""
+        self.deduplicate = deduplicate
+        self.write = write
+        self.identity_strategy = identity_strategy
+        self.workers = workers
+        self.events = 0
+        self.written = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    def run(self, paths: Sequence[str]):
+        """Replay the files in order."""
+        if self.workers <= 1:
+            init_worker(self.identity_strategy)
+            for lines in self._chunks(paths):
+                self._write_new(lines, identify(lines))
+            return
+
+        # Spawned rather than forked, since the destination flusher thread is already running.
+        pool = multiprocessing.get_context('spawn').Pool(
+            self.workers, init_worker, (self.identity_strategy,))
+        in_flight: Deque[Tuple[List[bytes], AsyncResult]] = deque()
+        try:
+            for lines in self._chunks(paths):
+                in_flight.append((lines, pool.apply_async(identify, (lines,))))
+                # Bounded, so the files aren't read into memory faster than they're written.
+                if len(in_flight) >= self.workers * CHUNKS_PER_WORKER:
+                    self._write_new(*self._get(in_flight))
+            while in_flight:
+                self._write_new(*self._get(in_flight))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def _get(in_flight: Deque[Tuple[List[bytes], AsyncResult]]):
+        lines, result = in_flight.popleft()
+        return lines, result.get()
+
+    def _chunks(self, paths: Sequence[str]) -> Iterator[List[bytes]]:
+        for path in paths:
+            log.info('Replaying %s', path)
+            stream = open_input(path)
+            try:
+                yield from read_chunks(stream)
+            finally:
+                if stream is not sys.stdin.buffer:
+                    stream.close()
+
+    def _write_new(self, lines: List[bytes], identities: List[Optional[bytes]]):
+        events = []
+        for line, event_identity in zip(lines, identities):
+            if event_identity is not None:
+                events.append((line, event_identity))
+            elif line.strip():
+                self.invalid += 1
+        # Looked up in and added to filters in a batch.
+        first_seen = self.deduplicate.first_seen_many([identity for _, identity in events])
+        for (line, _), new in zip(events, first_seen):
+            if new:
+                self.write(line.rstrip(b'\r\n'))
+        written = sum(first_seen)
+        self.events += len(events)
+        self.written += written
+        self.duplicates += len(events) - written
+
+
+def main(argv: List[str]):
+    """Run the `replay` command."""
+    parser = argparse.ArgumentParser(
+        prog='kube-event-pipe replay', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('files', nargs='+',
+                        help='files of JSON lines or JSON lists of events, - for stdin')
+    parser.add_argument('--output', help='file to write new events to, - for stdout, '
+                                         'by default KUBE_EVENT_PIPE_DESTINATION')
+    parser.add_argument('--filters', type=Path,
+                        help='directory of filters to deduplicate against and add events to, '
+                             'e.g. the persistence directory, by default temporary filters')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes parsing events, by default one per CPU')
+    args = parser.parse_args(argv)
+    settings = read_settings()
+    output_path = settings.destination_path
+    if args.output is not None:
+        output_path = Path('/dev/stdout' if args.output == '-' else args.output)
+
+    with tempfile.TemporaryDirectory(prefix='kube-event-pipe-replay-') as tmpdir:
+        filters_path = args.filters or Path(tmpdir)
+        filters_path.mkdir(parents=True, exist_ok=True)
+        if check_identity_strategy(
+                filters_path, settings.identity,
+                settings.batch_count * settings.batch_duration_sec):
+            log.warning('Identities written before digests are not checked by replay')
+        events_seen = open_events_seen(filters_path, settings)
+        destination = open_settings_destination(settings, output_path)
+        replay = Replay(
+            Deduplicator(events_seen, recent_cache_size=settings.recent_cache_size),
+            destination.write,
+            settings.identity,
+            workers=args.workers,
+        )
+        start = time.monotonic()
+        try:
+            replay.run(args.files)
+        finally:
+            destination.close()
+            events_seen.close()
+        duration = time.monotonic() - start
+        log.info('Replayed %s events in %.3fs (%.0f/s): %s written, %s duplicates, %s invalid',
+                 replay.events, duration, replay.events / duration if duration else 0,
+                 replay.written, replay.duplicates, replay.invalid)
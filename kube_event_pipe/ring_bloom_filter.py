@@ -0,0 +1,242 @@
+"""Rotated bloom filter generations kept as slots of a ring in a single mmapped file."""
+import os
+import math
+import mmap
+import time
+import struct
+import hashlib
+import logging
+from typing import Generic, List, Sequence, Tuple, TypeVar, Union
+from pathlib import Path
+from kube_event_pipe import memory
+
+
+log = logging.getLogger(__name__)
+
+
+Element = TypeVar('Element', str, bytes)
+
+
+RING_FILE_NAME = 'events_seen.ring'
+RING_MAGIC = b'KEPRING1'
+# Magic, slot count, blocks per slot, hashes per element, head slot. Followed by a creation
+# timestamp per slot.
+HEADER_FORMAT = '<8sIQII'
+TIMESTAMP_FORMAT = '<q'
+# A block is a cache line: all bits of an element are set within a single one.
+BLOCK_BYTES = 64
+BLOCK_BITS = BLOCK_BYTES * 8
+BIT_POSITION_BITS = 9
+BIT_MASKS = [1 << position for position in range(BLOCK_BITS)]
+ZEROING_CHUNK_BYTES = 1024 * 1024
+
+
+def blocked_filter_geometry(capacity: int, error_rate: float) -> Tuple[int, int]:
+    """
+    Return the number of blocks and hashes of a filter, sized like a standard bloom filter.
+
+    Since elements aren't spread evenly between blocks, the false positive rate of a blocked filter
+    is somewhat higher than that of a standard one of the same size, increasingly so for error
+    rates much below 1%.
+    """
+    bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+    block_count = max(1, math.ceil(bits / BLOCK_BITS))
+    num_hashes = max(1, round(bits / capacity * math.log(2)))
+    return block_count, num_hashes
+
+
+class RingBloomFilter(Generic[Element]):
+    """
+    Bloom filter generations rotated periodically, stored as a ring of slots in a single file.
+
+    Filters are blocked: each element sets bits within a single cache line, selected by the same
+    hash in every slot. An element is hashed once per lookup and probing each generation touches
+    one cache line. Rotation zeroes the oldest slot in place and makes it the one written to.
+
+    The kernel is advised not to read ahead on page faults, and the head slot is kept resident.
+    """
+
+    path: Path
+    batch_count: int
+    batch_duration_sec: int
+    block_count: int
+    num_hashes: int
+    head: int
+    head_offset: int
+    timestamps: List[int]
+
+    def __init__(
+        self,
+        directory: Path,
+        filter_capacity: int,
+        filter_error_rate: float,
+        batch_count: int,
+        batch_duration_sec: int,
+    ):
+        """Open the ring in `<directory>/events_seen.ring`, creating it if needed."""
+        self.path = directory / RING_FILE_NAME
+        self.batch_count = batch_count
+        self.batch_duration_sec = batch_duration_sec
+        self.block_count, self.num_hashes = blocked_filter_geometry(
+            filter_capacity, filter_error_rate)
+        # The digest holds a 64-bit block index followed by bit positions within the block.
+        self.position_shifts = [64 + i * BIT_POSITION_BITS for i in range(self.num_hashes)]
+        self.digest_size = min(64, math.ceil(self.position_shifts[-1] / 8) + 2)
+
+        self.slot_bytes = self.block_count * BLOCK_BYTES
+        header_bytes = struct.calcsize(HEADER_FORMAT) + batch_count * struct.calcsize(
+            TIMESTAMP_FORMAT)
+        # Keeps slots page-aligned.
+        self.data_offset = math.ceil(header_bytes / mmap.PAGESIZE) * mmap.PAGESIZE
+        file_size = self.data_offset + batch_count * self.slot_bytes
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing_size = os.fstat(fd).st_size
+            if existing_size != file_size:
+                if existing_size:
+                    log.warning('Discarding bloom filter ring of a different size: %s', self.path)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, file_size)
+            self.mmap = mmap.mmap(fd, file_size)
+        finally:
+            os.close(fd)
+
+        self.head = 0
+        self.timestamps = [0] * batch_count
+        self._last_probe: Tuple[Union[str, bytes, None], int, int] = (None, 0, 0)
+        if not self._read_header():
+            self._zero(self.data_offset, file_size)
+            self._write_header()
+        log.info('Opened bloom filter ring %s: %s slots of %s blocks, %s hashes, created at %s',
+                 self.path, self.batch_count, self.block_count, self.num_hashes, self.timestamps)
+        self._update_slot_offsets()
+        memory.advise(self.path, memory.MADV_RANDOM)
+        memory.keep_resident(self.path, self.head_offset, self.slot_bytes)
+        self.rotate_if_needed()
+
+    def _read_header(self) -> bool:
+        """Read the head slot and slot timestamps, return whether the header was valid."""
+        magic, slot_count, block_count, num_hashes, head = struct.unpack_from(
+            HEADER_FORMAT, self.mmap)
+        if magic != RING_MAGIC:
+            return False
+        if (slot_count, block_count, num_hashes) != (
+                self.batch_count, self.block_count, self.num_hashes):
+            log.warning('Discarding bloom filter ring of a different geometry: %s', self.path)
+            return False
+        self.head = head
+        offset = struct.calcsize(HEADER_FORMAT)
+        self.timestamps = [
+            struct.unpack_from(TIMESTAMP_FORMAT, self.mmap, offset + i * 8)[0]
+            for i in range(slot_count)
+        ]
+        return True
+
+    def _write_header(self):
+        struct.pack_into(
+            HEADER_FORMAT, self.mmap, 0,
+            RING_MAGIC, self.batch_count, self.block_count, self.num_hashes, self.head)
+        offset = struct.calcsize(HEADER_FORMAT)
+        for i, timestamp in enumerate(self.timestamps):
+            struct.pack_into(TIMESTAMP_FORMAT, self.mmap, offset + i * 8, timestamp)
+
+    def _zero(self, start: int, end: int):
+        for chunk_start in range(start, end, ZEROING_CHUNK_BYTES):
+            chunk_end = min(chunk_start + ZEROING_CHUNK_BYTES, end)
+            self.mmap[chunk_start:chunk_end] = bytes(chunk_end - chunk_start)
+
+    def _update_slot_offsets(self):
+        """Note offsets of the head slot and of all slots in use, newest first."""
+        self.head_offset = self.data_offset + self.head * self.slot_bytes
+        slots = [(self.head - i) % self.batch_count for i in range(self.batch_count)]
+        self.slot_offsets = [
+            self.data_offset + slot * self.slot_bytes for slot in slots if self.timestamps[slot]
+        ]
+
+    @property
+    def last_batch_ts(self) -> int:
+        """Return the time the head slot was started at."""
+        return self.timestamps[self.head]
+
+    def rotate_if_needed(self):
+        """Zero the oldest slot and make it the head, if the head slot is due to be rotated."""
+        ts = int(time.time())
+        if ts - self.last_batch_ts <= self.batch_duration_sec:
+            return
+        if self.last_batch_ts:
+            memory.release_resident(self.path, self.head_offset, self.slot_bytes)
+            self.head = (self.head + 1) % self.batch_count
+        offset = self.data_offset + self.head * self.slot_bytes
+        self._zero(offset, offset + self.slot_bytes)
+        self.timestamps[self.head] = ts
+        self._write_header()
+        self._update_slot_offsets()
+        memory.keep_resident(self.path, self.head_offset, self.slot_bytes)
+        log.info('Rotated bloom filter ring %s, head slot %s, slots created at %s',
+                 self.path, self.head, self.timestamps)
+
+    def paths(self) -> List[Path]:
+        """Return the path of the ring file."""
+        return [self.path]
+
+    def _probe(self, element: Element) -> Tuple[int, int]:
+        """
+        Return the offset of the element's block within a slot and the mask of its bits.
+
+        The result for the last element is kept, since it's usually added right after a lookup.
+        """
+        last_element, block_offset, mask = self._last_probe
+        if element == last_element:
+            return block_offset, mask
+
+        if isinstance(element, bytes) and len(element) >= self.digest_size:
+            # Long enough bytes are event identity digests, uniformly distributed already.
+            digest = int.from_bytes(element[:self.digest_size], 'little')
+        else:
+            data = element.encode() if isinstance(element, str) else element
+            digest = int.from_bytes(
+                hashlib.blake2b(data, digest_size=self.digest_size).digest(), 'little')
+        block_offset = (digest & 0xffffffffffffffff) % self.block_count * BLOCK_BYTES
+        mask = 0
+        for shift in self.position_shifts:
+            mask |= BIT_MASKS[(digest >> shift) & (BLOCK_BITS - 1)]
+
+        self._last_probe = (element, block_offset, mask)
+        return block_offset, mask
+
+    def __contains__(self, element: Element) -> bool:
+        """Check if the element has been seen in any of the generations."""
+        block_offset, mask = self._probe(element)
+        buf = self.mmap
+        for slot_offset in self.slot_offsets:
+            offset = slot_offset + block_offset
+            if int.from_bytes(buf[offset:offset + BLOCK_BYTES], 'little') & mask == mask:
+                return True
+        return False
+
+    def add(self, element: Element):
+        """Add the element to the head slot."""
+        self.rotate_if_needed()
+        block_offset, mask = self._probe(element)
+        offset = self.head_offset + block_offset
+        block = int.from_bytes(self.mmap[offset:offset + BLOCK_BYTES], 'little') | mask
+        self.mmap[offset:offset + BLOCK_BYTES] = block.to_bytes(BLOCK_BYTES, 'little')
+
+    def contains_many(self, elements: Sequence[Element]) -> List[bool]:
+        """Check if each of the elements has been seen, one by one."""
+        return [element in self for element in elements]
+
+    def add_many(self, elements: Sequence[Element]):
+        """Add the elements, one by one."""
+        for element in elements:
+            self.add(element)
+
+    def sync(self):
+        """Write changed pages of the ring out to disk."""
+        self.mmap.flush()
+
+    def close(self):
+        """Write the ring out and unmap it."""
+        self.mmap.flush()
+        self.mmap.close()
@@ -0,0 +1,402 @@
+"""Splitting namespaces between worker processes, each with its own deduplication state."""
+import os
+import sys
+import time
+import zlib
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing.process import BaseProcess
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
+from pathlib import Path
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.destination import Destination
+from kube_event_pipe.source import BOOKMARK, WatchedEvent, parse_event
+
+
+log = logging.getLogger(__name__)
+
+
+SHARD_OUTPUT_MERGED = 'merged'
+SHARD_OUTPUT_SEPARATE = 'separate'
+SHARD_OUTPUTS = (SHARD_OUTPUT_MERGED, SHARD_OUTPUT_SEPARATE)
+
+# Events are passed to workers as their type and JSON, to parse, unless they were parsed already.
+RoutedEvent = Union[Tuple[str, bytes], WatchedEvent]
+
+WORKER_POLL_INTERVAL_SEC = 1.0
+WORKER_STOP_TIMEOUT_SEC = 10.0
+# Bookmarks sent to workers and not yet acknowledged by all of them, beyond which old ones are
+# forgotten, e.g. while a worker holds coalesced events.
+MAX_PENDING_SYNCS = 100
+
+
+def parse_shard_namespaces(spec: str) -> List[List[str]]:
+    """
+    Parse explicit namespace lists, e.g. `kube-system,monitoring;default`.
+
+    Lists are separated by `;`, and namespaces within them by `,`. The n-th list is assigned to
+    the n-th shard.
+    """
+    return [
+        [namespace.strip() for namespace in namespaces.split(',') if namespace.strip()]
+        for namespaces in spec.split(';') if namespaces.strip()
+    ]
+
+
+class ShardAssignment:
+    """Assigns namespaces to shards: from explicit lists, or by hashing the namespace name."""
+
+    shard_count: int
+    explicit: Dict[str, int]
+
+    def __init__(self, shard_count: int, shard_namespaces: Sequence[Sequence[str]] = ()):
+        """Assign namespaces listed in `shard_namespaces[n]` to shard n, hash all others."""
+        if len(shard_namespaces) > shard_count:
+            raise ValueError(
+                f'{len(shard_namespaces)} namespace lists given for {shard_count} shards')
+        self.shard_count = shard_count
+        self.explicit = {
+            namespace: shard
+            for shard, namespaces in enumerate(shard_namespaces)
+            for namespace in namespaces
+        }
+
+    def shard(self, namespace: str) -> int:
+        """Return the shard a namespace belongs to."""
+        try:
+            return self.explicit[namespace]
+        except KeyError:
+            # Not `hash`, which is randomized per process.
+            return zlib.crc32(namespace.encode()) % self.shard_count
+
+    def event_shard(self, event_obj: dict) -> int:
+        """Return the shard an event object belongs to, by its namespace."""
+        return self.shard(event_obj['metadata'].get('namespace', ''))
+
+
+def shard_destination_path(destination_path: Path, shard: int) -> Path:
+    """Name a per-shard destination file, e.g. `events.shard0.log` for `events.log`."""
+    return destination_path.with_name(
+        f'{destination_path.stem}.shard{shard}{destination_path.suffix}')
+
+
+def shard_persistence_path(persistence_path: Path, shard: int) -> Path:
+    """Return the directory of a shard's bloom filters and checkpoint."""
+    path = persistence_path / f'shard-{shard}'
+    path.mkdir(exist_ok=True)
+    return path
+
+
+class ShardCheckpoint(ResourceVersionCheckpoint):
+    """
+    The resourceVersion a worker processed events up to, acknowledged to the supervisor.
+
+    The supervisor watches and saves the checkpoint, once all workers acknowledge the
+    resourceVersion of a bookmark it sent them, so the worker doesn't keep a file. A bookmark is
+    acknowledged once its resourceVersion is processed, which the pipeline holds back while
+    events before it are held, along with the ones received before it. `before_save` is called
+    before acknowledging, to write out events the resourceVersion covers.
+    """
+
+    shard: int
+    bookmarks: 'OrderedDict[str, None]'
+
+    def __init__(
+        self,
+        directory: Path,
+        interval_sec: float,
+        shard: int,
+        output_queue: multiprocessing.Queue,
+        before_save: Optional[Callable[[], None]] = None,
+    ):
+        """Send acknowledgements to `output_queue`, as `(shard, resourceVersion)`."""
+        super().__init__(directory, interval_sec, before_save)
+        self.shard = shard
+        self.output_queue = output_queue
+        self.bookmarks = OrderedDict()
+        # Bookmarks are received and processed by different threads in the async pipeline.
+        self._lock = threading.Lock()
+
+    def load(self) -> Optional[str]:
+        """Return None, the supervisor's checkpoint is the one the watch resumes from."""
+        return None
+
+    def receive_bookmark(self, resource_version: str):
+        """Remember the resourceVersion of a bookmark, to acknowledge once it's processed."""
+        with self._lock:
+            self.bookmarks[resource_version] = None
+
+    def update(self, resource_version: str):
+        """Record a processed resourceVersion, acknowledging it if the supervisor asked for it."""
+        self.resource_version = resource_version
+        with self._lock:
+            if resource_version not in self.bookmarks:
+                return
+            # Bookmarks received before it are covered by it.
+            while self.bookmarks.popitem(last=False)[0] != resource_version:
+                pass
+        self.save()
+
+    def save(self):
+        """Write out events processed so far, and acknowledge their resourceVersion."""
+        if self.resource_version is None or self.resource_version == self.saved_resource_version:
+            return
+        if self.before_save is not None:
+            self.before_save()
+        self.output_queue.put((self.shard, self.resource_version))
+        self.saved_resource_version = self.resource_version
+
+    def clear(self):
+        """Forget the resourceVersion."""
+        self.resource_version = None
+        self.saved_resource_version = None
+
+
+def receive_events(
+    input_queue: multiprocessing.Queue, checkpoint: ShardCheckpoint,
+) -> Iterator[WatchedEvent]:
+    """
+    Yield events the supervisor routed to a worker, parsed, until it ends the watch.
+
+    Bookmarks are the supervisor's requests to acknowledge their resourceVersion, once the events
+    before them are processed.
+    """
+    while True:
+        item: Optional[RoutedEvent] = input_queue.get()
+        if item is None:
+            return
+        if isinstance(item, WatchedEvent):
+            event = item
+        else:
+            event = parse_event(*item)
+        if event.type == BOOKMARK:
+            checkpoint.receive_bookmark(event.obj['metadata']['resourceVersion'])
+        yield event
+
+
+class MergedOutput:
+    """A file-like object, passing batches of lines written by a worker to the supervisor."""
+
+    def __init__(self, output_queue: multiprocessing.Queue):
+        """Send lines to `output_queue`."""
+        self.output_queue = output_queue
+
+    def write(self, data: bytes):
+        """Pass on lines, without the trailing newline, which the supervisor adds back."""
+        self.output_queue.put(data[:-1])
+
+    def flush(self):
+        """Do nothing, the supervisor flushes the destination."""
+
+    def close(self):
+        """Do nothing, the supervisor closes the destination."""
+
+    def fileno(self):
+        """Refuse fsyncs, which are the supervisor's job."""
+        raise OSError('Merged shard output has no file descriptor')
+
+
+class ShardSupervisor:
+    """
+    Routes watched events to a worker process per shard and, if output is merged, writes them out.
+
+    Events are watched once, and only peeked at, for the namespace to route them by and the
+    resourceVersion, see `peek_event`. They're passed on as JSON, to be parsed, deduplicated and
+    encoded by the worker of their namespace's shard. Every `checkpoint.interval_sec`, a bookmark
+    is sent to all workers, and its resourceVersion is checkpointed once they all acknowledge it,
+    or a later one, so it's only saved once events up to it have been written out.
+
+    If a worker dies, the remaining workers are stopped and the supervisor exits with an error.
+    SIGUSR1 and SIGUSR2 are passed on to the workers, after calling the handlers set before, e.g.
+    profiling the supervisor.
+    """
+
+    worker: Callable
+    assignment: ShardAssignment
+    destination: Optional[Destination]
+    checkpoint: ResourceVersionCheckpoint
+    processes: List[BaseProcess]
+    watch_error: Optional[BaseException]
+    syncs: 'OrderedDict[str, Set[int]]'
+    sync_at: float
+
+    def __init__(
+        self,
+        worker: Callable,
+        assignment: ShardAssignment,
+        destination: Optional[Destination],
+        checkpoint: ResourceVersionCheckpoint,
+        queue_size: int,
+    ):
+        """
+        Prepare to run `worker(shard, input_queue, output_queue)` for each shard.
+
+        Workers receive events from `input_queue`, which holds up to `queue_size` of them, until
+        they receive None, at the end of the watch. They send acknowledgements to `output_queue`,
+        and their output too, if `destination` is given, which means output is merged.
+        """
+        self.worker = worker
+        self.assignment = assignment
+        self.destination = destination
+        self.checkpoint = checkpoint
+        # Spawned rather than forked, since the destination flusher thread is already running.
+        self.context = multiprocessing.get_context('spawn')
+        # Bounded, so a lagging worker applies backpressure to the watch.
+        self.input_queues = [
+            self.context.Queue(queue_size) for _ in range(assignment.shard_count)]
+        self.output_queue = self.context.Queue()
+        self.processes = []
+        self.signal_handlers: Dict[int, Callable] = {}
+        self.watch_ended = threading.Event()
+        self.watch_error = None
+        # Bookmarks sent to the workers, with the shards which acknowledged them.
+        self.syncs = OrderedDict()
+        self.sync_lock = threading.Lock()
+        self.sync_at = time.monotonic() + checkpoint.interval_sec
+
+    def run(self, events: Iterator[WatchedEvent]):
+        """
+        Start the workers, and route events to them until terminated or the watch ends.
+
+        Errors of the watch are raised once the workers have written out the events they received.
+        """
+        for shard, input_queue in enumerate(self.input_queues):
+            process = self.context.Process(
+                target=self.worker, args=(shard, input_queue, self.output_queue),
+                name=f'shard-{shard}')
+            process.start()
+            log.info('Started shard %s worker, pid %s', shard, process.pid)
+            self.processes.append(process)
+
+        signal.signal(signal.SIGHUP, self._reopen)
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            handler = signal.getsignal(signum)
+            if callable(handler):
+                self.signal_handlers[signum] = handler
+            signal.signal(signum, self._forward)
+        threading.Thread(target=self._route, args=(events,), name='watcher', daemon=True).start()
+        try:
+            while True:
+                self._write_output(timeout=WORKER_POLL_INTERVAL_SEC)
+                stopped = [p for p in self.processes if not p.is_alive()]
+                # Workers only exit by themselves, successfully, once the watch ended.
+                dead = [p for p in stopped if p.exitcode or not self.watch_ended.is_set()]
+                if dead or len(stopped) == len(self.processes):
+                    break
+        except (SystemExit, KeyboardInterrupt):
+            log.info('Terminating shard workers')
+            self._stop()
+            raise
+
+        if not dead:
+            self._write_output(timeout=0.1)
+            if self.watch_error is not None:
+                raise self.watch_error
+            return
+        for dead_process in dead:
+            log.error('Worker %s exited with %s', dead_process.name, dead_process.exitcode)
+        self._stop()
+        sys.exit(1)
+
+    def _route(self, events: Iterator[WatchedEvent]):
+        """Pass events to the workers of their shards, in a thread, and ask them to sync."""
+        resource_version = synced_version = None
+        try:
+            for event in events:
+                if event.type != BOOKMARK:
+                    routed: RoutedEvent = (
+                        event if event.data is None else (event.type, event.data))
+                    self.input_queues[self.assignment.event_shard(event.obj)].put(routed)
+                resource_version = event.obj['metadata']['resourceVersion']
+                if resource_version != synced_version and time.monotonic() >= self.sync_at:
+                    self._sync(resource_version)
+                    synced_version = resource_version
+        except BaseException as e:
+            self.watch_error = e
+        self.watch_ended.set()
+        # Events received before the watch ended are checkpointed once written out.
+        if resource_version is not None and resource_version != synced_version:
+            self._sync(resource_version)
+        for input_queue in self.input_queues:
+            input_queue.put(None)
+
+    def _sync(self, resource_version: str):
+        """Ask all workers to acknowledge the resourceVersion, once events before it are written."""
+        with self.sync_lock:
+            self.syncs[resource_version] = set()
+            if len(self.syncs) > MAX_PENDING_SYNCS:
+                self.syncs.popitem(last=False)
+            self.sync_at = time.monotonic() + self.checkpoint.interval_sec
+        bookmark = WatchedEvent(BOOKMARK, {'metadata': {'resourceVersion': resource_version}}, None)
+        for input_queue in self.input_queues:
+            input_queue.put(bookmark)
+
+    def _acknowledge(self, shard: int, resource_version: str):
+        """Checkpoint the latest resourceVersion all workers acknowledged, or a later one."""
+        with self.sync_lock:
+            if resource_version not in self.syncs:
+                return
+            for synced_version, shards in self.syncs.items():
+                shards.add(shard)
+                if synced_version == resource_version:
+                    break
+            acknowledged = None
+            while self.syncs and len(next(iter(self.syncs.values()))) == len(self.processes):
+                acknowledged, _ = self.syncs.popitem(last=False)
+        if acknowledged is not None:
+            self.checkpoint.update(acknowledged)
+            self.checkpoint.save()
+
+    def _reopen(self, signum, frame):
+        sys.stderr.write('Caught SIGHUP. Passing it on to reopen destination files.\n')
+        if self.destination is not None:
+            self.destination.request_reopen()
+        else:
+            for process in self.processes:
+                if process.pid is not None:
+                    os.kill(process.pid, signal.SIGHUP)
+
+    def _forward(self, signum, frame):
+        handler = self.signal_handlers.get(signum)
+        if handler is not None:
+            handler(signum, frame)
+        sys.stderr.write(f'Caught signal {signum}. Passing it on to shard workers.\n')
+        for process in self.processes:
+            if process.pid is not None:
+                os.kill(process.pid, signum)
+
+    def _stop(self):
+        """Terminate the workers, writing out what they output before exiting."""
+        for process, input_queue in zip(self.processes, self.input_queues):
+            # Events the worker won't receive are replayed after the checkpoint on restart.
+            input_queue.cancel_join_thread()
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT_SEC
+        while any(p.is_alive() for p in self.processes) and time.monotonic() < deadline:
+            self._write_output(timeout=0.1)
+        for process in self.processes:
+            if process.is_alive():
+                log.error('Worker %s did not stop in time, killing it', process.name)
+                # Not `process.kill()`, which needs Python 3.7.
+                os.kill(process.pid, signal.SIGKILL)  # type: ignore
+            process.join()
+        self._write_output(timeout=0.1)
+
+    def _write_output(self, timeout: float):
+        """Write out output of the workers and handle acknowledgements, waiting up to `timeout`."""
+        try:
+            item = self.output_queue.get(timeout=timeout)
+            while True:
+                if isinstance(item, tuple):
+                    self._acknowledge(*item)
+                else:
+                    # Batches of lines, without the last newline.
+                    self.destination.write(item, lines=item.count(b'\n') + 1)  # type: ignore
+                item = self.output_queue.get_nowait()
+        except queue.Empty:
+            pass
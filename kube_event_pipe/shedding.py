@@ -0,0 +1,122 @@
+"""Shedding low-priority events when the pipeline falls behind the watch."""
+import time
+import logging
+from collections import Counter
+from typing import Dict, FrozenSet, Optional
+from kube_event_pipe import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+# Levels of shedding, each entered at twice the lag of the previous one.
+LEVEL_NONE = 0
+LEVEL_NOISY = 1
+LEVEL_SAMPLE = 2
+LEVEL_NORMAL = 3
+LEVEL_DESCRIPTIONS = {
+    LEVEL_NONE: 'nothing',
+    LEVEL_NOISY: 'Normal events of noisy reasons',
+    LEVEL_SAMPLE: 'Normal events of noisy reasons, and sampling other Normal events',
+    LEVEL_NORMAL: 'all Normal events',
+}
+
+# Weight of each event's lag in the smoothed lag.
+LAG_SMOOTHING = 0.05
+DEFAULT_SUMMARY_INTERVAL_SEC = 60.0
+
+
+class LoadShedder:
+    """
+    Decides which new events to drop while the pipeline lags behind the watch.
+
+    The lag is how long events waited between being read from the watch and being deduplicated,
+    passed to `update` and smoothed over recent events. Events read long after they occurred, e.g.
+    when relisting, don't lag unless they wait. Shedding starts at `lag_sec` and goes through
+    levels, each entered at twice the lag of the previous one:
+
+    1. Normal events of `noisy_reasons` are dropped.
+    2. One in `sample` other Normal events is kept, per reason.
+    3. All Normal events are dropped.
+
+    A level is left once the lag falls under half the lag it was entered at. Events of other
+    types, i.e. Warnings, are always kept. Shed events are counted by reason, and the counts are
+    logged every `summary_interval_sec`.
+    """
+
+    lag_sec: float
+    noisy_reasons: FrozenSet[str]
+    sample: int
+    summary_interval_sec: float
+    level: int
+    lag: Optional[float]
+    shed: 'Counter[str]'
+    sampled: Dict[str, int]
+    summary_at: float
+
+    def __init__(
+        self,
+        lag_sec: float,
+        noisy_reasons: FrozenSet[str] = frozenset(),
+        sample: int = 10,
+        summary_interval_sec: float = DEFAULT_SUMMARY_INTERVAL_SEC,
+    ):
+        """Shed events once they wait `lag_sec` to be deduplicated, on average."""
+        self.lag_sec = lag_sec
+        self.noisy_reasons = noisy_reasons
+        self.sample = sample
+        self.summary_interval_sec = summary_interval_sec
+        self.level = LEVEL_NONE
+        self.lag = None
+        self.shed = Counter()
+        self.sampled = {}
+        self.summary_at = time.monotonic() + summary_interval_sec
+
+    def __call__(self, event_obj: dict) -> bool:
+        """Return whether to drop a new event, at the current level of shedding."""
+        if self.level == LEVEL_NONE or event_obj.get('type') != 'Normal':
+            return False
+        reason = event_obj.get('reason') or ''
+        if self.level == LEVEL_SAMPLE and reason not in self.noisy_reasons:
+            sampled = self.sampled.get(reason, 0)
+            self.sampled[reason] = sampled + 1
+            if sampled % self.sample == 0:
+                return False
+        elif self.level == LEVEL_NOISY and reason not in self.noisy_reasons:
+            return False
+
+        self.shed[reason] += 1
+        metrics.EVENTS_SHED.inc()
+        return True
+
+    def update(self, lag: float):
+        """Smooth the lag of an event into the lag, and change the level of shedding if needed."""
+        if time.monotonic() >= self.summary_at:
+            self.log_summary()
+        self.lag = lag if self.lag is None else self.lag + LAG_SMOOTHING * (lag - self.lag)
+        level = self.level
+        while level < LEVEL_NORMAL and self.lag >= self.lag_sec * 2 ** level:
+            level += 1
+        while level > LEVEL_NONE and self.lag < self.lag_sec * 2 ** (level - 1) / 2:
+            level -= 1
+        if level == self.level:
+            return
+        if level > self.level:
+            log.warning('Lagging %.1fs behind the watch, shedding %s',
+                        self.lag, LEVEL_DESCRIPTIONS[level])
+        else:
+            log.info('Lagging %.1fs behind the watch, now shedding %s',
+                     self.lag, LEVEL_DESCRIPTIONS[level])
+        self.level = level
+        self.sampled.clear()
+
+    def log_summary(self):
+        """Log the number of events shed since the last summary, by reason."""
+        self.summary_at = time.monotonic() + self.summary_interval_sec
+        if not self.shed:
+            return
+        log.warning('Shed %s events, lagging %.1fs behind the watch: %s',
+                    sum(self.shed.values()), self.lag or 0.0,
+                    ', '.join(f'{reason or "-"}: {count}'
+                              for reason, count in self.shed.most_common()))
+        self.shed.clear()
@@ -0,0 +1,323 @@
+"""Event watching, resumed from a checkpointed resourceVersion."""
+import re
+import time
+import logging
+import threading
+from calendar import timegm
+from http import HTTPStatus
+from http.client import HTTPException
+from typing import Dict, Generator, Iterator, NamedTuple, Optional, Tuple, Type
+from kube_event_pipe import metrics
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.kube_client import ApiError, KubeClient
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore
+
+
+log = logging.getLogger(__name__)
+
+
+BOOKMARK = 'BOOKMARK'
+LIST_PAGE_SIZE = 500
+RETRY_DELAY_SEC = 1
+MAX_RETRY_DELAY_SEC = 30
+# Fields of the object's metadata events are routed by, see `peek_event`.
+ROUTING_FIELDS = re.compile(rb'"(namespace|resourceVersion)":"([^"]*)"')
+WATCH_LINE_PREFIX = b'{"type":"'
+# Responses of an overloaded or restarting API server, retried like connection failures.
+RETRIED_STATUSES = frozenset({
+    HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT,
+})
+
+
+class WatchedEvent(NamedTuple):
+    """
+    A watch event: its type, the event object, and, if available, the object as JSON.
+
+    Bookmarks only have `metadata.resourceVersion` set.
+    """
+
+    type: str
+    obj: dict
+    data: Optional[bytes]
+
+
+def watch_events(
+    kube_api,
+    checkpoint: ResourceVersionCheckpoint,
+    raw: bool = False,
+    field_selector: Optional[str] = None,
+    label_selector: Optional[str] = None,
+    stop: Optional[threading.Event] = None,
+    parse: bool = True,
+) -> Iterator[WatchedEvent]:
+    """
+    Watch events for all namespaces, starting from the checkpointed resourceVersion.
+
+    Without a resourceVersion, all existing events are listed first, and watched from the
+    resourceVersion of the list. That only happens on the first run, or when the API server
+    responds with 410 Gone, because the resourceVersion is too old. Bookmarks keep the
+    resourceVersion fresh while no events happen, and are yielded to be checkpointed. When the
+    connection fails, or the API server responds with 429, 500, 503 or 504, the watch resumes from
+    the most recent resourceVersion, after a growing delay, or the one asked for by Retry-After.
+
+    If `raw` is true, the kubernetes client's models aren't used and events are yielded with their
+    original JSON. `kube_api` is either the kubernetes client's CoreV1Api or a KubeClient, which
+    only supports raw watches. Field and label selectors are passed to the API server. If `parse`
+    is false, raw watch events are only peeked at, see `peek_event`.
+
+    The watch ends once `stop` is set, after the next event, or when the connection is closed,
+    e.g. by `KubeClient.interrupt`.
+    """
+    selectors = {}
+    if field_selector:
+        selectors['field_selector'] = field_selector
+    if label_selector:
+        selectors['label_selector'] = label_selector
+    resource_version = checkpoint.resource_version
+    retry_delay = RETRY_DELAY_SEC
+    errors = connection_errors(kube_api)
+    delay: float
+    while True:
+        try:
+            if resource_version is None:
+                resource_version = yield from relist(kube_api, **selectors)
+            log.info('Watching from resourceVersion %s', resource_version)
+            if raw:
+                stream = stream_raw(kube_api, resource_version, stop, parse, **selectors)
+            else:
+                stream = stream_models(kube_api, resource_version, **selectors)
+            for event in stream:
+                resource_version = event.obj['metadata']['resourceVersion']
+                retry_delay = RETRY_DELAY_SEC
+                yield event
+                if stop is not None and stop.is_set():
+                    return
+            return
+        except errors as e:
+            if stop is not None and stop.is_set():
+                return
+            log.warning('Watch connection failed, retrying in %ss: %r', retry_delay, e)
+            delay = retry_delay
+        except Exception as e:
+            # Either the kubernetes client's ApiException or ApiError.
+            status = getattr(e, 'status', None)
+            if status == HTTPStatus.GONE:
+                log.warning('resourceVersion %s is gone, falling back to a full list',
+                            resource_version)
+                resource_version = None
+                checkpoint.clear()
+                continue
+            if status not in RETRIED_STATUSES:
+                raise
+            delay = retry_delay
+            if status == HTTPStatus.TOO_MANY_REQUESTS:
+                delay = retry_after(e) or delay
+            log.warning('API server responded with %s, retrying in %ss: %s', status, delay, e)
+
+        if stop is None:
+            time.sleep(delay)
+        elif stop.wait(delay):
+            return
+        retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY_SEC)
+        metrics.WATCH_RECONNECTS.inc()
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Return the delay in seconds the Retry-After header of an error response asks for, if any."""
+    # Both ApiError and the kubernetes client's ApiException have the response headers, if any.
+    headers = getattr(error, 'headers', None) or {}
+    value = next((value for name, value in headers.items() if name.lower() == 'retry-after'), None)
+    # An HTTP date instead of seconds isn't supported.
+    if value is None or not value.strip().isdigit():
+        return None
+    return float(value)
+
+
+def connection_errors(kube_api) -> Tuple[Type[Exception], ...]:
+    """Return the exceptions the client raises when the connection fails."""
+    if isinstance(kube_api, KubeClient):
+        return (OSError, HTTPException)
+    # Imported by the kubernetes client anyway.
+    from urllib3.exceptions import HTTPError
+    return (OSError, HTTPException, HTTPError)
+
+
+def relist(kube_api, **selectors: str) -> Generator[WatchedEvent, None, str]:
+    """
+    List all events in pages, as ADDED, return the resourceVersion to watch from.
+
+    Relists are counted and timed, including the time taken to process the listed events.
+    """
+    log.info('Listing all events')
+    metrics.WATCH_RELISTS.inc()
+    start = time.monotonic()
+    count = 0
+    kwargs: Dict[str, Optional[str]] = {}
+    while True:
+        response = kube_api.list_event_for_all_namespaces(
+            limit=LIST_PAGE_SIZE, _preload_content=False, **selectors, **kwargs)
+        try:
+            event_list = json_loads(response.data)
+        finally:
+            response.close()
+            response.release_conn()
+        for obj in event_list['items']:
+            # Unlike watched objects, listed ones don't have their kind set.
+            yield WatchedEvent('ADDED', {'kind': 'Event', 'apiVersion': 'v1', **obj}, None)
+        count += len(event_list['items'])
+        kwargs['_continue'] = event_list['metadata'].get('continue')
+        if not kwargs['_continue']:
+            break
+
+    duration = time.monotonic() - start
+    metrics.WATCH_RELIST_DURATION.observe(duration)
+    resource_version = event_list['metadata']['resourceVersion']
+    log.info('Listed %s events in %.3fs, at resourceVersion %s', count, duration, resource_version)
+    return resource_version
+
+
+def stream_models(kube_api, resource_version: str, **selectors: str) -> Iterator[WatchedEvent]:
+    """
+    Watch events with the kubernetes client's Watch, which parses them with the json module.
+
+    Objects aren't deserialized into V1Event, since only their JSON is used, and bookmarks can't
+    be.
+    """
+    from kubernetes import watch  # type: ignore
+
+    # A new Watch every time, so it doesn't reconnect with an expired resourceVersion.
+    watcher = watch.Watch(return_type='object')
+    for event in watcher.stream(
+        kube_api.list_event_for_all_namespaces,
+        resource_version=resource_version,
+        allow_watch_bookmarks=True,
+        **selectors,
+    ):
+        yield WatchedEvent(event['type'], event['raw_object'], None)
+
+
+def stream_raw(
+    kube_api,
+    resource_version: Optional[str],
+    stop: Optional[threading.Event] = None,
+    parse: bool = True,
+    **selectors: str,
+) -> Iterator[WatchedEvent]:
+    """
+    Watch events, parsing the response lines directly, without creating V1Event objects.
+
+    Reconnects from the last seen resourceVersion, possibly of a bookmark, when the API server
+    closes the watch, unless `stop` is set. If `parse` is false, events are only peeked at, see
+    `peek_event`, unless they don't look like the API server encoded them.
+
+    :raise: ApiError, when the API server responds with an ERROR event.
+    """
+    while True:
+        response = kube_api.list_event_for_all_namespaces(
+            watch=True, resource_version=resource_version, allow_watch_bookmarks=True,
+            _preload_content=False, **selectors)
+        try:
+            for line in iter_lines(response):
+                if not parse:
+                    peeked = peek_event(line)
+                    if peeked is not None:
+                        resource_version = peeked.obj['metadata']['resourceVersion']
+                        yield peeked
+                        continue
+                event = json_loads(line)
+                event_type = event['type']
+                obj = event['object']
+                if event_type == 'ERROR':
+                    raise ApiError(obj['code'], f"{obj['reason']}: {obj['message']}")
+                resource_version = obj['metadata']['resourceVersion']
+                yield WatchedEvent(event_type, obj, extract_object(line, event_type))
+        finally:
+            response.close()
+            response.release_conn()
+        if stop is not None and stop.is_set():
+            return
+        log.debug('Watch closed by the API server, reconnecting')
+        metrics.WATCH_RECONNECTS.inc()
+
+
+def peek_event(line: bytes) -> Optional[WatchedEvent]:
+    """
+    Return a watch event with only the namespace and resourceVersion of the object, and its JSON.
+
+    Only the first occurrences of the fields are searched for, which are the object's own, since
+    the API server encodes metadata before other fields, and the namespace and resourceVersion
+    before labels and annotations. Return None for errors and lines which don't look like the API
+    server encoded them, to parse them instead. Objects are parsed with `parse_event`.
+    """
+    if not line.startswith(WATCH_LINE_PREFIX):
+        return None
+    event_type = line[len(WATCH_LINE_PREFIX):line.find(b'"', len(WATCH_LINE_PREFIX))].decode()
+    if event_type == 'ERROR':
+        return None
+    data = extract_object(line, event_type)
+    if data is None:
+        return None
+    metadata: Dict[str, str] = {}
+    for match in ROUTING_FIELDS.finditer(data):
+        metadata.setdefault(match.group(1).decode(), match.group(2).decode())
+        if 'resourceVersion' in metadata:
+            return WatchedEvent(event_type, {'metadata': metadata}, data)
+    return None
+
+
+def parse_event(event_type: str, data: bytes) -> WatchedEvent:
+    """Return a watch event with the object parsed from its JSON, e.g. of an event peeked at."""
+    return WatchedEvent(event_type, json_loads(data), data)
+
+
+def event_timestamp(event_obj: dict) -> Optional[str]:
+    """Return the timestamp the event last occurred at, as formatted by the API server."""
+    return (
+        event_obj.get('lastTimestamp') or event_obj.get('eventTime')
+        or event_obj['metadata'].get('creationTimestamp')
+    )
+
+
+def event_time(event_obj: dict) -> Optional[float]:
+    """Return the Unix time the event last occurred at, to a second, if it's known."""
+    timestamp = event_timestamp(event_obj)
+    if not timestamp:
+        return None
+    # Timestamps are UTC, formatted as `2006-01-02T15:04:05Z`, with microseconds for eventTime.
+    try:
+        return timegm((
+            int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+            int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+        ))
+    except ValueError:
+        return None
+
+
+def iter_lines(response) -> Iterator[bytes]:
+    """Split a chunked HTTP response into non-empty lines, without decoding."""
+    pending = b''
+    for chunk in response.read_chunked(decode_content=False):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+
+
+def extract_object(line: bytes, event_type: str) -> Optional[bytes]:
+    """
+    Slice the event object out of a watch event line, to write it without re-encoding.
+
+    The API server encodes watch events as `{"type":"<type>","object":<object>}`. If the line
+    doesn't look like that, return None.
+    """
+    prefix = b'{"type":"%s","object":' % event_type.encode()
+    line = line.rstrip()
+    if line.startswith(prefix) and line.endswith(b'}'):
+        return line[len(prefix):-1]
+    return None
@@ -0,0 +1,260 @@
+"""
+Inspecting and combining directories of the batched engine's bloom filters.
+
+Usage: `kube-event-pipe state {inspect,merge,compact,convert} ...`. Filters must not be in use,
+i.e. kube-event-pipe must be stopped.
+"""
+import time
+import shutil
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from kube_event_pipe.batched_bloom_filter import (  # type: ignore
+    Filter, create_filter, find_filter_files, open_filter,
+)
+from kube_event_pipe.identity import read_identity_file, write_identity_file
+
+
+log = logging.getLogger(__name__)
+
+
+class FilterReport(NamedTuple):
+    """Parameters and occupancy of a bloom filter file."""
+
+    file: str
+    capacity: int
+    error_rate: float
+    num_bits: int
+    num_hashes: int
+    fill_ratio: float
+    false_positive_rate: float
+    approx_len: int
+
+
+def filter_name(timestamp: int, position: int) -> str:
+    """Name a filter file, `<unix_timestamp>.bloom`, or `<unix_timestamp>.<n>.bloom` if chained."""
+    return f'{timestamp}.{position}.bloom' if position else f'{timestamp}.bloom'
+
+
+def sorted_batches(directory: Path) -> List[Tuple[int, List[Path]]]:
+    """Return batch timestamps and paths of their filters in order, oldest first."""
+    return [
+        (timestamp, [path for _, path in sorted(positions.items())])
+        for timestamp, positions in sorted(find_filter_files(directory).items())
+    ]
+
+
+def compatible(bf: Filter, other: Filter) -> bool:
+    """Return whether filters set the same bits for the same elements, so they can be OR-ed."""
+    return (
+        bf.capacity == other.capacity and bf.error_rate == other.error_rate
+        and bf.num_bits == other.num_bits and list(bf.hash_seeds) == list(other.hash_seeds)
+    )
+
+
+def union_false_positive_rate(bf: Filter, other: Filter) -> float:
+    """Estimate the false positive rate of the union of compatible filters, from their bits set."""
+    fill_ratio = 1 - (1 - bf.bit_count / bf.num_bits) * (1 - other.bit_count / other.num_bits)
+    return fill_ratio ** bf.num_hashes
+
+
+def inspect(directory: Path) -> List[FilterReport]:
+    """Report on filters in the directory, oldest first."""
+    reports = []
+    for _, paths in sorted_batches(directory):
+        for path in paths:
+            bf = open_filter(path, 'r')
+            try:
+                fill_ratio = bf.bit_count / bf.num_bits
+                reports.append(FilterReport(
+                    file=path.name,
+                    capacity=bf.capacity,
+                    error_rate=bf.error_rate,
+                    num_bits=bf.num_bits,
+                    num_hashes=bf.num_hashes,
+                    fill_ratio=fill_ratio,
+                    false_positive_rate=fill_ratio ** bf.num_hashes,
+                    approx_len=bf.approx_len,
+                ))
+            finally:
+                bf.close()
+    return reports
+
+
+def merge(sources: Sequence[Path], target: Path) -> int:
+    """
+    Merge filters of the source directories into the target one, return the number of filters.
+
+    The n-th most recent batches of all sources are merged into one, with the timestamp of the
+    most recent of them, so no events are forgotten sooner than they would have been. Compatible
+    filters in it, e.g. copies of one filter which diverged, are OR-ed, others are chained.
+
+    :raise: ValueError, if the target directory already has filters, or the sources were written
+        with different identity strategies.
+    """
+    if find_filter_files(target):
+        raise ValueError(f'{target} already has filters, merge them into another directory')
+    recorded = [read_identity_file(source) for source in sources]
+    identities = {strategy for strategy, _ in recorded if strategy is not None}
+    if len(identities) > 1:
+        # Events would be looked up by one identity in filters of another, and written again.
+        raise ValueError(
+            f'Sources were written with different identities: {", ".join(sorted(identities))}')
+
+    ranked: List[List[Tuple[int, List[Path]]]] = []
+    for source in sources:
+        for rank, batch in enumerate(reversed(sorted_batches(source))):
+            if rank == len(ranked):
+                ranked.append([])
+            ranked[rank].append(batch)
+
+    count = 0
+    for batches in ranked:
+        timestamp = max(timestamp for timestamp, _ in batches)
+        merged: List[Filter] = []
+        try:
+            for _, paths in batches:
+                for path in paths:
+                    _merge_filter(path, merged, target, timestamp)
+        finally:
+            for bf in merged:
+                bf.close()
+        log.info('Merged %s filters into %s filters of batch %s',
+                 sum(len(paths) for _, paths in batches), len(merged), timestamp)
+        count += len(merged)
+
+    if identities:
+        # Merged filters may contain strings as long as any of the sources.
+        write_identity_file(
+            target, identities.pop(), max(legacy_until for _, legacy_until in recorded))
+    return count
+
+
+def _merge_filter(path: Path, merged: List[Filter], target: Path, timestamp: int):
+    source_bf = open_filter(path, 'r')
+    try:
+        for bf in merged:
+            if compatible(bf, source_bf):
+                bf.union(source_bf)
+                return
+    finally:
+        source_bf.close()
+    merged_path = target / filter_name(timestamp, len(merged))
+    shutil.copyfile(str(path), str(merged_path))
+    merged.append(open_filter(merged_path))
+
+
+def compact(directory: Path, max_error_rate: Optional[float] = None) -> int:
+    """
+    OR sparse filters into the ones of the next batch, return the number of filters removed.
+
+    Only batches of single filters are compacted, and the batch written to is left as it is. A
+    filter is merged into the next one if they are compatible and the estimated false positive
+    rate of their union stays under `max_error_rate`, the filters' error rate by default. Merged
+    events are then remembered as long as ones of the next batch.
+    """
+    removed = 0
+    previous: Optional[Filter] = None
+    try:
+        for _, paths in sorted_batches(directory)[:-1]:
+            bf = open_filter(paths[0]) if len(paths) == 1 else None
+            if previous is not None and bf is not None and compatible(previous, bf) and (
+                    union_false_positive_rate(previous, bf) <= (max_error_rate or bf.error_rate)):
+                bf.union(previous)
+                previous_path = Path(previous.filename)
+                previous.close()
+                previous_path.unlink()
+                log.info('Compacted %s into %s', previous_path.name, paths[0].name)
+                removed += 1
+            elif previous is not None:
+                previous.close()
+            previous = bf
+    finally:
+        if previous is not None:
+            previous.close()
+    return removed
+
+
+def convert(directory: Path, capacity: int, error_rate: float) -> Path:
+    """
+    Chain a filter of the capacity and error rate to the most recent batch, return its path.
+
+    Bits can't be hashed again without the events they were set for, so filters can't be
+    converted in place. New events are added to the chained filter, and the older ones are read
+    as they are, until their batches are rotated out. Without filters, a new batch is started.
+    Only this batch is converted, later ones are created with the configured capacity and error
+    rate.
+    """
+    batches = sorted_batches(directory)
+    if batches:
+        timestamp, paths = batches[-1]
+        path = directory / filter_name(timestamp, len(paths))
+    else:
+        path = directory / filter_name(int(time.time()), 0)
+    create_filter(capacity, error_rate, path).close()
+    log.info('Created %s, with capacity %s and error rate %s', path, capacity, error_rate)
+    return path
+
+
+def format_reports(reports: List[FilterReport]) -> List[str]:
+    """Format reports as a table."""
+    columns: Dict[str, List[str]] = {
+        'file': [report.file for report in reports],
+        'capacity': [str(report.capacity) for report in reports],
+        'error_rate': [f'{report.error_rate:g}' for report in reports],
+        'bits': [str(report.num_bits) for report in reports],
+        'hashes': [str(report.num_hashes) for report in reports],
+        'fill_ratio': [f'{report.fill_ratio:.4f}' for report in reports],
+        'est_fpr': [f'{report.false_positive_rate:.3g}' for report in reports],
+        'approx_len': [str(report.approx_len) for report in reports],
+    }
+    widths = [max(len(name), *map(len, values)) for name, values in columns.items()]
+    rows = [list(columns), *zip(*columns.values())]
+    return ['  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+            for row in rows]
+
+
+def main(argv: List[str]):
+    """Run the `state` command."""
+    parser = argparse.ArgumentParser(
+        prog='kube-event-pipe state', description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    inspect_parser = commands.add_parser(
+        'inspect', help='report the fill ratio and false positive rate of each filter')
+    inspect_parser.add_argument('directories', nargs='+', type=Path)
+    merge_parser = commands.add_parser(
+        'merge', help='merge filters of directories, e.g. of shards or after moving nodes')
+    merge_parser.add_argument('sources', nargs='+', type=Path)
+    merge_parser.add_argument('--into', type=Path, required=True, help='directory to merge into')
+    compact_parser = commands.add_parser(
+        'compact', help='OR sparse filters into the ones of later batches')
+    compact_parser.add_argument('directory', type=Path)
+    compact_parser.add_argument('--max-error-rate', type=float,
+                                help='of merged filters, by default their own error rate')
+    convert_parser = commands.add_parser(
+        'convert',
+        help='write new events of the current batch to a filter of another capacity and error '
+             'rate, later batches are created as configured')
+    convert_parser.add_argument('directory', type=Path)
+    convert_parser.add_argument('--capacity', type=int, required=True)
+    convert_parser.add_argument('--error-rate', type=float, required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == 'inspect':
+        for directory in args.directories:
+            print(f'{directory}:')
+            for line in format_reports(inspect(directory)):
+                print(f'  {line}')
+    elif args.command == 'merge':
+        args.into.mkdir(parents=True, exist_ok=True)
+        try:
+            merge(args.sources, args.into)
+        except ValueError as e:
+            log.error('%s', e)
+            exit(1)
+    elif args.command == 'compact':
+        log.info('Removed %s filters', compact(args.directory, args.max_error_rate))
+    else:
+        convert(args.directory, args.capacity, args.error_rate)
@@ -12,6 +12,9 @@ REQUIREMENTS = [
     'pybloomfiltermmap3==0.5.3',
     'requests==2.25.1',
 ]
+FAST_REQUIREMENTS = [
+    'orjson',
+]
 DEV_REQUIREMENTS = [
     'flake8',
     'flake8-docstrings',
@@ -48,6 +51,7 @@ if __name__ == '__main__':
         install_requires=REQUIREMENTS,
         extras_require={
             'dev': DEV_REQUIREMENTS,
+            'fast': FAST_REQUIREMENTS,
         },
         entry_points={
             'console_scripts': 'kube-event-pipe=kube_event_pipe.main:main'
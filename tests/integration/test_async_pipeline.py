@@ -0,0 +1,21 @@
+"""Test the asyncio pipeline."""
+from kube_event_pipe.main import ENV_ASYNC_PIPELINE, ENV_QUEUE_SIZE
+from tests.conftest import make_kube_event, KubeEventPipe
+
+
+def test_async_pipeline(kube_api, clean_kube, kube_event_pipe: KubeEventPipe) -> None:
+    """Test watching, deduplicating and writing events in separate stages."""
+    env = {ENV_ASYNC_PIPELINE: 'true', ENV_QUEUE_SIZE: '2'}
+    with kube_event_pipe(output_file_name='first.log', env=env) as event_pipe:
+        assert event_pipe.get_events() == [], 'Expecting clean state'
+        for _ in range(5):
+            make_kube_event(kube_api)
+        events = event_pipe.get_events(min_count=5)
+        assert len(events) == 5
+
+        event_pipe.rotate_output()
+        make_kube_event(kube_api)
+        assert len(event_pipe.get_events(min_count=1)) == 1
+
+    with kube_event_pipe(output_file_name='second.log', env=env) as event_pipe:
+        assert event_pipe.get_events() == [], 'Events written before should be skipped'
@@ -0,0 +1,20 @@
+"""Test the raw JSON fast path."""
+from kube_event_pipe.main import ENV_RAW_JSON
+from tests.conftest import make_kube_event, KubeEventPipe
+
+
+def test_raw_json(kube_api, clean_kube, kube_event_pipe: KubeEventPipe) -> None:
+    """Test that events written without V1Event deserialization are deduplicated the same way."""
+    with kube_event_pipe(output_file_name='first.log', env={ENV_RAW_JSON: 'true'}) as event_pipe:
+        assert event_pipe.get_events() == [], 'Expecting clean state'
+        event = make_kube_event(kube_api, name='raw-event', message='Raw event')
+        namespaced_event = (event.metadata.name, event.metadata.namespace)
+        for count in [2, 2, 3]:
+            kube_api.patch_namespaced_event(*namespaced_event, body={'count': count})
+
+        events = event_pipe.get_events(min_count=3)
+        assert [e['metadata']['name'] for e in events] == ['raw-event'] * 3
+        assert [e['message'] for e in events] == ['Raw event'] * 3
+
+    with kube_event_pipe(output_file_name='second.log') as event_pipe:
+        assert event_pipe.get_events() == [], 'Both modes should share the deduplication state'
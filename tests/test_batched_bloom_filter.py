@@ -40,3 +40,77 @@ def test_batched_bloom_filter_state_load(tmpdir_path: Path):
 
     assert len(filter_files_rotated) == 2
     assert filter_files_rotated[0] == filter_renamed
+
+
+def test_batched_bloom_filter_saturation_grow(tmpdir_path: Path):
+    """Test chaining larger filters to a saturated one, and loading them."""
+    bloom_filter: BatchedBloomFilter[str] = BatchedBloomFilter(
+        directory=tmpdir_path, **dict(params, filter_capacity=100), saturation_policy='grow',
+    )
+    for i in range(350):
+        bloom_filter.add(f'event-{i}')
+    capacities = [bf.capacity for bf in bloom_filter.batches[-1]]
+    bloom_filter.close()
+    assert capacities == [100, 200, 400]
+
+    ts = bloom_filter.last_batch_ts
+    assert sorted(p.name for p in tmpdir_path.glob('*.bloom')) == [
+        f'{ts}.1.bloom', f'{ts}.2.bloom', f'{ts}.bloom']
+
+    bloom_filter = BatchedBloomFilter(
+        directory=tmpdir_path, **dict(params, filter_capacity=100), saturation_policy='grow',
+    )
+    assert [bf.capacity for bf in bloom_filter.batches[-1]] == capacities
+    assert all(f'event-{i}' in bloom_filter for i in range(350))
+    bloom_filter.close()
+
+
+def test_batched_bloom_filter_saturation_rotate(tmpdir_path: Path):
+    """Test rotating early when the most recent filter is saturated."""
+    bloom_filter: BatchedBloomFilter[str] = BatchedBloomFilter(
+        directory=tmpdir_path, **dict(params, filter_capacity=100), saturation_policy='rotate',
+    )
+    for i in range(250):
+        bloom_filter.add(f'event-{i}')
+    assert len(bloom_filter.batches) == 3
+    assert bloom_filter.recent_filter_count == 50
+    bloom_filter.close()
+    assert len(list(tmpdir_path.glob('*.bloom'))) == 3
+
+
+def test_batched_bloom_filter_prepared_rotation(tmpdir_path: Path):
+    """Test rotating to the filter prepared in the background, and removing stale ones."""
+    bloom_filter: BatchedBloomFilter[str] = BatchedBloomFilter(
+        directory=tmpdir_path, **dict(params, batch_count=1),
+    )
+    first_path = Path(bloom_filter.recent_filter.filename)
+    bloom_filter.add('event')
+    bloom_filter._prepared.result()  # type: ignore
+    assert bloom_filter.prepared_path.exists()
+
+    bloom_filter.rotate_if_needed(force=True)
+    assert 'event' not in bloom_filter
+    bloom_filter.add('other-event')
+    # A new filter is being prepared.
+    bloom_filter._prepared.result()  # type: ignore
+    bloom_filter.close()
+
+    assert not first_path.exists()
+    assert not bloom_filter.prepared_path.exists()
+    assert [p.name for p in tmpdir_path.iterdir()] == [f'{bloom_filter.last_batch_ts}.bloom']
+
+
+def test_batched_bloom_filter_many(tmpdir_path: Path):
+    """Test looking up and adding batches, split over filters chained as they saturate."""
+    bloom_filter: BatchedBloomFilter[str] = BatchedBloomFilter(
+        directory=tmpdir_path, **dict(params, filter_capacity=100), saturation_policy='grow',
+    )
+    bloom_filter.add_many([f'event-{i}' for i in range(50)])
+    bloom_filter.rotate_if_needed(force=True)
+    bloom_filter.add_many([f'event-{i}' for i in range(50, 400)])
+    # Grown twice, to capacities of 200 and 400.
+    assert [bf.capacity for batch in bloom_filter.batches for bf in batch] == [100, 100, 200, 400]
+    assert bloom_filter.recent_filter_count == 50
+    assert bloom_filter.contains_many([f'event-{i}' for i in range(400)]) == [True] * 400
+    assert all(f'event-{i}' in bloom_filter for i in range(400))
+    bloom_filter.close()
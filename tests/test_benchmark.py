@@ -0,0 +1,61 @@
+"""Tests of the benchmark harness and its fake API server."""
+from pathlib import Path
+from itertools import islice
+from kubernetes import client  # type: ignore
+from benchmarks.fake_api_server import EventStream, EventStreamConfig, FakeApiServer
+from benchmarks.run import run_benchmark, percentile
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.source import watch_events
+
+
+def test_fake_api_server_watch(tmpdir_path: Path):
+    """Test watching events through reconnects and 410 Gone, with the kubernetes client."""
+    stream = EventStream(EventStreamConfig(
+        rate=10_000, total=50, payload_bytes=10, duplicate_ratio=0.2, reconnect_every=10,
+        gone_every=3,
+    ))
+    server = FakeApiServer(stream)
+    server.start()
+    try:
+        configuration = client.Configuration()
+        configuration.host = server.url
+        kube_api = client.CoreV1Api(client.ApiClient(configuration))
+        checkpoint = ResourceVersionCheckpoint(tmpdir_path, 0)
+        watched = []
+        for event in islice(watch_events(kube_api, checkpoint, raw=True), 200):
+            checkpoint.update(event.obj['metadata']['resourceVersion'])
+            watched.append(event)
+            if checkpoint.resource_version == '50':
+                break
+    finally:
+        server.stop()
+
+    # Relisting after 410 Gone sends some events again.
+    assert len(watched) > 50
+    assert {event.obj['metadata']['name'] for event in watched} == {
+        name for name, _ in stream.identities}
+    assert watched[0].obj['message'] == 'x' * 10
+    assert stream.watch_count >= 3
+
+
+def test_run_benchmark(tmpdir_path: Path):
+    """Test a short benchmark run."""
+    config = EventStreamConfig(
+        rate=1000, total=200, payload_bytes=100, duplicate_ratio=0.1, reconnect_every=0,
+        gone_every=0,
+    )
+    result = run_benchmark(config, {'KUBE_EVENT_PIPE_FLUSH_INTERVAL_SEC': '0.1'}, 60, tmpdir_path)
+    assert result.events_written == result.events_expected < 200
+    assert result.latency_p50_sec is not None and result.latency_p99_sec is not None
+    assert 0 < result.latency_p50_sec <= result.latency_p99_sec
+    assert result.events_per_sec > 0
+    assert result.cpu_sec > 0
+    assert result.max_rss_kib > 0
+
+
+def test_percentile():
+    """Test nearest-rank percentiles."""
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([], 0.5) is None
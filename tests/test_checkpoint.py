@@ -0,0 +1,70 @@
+"""In-process tests for resourceVersion checkpointing and resuming the watch."""
+import json
+from http import HTTPStatus
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List, Optional
+from kubernetes import watch  # type: ignore
+from kubernetes.client.rest import ApiException  # type: ignore
+from kube_event_pipe import source
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint, RESOURCE_VERSION_FILE_NAME
+
+
+def test_checkpoint_save_load(tmpdir_path: Path):
+    """Test saving and loading the resourceVersion, throttled by the interval."""
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    assert checkpoint.resource_version is None
+
+    checkpoint.update('1')
+    assert not (tmpdir_path / RESOURCE_VERSION_FILE_NAME).exists(), 'Saving should be throttled'
+
+    checkpoint.save()
+    assert ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600).resource_version == '1'
+
+    checkpoint.clear()
+    assert ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600).resource_version is None
+
+
+def test_checkpoint_save_interval(tmpdir_path: Path):
+    """Test saving the resourceVersion when the interval has passed."""
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    checkpoint.last_save_time -= 3600
+    checkpoint.update('2')
+    assert (tmpdir_path / RESOURCE_VERSION_FILE_NAME).read_text() == '2'
+
+
+def test_watch_resume_gone(tmpdir_path: Path, monkeypatch):
+    """Test resuming from the checkpoint, and relisting when the resourceVersion is gone."""
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    checkpoint.update('10')
+    checkpoint.save()
+
+    requested_versions: List[Optional[str]] = []
+    listed = {'metadata': {'name': 'a', 'resourceVersion': '15'}}
+    watched = {'metadata': {'name': 'b', 'resourceVersion': '21'}}
+
+    class FakeWatch:
+        def __init__(self, return_type=None):
+            assert return_type == 'object'
+
+        def stream(self, func, resource_version=None, **kwargs):
+            requested_versions.append(resource_version)
+            if resource_version == '10':
+                raise ApiException(status=HTTPStatus.GONE)
+            yield {'type': 'ADDED', 'raw_object': watched}
+
+    def list_event_for_all_namespaces(**kwargs):
+        assert 'watch' not in kwargs
+        data = json.dumps({'metadata': {'resourceVersion': '20'}, 'items': [listed]})
+        return SimpleNamespace(data=data, close=lambda: None, release_conn=lambda: None)
+
+    monkeypatch.setattr(watch, 'Watch', FakeWatch)
+    kube_api = SimpleNamespace(list_event_for_all_namespaces=list_event_for_all_namespaces)
+    events = list(source.watch_events(kube_api, checkpoint))
+
+    assert events == [
+        source.WatchedEvent('ADDED', {'kind': 'Event', 'apiVersion': 'v1', **listed}, None),
+        source.WatchedEvent('ADDED', watched, None),
+    ]
+    assert requested_versions == ['10', '20']
+    assert not (tmpdir_path / RESOURCE_VERSION_FILE_NAME).exists()
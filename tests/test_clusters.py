@@ -0,0 +1,61 @@
+"""Tests of watching many clusters in threads, writing to a shared destination."""
+import json
+import threading
+from pathlib import Path
+import pytest  # type: ignore
+from kube_event_pipe.clusters import (
+    ClusterDestination, ClusterSupervisor, cluster_persistence_path, parse_contexts, tag_cluster,
+)
+from kube_event_pipe.destination import Destination
+
+
+def test_parse_contexts():
+    """Test parsing contexts in order, without duplicates."""
+    assert parse_contexts('prod, staging,,prod') == ['prod', 'staging']
+    assert parse_contexts('') == []
+
+
+def test_cluster_persistence_path(tmpdir_path: Path):
+    """Test naming per-cluster directories after contexts."""
+    assert cluster_persistence_path(tmpdir_path, 'prod') == tmpdir_path / 'cluster-prod'
+    path = cluster_persistence_path(tmpdir_path, 'arn:aws:eks:eu-west-1:1234:cluster/prod')
+    assert path.name == 'cluster-arn_aws_eks_eu-west-1_1234_cluster_prod'
+    assert path.is_dir()
+
+
+def test_tag_cluster():
+    """Test adding the cluster field to JSON objects."""
+    tag = b'"cluster":"prod"'
+    assert json.loads(tag_cluster(b'{"kind":"Event"}', tag)) == {'cluster': 'prod', 'kind': 'Event'}
+    assert json.loads(tag_cluster(b'{ }', tag)) == {'cluster': 'prod'}
+
+
+def test_cluster_supervisor(tmpdir_path: Path):
+    """Test writing tagged events of all clusters, stopping them once one of them stops."""
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024 * 1024,
+        max_buffered_events=1000,
+    )
+
+    def watch(context: str, stopping: threading.Event):
+        cluster_destination = ClusterDestination(destination, context)
+        cluster_destination.write(b'{"event":1}')
+        if context == 'staging':
+            return
+        while not stopping.wait(0.01):
+            pass
+        cluster_destination.write(b'{"event":2}')
+        cluster_destination.close()
+
+    with pytest.raises(SystemExit):
+        ClusterSupervisor(watch, ['prod', 'staging']).run()
+    destination.close()
+
+    lines = [json.loads(line) for line in (tmpdir_path / 'events.log').read_text().splitlines()]
+    assert sorted(lines, key=lambda line: (line['cluster'], line['event'])) == [
+        {'cluster': 'prod', 'event': 1},
+        {'cluster': 'prod', 'event': 2},
+        {'cluster': 'staging', 'event': 1},
+    ]
@@ -0,0 +1,110 @@
+"""Tests of coalescing storms of events."""
+import json
+from typing import List
+import pytest  # type: ignore
+from kube_event_pipe import coalescing
+from kube_event_pipe.coalescing import Coalescer
+
+
+@pytest.fixture
+def clock(monkeypatch) -> List[float]:
+    """Control the monotonic time seen by coalescing."""
+    now = [1000.0]
+    monkeypatch.setattr(coalescing.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def event(name: str, count: int, reason: str = 'BackOff', pod: str = 'pod-a') -> dict:
+    """Make an event about a pod."""
+    return {
+        'metadata': {'name': f'{name}.{count}', 'resourceVersion': str(count)},
+        'involvedObject': {'kind': 'Pod', 'namespace': 'default', 'name': pod},
+        'reason': reason,
+        'count': count,
+        'message': f'Back-off restarting {count}',
+        'lastTimestamp': f'2020-01-01T00:00:{count:02}Z',
+    }
+
+
+def coalesce_all(coalesce: Coalescer, event_obj: dict) -> List[dict]:
+    """Pass a new event to coalesce, return parsed lines to write."""
+    return [
+        json.loads(data) for data, _, _ in coalesce(event_obj, json.dumps(event_obj).encode())]
+
+
+def test_coalesce_storm(clock: List[float]):
+    """Test writing the first event of a storm, then a summary per window."""
+    coalesce = Coalescer(window_sec=60)
+
+    [first] = coalesce_all(coalesce, event('a', 1))
+    assert 'coalesced' not in first
+    # Another reason, about the same object, is written too.
+    assert len(coalesce_all(coalesce, event('b', 1, reason='Failed'))) == 1
+
+    for count in range(2, 12):
+        clock[0] += 5
+        assert coalesce_all(coalesce, event('a', count)) == []
+
+    clock[0] += 10
+    [(data, occurred_at, event_count)] = coalesce.expired(clock[0])
+    assert coalesce(event('a', 12), None) == []
+    summary = json.loads(data)
+    assert summary['count'] == 11
+    assert summary['coalesced'] == {
+        'events': 10,
+        'countDelta': 10,
+        'firstTimestamp': '2020-01-01T00:00:02Z',
+        'lastTimestamp': '2020-01-01T00:00:11Z',
+        'sampleMessage': 'Back-off restarting 11',
+    }
+    assert event_count == 10
+    assert occurred_at == 1577836811
+
+    # The storm goes on, into the next window.
+    assert coalesce_all(coalesce, event('a', 12)) == []
+    [summary] = [json.loads(data) for data, _, _ in coalesce.drain()]
+    assert summary['coalesced']['events'] == 1
+    assert summary['coalesced']['countDelta'] == 1
+    assert coalesce.windows == {}
+
+
+def test_coalesce_quiet(clock: List[float]):
+    """Test writing events about an object as they are, if they are further apart than windows."""
+    coalesce = Coalescer(window_sec=60)
+    for count in range(1, 4):
+        # Windows without held events are closed without a summary.
+        assert coalesce.expired(clock[0]) == []
+        assert len(coalesce_all(coalesce, event('a', count))) == 1
+        clock[0] += 61
+    assert coalesce.drain() == []
+
+
+def test_coalesce_hold(clock: List[float]):
+    """Test releasing held events with their summary, and holding back the checkpoint."""
+    released: List[bytes] = []
+    coalesce = Coalescer(window_sec=60)
+    coalesce.on_release = released.extend
+
+    assert not coalesce.hold(event('a', 1), b'a1')
+    coalesce_all(coalesce, event('a', 1))
+    assert coalesce.resume_version('1') == '1'
+    for count in range(2, 4):
+        clock[0] += 5
+        assert coalesce.hold(event('a', count), b'a%d' % count)
+        assert coalesce_all(coalesce, event('a', count)) == []
+        # Held events are listed again after a crash, from the event before them.
+        assert coalesce.resume_version(str(count)) == '1'
+    assert released == []
+
+    # The window ends before the next held event is passed in, which is held in the next one.
+    assert coalesce.hold(event('a', 4), b'a4')
+    clock[0] += 60
+    [(data, _, _)] = coalesce.expired(clock[0])
+    assert json.loads(data)['coalesced']['events'] == 2
+    assert coalesce_all(coalesce, event('a', 4)) == []
+    assert released == [b'a2', b'a3']
+    assert coalesce.resume_version('4') == '3'
+
+    coalesce.drain()
+    assert released == [b'a2', b'a3', b'a4']
+    assert coalesce.resume_version('4') == '4'
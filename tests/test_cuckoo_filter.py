@@ -0,0 +1,86 @@
+"""In-process tests for SlidingCuckooFilter."""
+from pathlib import Path
+from typing import List
+import pytest  # type: ignore
+from kube_event_pipe import cuckoo_filter
+from kube_event_pipe.cuckoo_filter import SlidingCuckooFilter
+
+
+params: dict = {
+    'filter_capacity': 10000,
+    'filter_error_rate': 0.01,
+    'batch_count': 3,
+    'batch_duration_sec': 3600,
+}
+WINDOW_SEC = 3 * 3600
+
+
+@pytest.fixture
+def clock(monkeypatch) -> List[float]:
+    """Make the filter read the time from the returned list."""
+    now = [1_000_000_000.0]
+    monkeypatch.setattr(cuckoo_filter.time, 'time', lambda: now[0])
+    return now
+
+
+def test_cuckoo_filter_error_rate(tmpdir_path: Path):
+    """Test filling the filter to capacity, and reopening it."""
+    cuckoo: SlidingCuckooFilter[str] = SlidingCuckooFilter(directory=tmpdir_path, **params)
+    for i in range(30000):
+        cuckoo.add(f'seen-{i}')
+
+    assert all(f'seen-{i}' in cuckoo for i in range(30000))
+    false_positives = sum(f'unseen-{i}' in cuckoo for i in range(10000))
+    assert false_positives < 100
+    assert cuckoo.insert_failures == 0
+    cuckoo.close()
+
+    cuckoo = SlidingCuckooFilter(directory=tmpdir_path, **params)
+    assert 'seen-1' in cuckoo
+    cuckoo.close()
+
+
+def test_cuckoo_filter_sliding_window(tmpdir_path: Path, clock: List[float]):
+    """Test that elements expire a window after being added, regardless of when that was."""
+    cuckoo: SlidingCuckooFilter[str] = SlidingCuckooFilter(directory=tmpdir_path, **params)
+    cuckoo.add('early')
+    clock[0] += WINDOW_SEC / 2
+    cuckoo.add('late')
+
+    # Advance a tick at a time, sweeping incrementally.
+    for _ in range(cuckoo.window_ticks // 2):
+        clock[0] += cuckoo.tick_sec
+        assert 'late' in cuckoo
+    assert 'early' in cuckoo
+    clock[0] += 2 * cuckoo.tick_sec
+    assert 'early' not in cuckoo
+    assert 'late' in cuckoo
+
+    # Let tags wrap around.
+    for _ in range(cuckoo.window_ticks // 2):
+        clock[0] += cuckoo.tick_sec
+    for _ in range(2 * cuckoo.window_ticks):
+        clock[0] += cuckoo.tick_sec
+        assert 'late' not in cuckoo
+    assert not any(cuckoo.entries)
+    cuckoo.close()
+
+
+def test_cuckoo_filter_downtime(tmpdir_path: Path, clock: List[float]):
+    """Test expiring elements while the filter was closed."""
+    cuckoo: SlidingCuckooFilter[str] = SlidingCuckooFilter(directory=tmpdir_path, **params)
+    cuckoo.add('early')
+    clock[0] += WINDOW_SEC / 2
+    cuckoo.add('late')
+    cuckoo.close()
+
+    clock[0] += WINDOW_SEC * 0.75
+    cuckoo = SlidingCuckooFilter(directory=tmpdir_path, **params)
+    assert 'early' not in cuckoo
+    assert 'late' in cuckoo
+    cuckoo.close()
+
+    clock[0] += WINDOW_SEC * 10
+    cuckoo = SlidingCuckooFilter(directory=tmpdir_path, **params)
+    assert not any(cuckoo.entries)
+    cuckoo.close()
@@ -0,0 +1,128 @@
+"""In-process tests for the buffered destination."""
+from pathlib import Path
+from typing import Iterator
+import pytest  # type: ignore
+from kube_event_pipe import metrics
+from kube_event_pipe.destination import Destination, FSYNC_BATCH, FSYNC_GROUP
+from tests.wait import wait_until
+
+
+@pytest.fixture
+def destination(tmpdir_path: Path) -> Iterator[Destination]:
+    """Create a destination with a long flush interval, so only buffer limits trigger flushes."""
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024,
+        max_buffered_events=3,
+        fsync_policy=FSYNC_BATCH,
+    )
+    yield destination
+    destination.close()
+
+
+def test_flush_max_events(destination: Destination):
+    """Test flushing when the buffer reaches the maximum number of events."""
+    destination.write(b'{"a":1}')
+    destination.write(b'{"b":2}')
+    assert destination.path.read_bytes() == b''
+
+    destination.write(b'{"c":3}')
+    assert destination.path.read_bytes() == b'{"a":1}\n{"b":2}\n{"c":3}\n'
+    assert not destination.unsynced
+
+
+def test_flush_batches(destination: Destination):
+    """Test counting lines of batches written at once, e.g. by shard workers."""
+    written = metrics.EVENTS_WRITTEN.value
+    destination.write(b'{"a":1}\n{"b":2}', lines=2)
+    assert destination.path.read_bytes() == b''
+
+    destination.write(b'{"c":3}')
+    assert destination.path.read_bytes() == b'{"a":1}\n{"b":2}\n{"c":3}\n'
+    assert metrics.EVENTS_WRITTEN.value == written + 3
+
+
+class FailingFile:
+    """Wraps a file, failing its first write."""
+
+    def __init__(self, file):
+        """Wrap the file."""
+        self.file = file
+        self.failed = False
+
+    def write(self, data: bytes) -> int:
+        """Fail the first write, pass on the others."""
+        if not self.failed:
+            self.failed = True
+            raise OSError('No space left on device')
+        return self.file.write(data)
+
+    def __getattr__(self, name: str):
+        """Pass on other attributes."""
+        return getattr(self.file, name)
+
+
+def test_flush_retry(destination: Destination):
+    """Test writing the buffer again after a failed write, without blank lines."""
+    destination.write(b'{"a":1}')
+    destination.file = FailingFile(destination.file)  # type: ignore
+    with pytest.raises(OSError):
+        destination.flush()
+    destination.write(b'{"b":2}')
+    destination.flush()
+    assert destination.path.read_bytes() == b'{"a":1}\n{"b":2}\n'
+
+
+def test_flush_max_bytes(destination: Destination):
+    """Test flushing when the buffer reaches the maximum size."""
+    destination.write(b'"' + b'x' * 1024 + b'"')
+    assert destination.path.read_bytes().endswith(b'x"\n')
+
+
+def test_reopen_close(destination: Destination):
+    """Test draining the buffer on reopening and closing."""
+    destination.write(b'{"a":1}')
+    rotated_path = destination.path.with_suffix('.log.1')
+    destination.path.rename(rotated_path)
+    destination.reopen()
+    destination.write(b'{"b":2}')
+    destination.close()
+
+    assert rotated_path.read_bytes() == b'{"a":1}\n'
+    assert destination.path.read_bytes() == b'{"b":2}\n'
+
+
+def test_flush_interval(tmpdir_path: Path):
+    """Test flushing in the background."""
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=0.01,
+        max_buffered_bytes=1024,
+        max_buffered_events=1000,
+    )
+    try:
+        destination.write(b'{"a":1}')
+        wait_until(lambda: destination.path.read_bytes() == b'{"a":1}\n', timeout=5)
+    finally:
+        destination.close()
+
+
+def test_group_commit(tmpdir_path: Path):
+    """Test committing each batch once it's written and synced."""
+    committed = []
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024,
+        max_buffered_events=2,
+        fsync_policy=FSYNC_GROUP,
+    )
+    destination.on_sync = lambda count: committed.append(
+        (count, destination.path.read_bytes().count(b'\n'), destination.unsynced))
+    try:
+        for i in range(3):
+            destination.write(b'{"a":%d}' % i)
+    finally:
+        destination.close()
+    assert committed == [(2, 2, False), (1, 3, False)]
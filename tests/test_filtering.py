@@ -0,0 +1,42 @@
+"""Tests of selecting events by the API server and locally."""
+from kube_event_pipe.filtering import EventFilter, parse_names
+
+
+def event(namespace: str, reason: str) -> dict:
+    """Make an event object."""
+    return {'metadata': {'name': 'x', 'namespace': namespace}, 'reason': reason}
+
+
+def test_selectors():
+    """Test adding single included and all excluded names to the field selector."""
+    event_filter = EventFilter(
+        include_namespaces=parse_names('default'),
+        exclude_namespaces=parse_names(' kube-system, ,monitoring'),
+        exclude_reasons=parse_names('Pulled'),
+        field_selector='type=Warning',
+        label_selector='app=x',
+    )
+    assert event_filter.field_selector == (
+        'type=Warning,metadata.namespace=default,metadata.namespace!=kube-system,'
+        'metadata.namespace!=monitoring,reason!=Pulled'
+    )
+    assert event_filter.label_selector == 'app=x'
+    assert event_filter.accept is None
+
+    unfiltered = EventFilter()
+    assert unfiltered.field_selector is None
+    assert unfiltered.label_selector is None
+
+
+def test_accept():
+    """Test filtering included lists locally."""
+    event_filter = EventFilter(
+        include_namespaces=parse_names('a,b'),
+        include_reasons=parse_names('BackOff,Failed'),
+    )
+    assert event_filter.field_selector is None
+    accept = event_filter.accept
+    assert accept is not None
+    assert [accept(event(*fields)) for fields in [
+        ('a', 'BackOff'), ('b', 'Failed'), ('c', 'BackOff'), ('a', 'Pulled'),
+    ]] == [True, True, False, False]
@@ -0,0 +1,45 @@
+"""Tests of event identities."""
+import time
+from pathlib import Path
+from kube_event_pipe.identity import (
+    DIGEST_SIZE, IDENTITY_NAME_COUNT, IDENTITY_UID_COUNT, IDENTITY_UID_RESOURCE_VERSION,
+    check_identity_strategy, make_identity, read_identity_file, write_identity_file,
+)
+
+
+def test_identities():
+    """Test digests of identity strategies, telling apart different events."""
+    event = {'metadata': {'name': 'a', 'uid': 'u1', 'resourceVersion': '1'}, 'count': 1}
+    recreated = {'metadata': {'name': 'a', 'uid': 'u2', 'resourceVersion': '2'}, 'count': 1}
+    updated = {'metadata': {'name': 'a', 'uid': 'u1', 'resourceVersion': '3'}, 'count': 1}
+
+    digests = {}
+    for strategy in [IDENTITY_NAME_COUNT, IDENTITY_UID_COUNT, IDENTITY_UID_RESOURCE_VERSION]:
+        identity = make_identity(strategy)
+        digests[strategy] = [identity(obj) for obj in [event, recreated, updated]]
+        assert all(len(digest) == DIGEST_SIZE for digest in digests[strategy])
+
+    def distinct(digests):
+        return len(set(digests))
+    assert distinct(digests[IDENTITY_NAME_COUNT]) == 1
+    assert distinct(digests[IDENTITY_UID_COUNT]) == 2
+    assert distinct(digests[IDENTITY_UID_RESOURCE_VERSION]) == 3
+
+
+def test_check_identity_strategy(tmpdir_path: Path):
+    """Test detecting filters written before digests, and recording the strategy."""
+    assert not check_identity_strategy(tmpdir_path, IDENTITY_NAME_COUNT, 3600)
+    (tmpdir_path / '1600000000.bloom').touch()
+    assert not check_identity_strategy(tmpdir_path, IDENTITY_UID_COUNT, 3600)
+    assert (tmpdir_path / 'identity').read_text() == IDENTITY_UID_COUNT
+
+    (tmpdir_path / 'identity').unlink()
+    legacy_until = check_identity_strategy(tmpdir_path, IDENTITY_NAME_COUNT, 3600)
+    assert time.time() < legacy_until <= time.time() + 3600
+    # Restarts keep checking strings until the filters holding them are rotated out.
+    assert check_identity_strategy(tmpdir_path, IDENTITY_NAME_COUNT, 3600) == legacy_until
+    assert read_identity_file(tmpdir_path) == (IDENTITY_NAME_COUNT, legacy_until)
+
+    write_identity_file(tmpdir_path, IDENTITY_NAME_COUNT, time.time() - 1)
+    assert not check_identity_strategy(tmpdir_path, IDENTITY_NAME_COUNT, 3600)
+    assert (tmpdir_path / 'identity').read_text() == IDENTITY_NAME_COUNT
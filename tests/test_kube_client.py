@@ -0,0 +1,138 @@
+"""Tests of the built-in watch client."""
+import json
+import threading
+from pathlib import Path
+from http import HTTPStatus
+from typing import List
+import pytest  # type: ignore
+from benchmarks.fake_api_server import EventStream, EventStreamConfig, FakeApiServer
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.kube_client import (
+    ApiError, ClusterConfig, ConfigError, KubeClient, UnsupportedConfig, load_config,
+)
+from kube_event_pipe.source import iter_lines, watch_events
+
+
+KUBECONFIG = '''
+apiVersion: v1
+kind: Config
+clusters:
+- name: plain
+  cluster:
+    server: http://127.0.0.1:8080/
+contexts:
+- name: token-file
+  context: {cluster: plain, user: token-file}
+- name: basic
+  context: {cluster: plain, user: basic}
+- name: plugin
+  context: {cluster: plain, user: plugin}
+current-context: token-file
+users:
+- name: token-file
+  user: {tokenFile: token}
+- name: basic
+  user: {username: admin, password: secret}
+- name: plugin
+  user: {exec: {command: aws}}
+'''
+
+
+def test_load_kubeconfig(tmpdir_path: Path):
+    """Test loading credentials of the current context, overridden by an earlier kubeconfig."""
+    kubeconfig = tmpdir_path / 'config'
+    kubeconfig.write_text(KUBECONFIG)
+    (tmpdir_path / 'token').write_text('abc\n')
+    override = tmpdir_path / 'override'
+
+    config = load_config({'KUBECONFIG': str(kubeconfig)})
+    assert config.server == 'http://127.0.0.1:8080'
+    assert config.ssl_context is None
+    assert KubeClient(config).request_headers()['Authorization'] == 'Bearer abc'
+
+    override.write_text('current-context: basic')
+    config = load_config({'KUBECONFIG': f'{override}:{kubeconfig}'})
+    assert config.headers == {'Authorization': 'Basic YWRtaW46c2VjcmV0'}
+
+    override.write_text('current-context: plugin')
+    with pytest.raises(UnsupportedConfig):
+        load_config({'KUBECONFIG': f'{override}:{kubeconfig}'})
+
+
+def test_load_kubeconfig_context(tmpdir_path: Path):
+    """Test loading credentials of a context other than the current one."""
+    kubeconfig = tmpdir_path / 'config'
+    kubeconfig.write_text(KUBECONFIG)
+
+    config = load_config({'KUBECONFIG': str(kubeconfig)}, context='basic')
+    assert config.headers == {'Authorization': 'Basic YWRtaW46c2VjcmV0'}
+    with pytest.raises(ConfigError):
+        load_config({'KUBECONFIG': str(kubeconfig)}, context='missing')
+    # In-cluster config has no contexts.
+    with pytest.raises(ConfigError):
+        load_config({'KUBECONFIG': str(tmpdir_path / 'none'), 'KUBERNETES_SERVICE_HOST': 'kube'},
+                    context='basic')
+
+
+def test_watch():
+    """Test watching events, reusing the connection once a watch ends."""
+    stream = EventStream(EventStreamConfig(
+        rate=10_000, total=20, payload_bytes=10, duplicate_ratio=0, reconnect_every=10,
+        gone_every=0,
+    ))
+    server = FakeApiServer(stream)
+    server.start()
+    kube_client = KubeClient(ClusterConfig(server.url, None, None, {}))
+    try:
+        lines: List[bytes] = []
+        sockets = []
+        # Resuming from 0, the first watch ends after 10 events, however many are due by then.
+        for resource_version in ['0', '10']:
+            response = kube_client.list_event_for_all_namespaces(
+                watch=True, resource_version=resource_version, _preload_content=False)
+            lines.extend(iter_lines(response))
+            response.close()
+            response.release_conn()
+            assert kube_client.connection is not None
+            sockets.append(kube_client.connection.sock)
+
+        with pytest.raises(ValueError):
+            kube_client.list_event_for_all_namespaces(watch=True)
+        with pytest.raises(ApiError) as exc_info:
+            KubeClient(ClusterConfig(server.url + '/missing', None, None, {})) \
+                .list_event_for_all_namespaces(watch=True, _preload_content=False)
+    finally:
+        kube_client.close()
+        server.stop()
+
+    assert {json.loads(line)['object']['metadata']['resourceVersion'] for line in lines} == {
+        str(i) for i in range(1, 21)}
+    assert sockets[0] is not None and sockets[0] is sockets[1]
+    assert stream.watch_count == 2
+    assert exc_info.value.status == HTTPStatus.NOT_FOUND
+
+
+def test_watch_interrupt(tmpdir_path: Path):
+    """Test ending a watch blocked reading from the API server by interrupting the client."""
+    stream = EventStream(EventStreamConfig(
+        rate=10_000, total=5, payload_bytes=10, duplicate_ratio=0, reconnect_every=0,
+        gone_every=0,
+    ))
+    server = FakeApiServer(stream)
+    server.start()
+    kube_client = KubeClient(ClusterConfig(server.url, None, None, {}))
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    checkpoint.update('0')
+    stop = threading.Event()
+    events = watch_events(kube_client, checkpoint, raw=True, stop=stop)
+    try:
+        resource_versions = [next(events).obj['metadata']['resourceVersion'] for _ in range(5)]
+        stop.set()
+        kube_client.interrupt()
+        assert list(events) == []
+    finally:
+        kube_client.close()
+        server.stop()
+
+    assert resource_versions == ['1', '2', '3', '4', '5']
+    assert stream.watch_count == 1
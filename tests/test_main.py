@@ -0,0 +1,96 @@
+"""Tests of running the pipeline as configured."""
+import sys
+import json
+import signal
+from pathlib import Path
+from typing import Iterator
+import pytest  # type: ignore
+from kube_event_pipe import main
+from kube_event_pipe.checkpoint import RESOURCE_VERSION_FILE_NAME
+from kube_event_pipe.main import (
+    ENV_ASYNC_PIPELINE, ENV_DESTINATION, ENV_PERSISTENCE_PATH, ENV_SHARDS, ENV_SHARD_OUTPUT,
+    FILTER_ENGINE_BATCHED, FILTER_ENGINE_RING, budget_filter_capacity, pipe_events, read_settings,
+)
+from kube_event_pipe.memory import bloom_filter_capacity
+from kube_event_pipe.source import WatchedEvent
+
+
+@pytest.fixture
+def restore_signals() -> Iterator[None]:
+    """Restore signal handlers set by running kube-event-pipe."""
+    signums = (signal.SIGTERM, signal.SIGQUIT, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2)
+    handlers = {signum: signal.getsignal(signum) for signum in signums}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_budget_filter_capacity():
+    """Test splitting the budget between shards and generations, and the prepared next batch."""
+    settings = read_settings()._replace(
+        memory_budget=8 * 2 ** 20, shards=2, batch_count=3, filter_engine=FILTER_ENGINE_RING)
+    assert budget_filter_capacity(settings) == bloom_filter_capacity(
+        2 ** 20 * 4 // 3, settings.filter_error_rate)
+    settings = settings._replace(filter_engine=FILTER_ENGINE_BATCHED)
+    assert budget_filter_capacity(settings) == bloom_filter_capacity(
+        2 ** 20, settings.filter_error_rate)
+
+
+@pytest.mark.parametrize('async_pipeline', ['false', 'true'])
+def test_pipe_events_watch_error(tmpdir_path: Path, monkeypatch, async_pipeline: str):
+    """Test writing out events received before the watch failed, and saving the checkpoint."""
+    def failing_watch(*args, **kwargs) -> Iterator[WatchedEvent]:
+        for i in range(10):
+            obj = {'metadata': {'name': f'event-{i}', 'resourceVersion': str(i)}, 'count': 1}
+            yield WatchedEvent('ADDED', obj, None)
+        raise ConnectionError('Watch failed')
+
+    monkeypatch.setattr(main, 'watch_events', failing_watch)
+    monkeypatch.setenv(ENV_ASYNC_PIPELINE, async_pipeline)
+    settings = read_settings()._replace(persistence_path=tmpdir_path)
+    destination = main.open_settings_destination(settings, tmpdir_path / 'events.log')
+
+    with pytest.raises(ConnectionError):
+        pipe_events(None, destination, tmpdir_path, settings)
+
+    with destination.path.open() as f:
+        assert [json.loads(line)['metadata']['name'] for line in f] == [
+            f'event-{i}' for i in range(10)]
+    assert (tmpdir_path / RESOURCE_VERSION_FILE_NAME).read_text() == '9'
+
+
+def test_main_sharded(tmpdir_path: Path, monkeypatch, restore_signals):
+    """Test watching once, and writing events of all shards, until the watch ends."""
+    def watch(*args, **kwargs) -> Iterator[WatchedEvent]:
+        for i in range(20):
+            obj = {
+                'metadata': {
+                    'name': f'event-{i}', 'namespace': f'namespace-{i % 8}',
+                    'resourceVersion': str(i),
+                },
+                'count': 1,
+            }
+            yield WatchedEvent('ADDED', obj, None)
+
+    monkeypatch.setattr(main, 'watch_events', watch)
+    monkeypatch.setattr(main, 'connect_kube_api', lambda settings: None)
+    monkeypatch.setattr(sys, 'argv', ['kube-event-pipe'])
+    monkeypatch.setenv(ENV_SHARDS, '2')
+    monkeypatch.setenv(ENV_DESTINATION, str(tmpdir_path / 'events.log'))
+    monkeypatch.setenv(ENV_PERSISTENCE_PATH, str(tmpdir_path))
+    main.main()
+
+    with (tmpdir_path / 'events.log').open() as f:
+        assert sorted(json.loads(line)['metadata']['name'] for line in f) == sorted(
+            f'event-{i}' for i in range(20))
+    assert (tmpdir_path / RESOURCE_VERSION_FILE_NAME).read_text() == '19'
+
+
+def test_main_sharded_separate_stdout(monkeypatch, restore_signals):
+    """Test refusing per-shard output files next to stdout."""
+    monkeypatch.setattr(sys, 'argv', ['kube-event-pipe'])
+    monkeypatch.setenv(ENV_SHARDS, '2')
+    monkeypatch.setenv(ENV_SHARD_OUTPUT, 'separate')
+    monkeypatch.setenv(ENV_DESTINATION, '-')
+    with pytest.raises(SystemExit):
+        main.main()
@@ -0,0 +1,47 @@
+"""Tests of sizing filters to a memory budget and of their residency."""
+import math
+import mmap
+from pathlib import Path
+import pytest  # type: ignore
+from kube_event_pipe import memory
+from kube_event_pipe.cuckoo_filter import cuckoo_filter_capacity, cuckoo_filter_geometry
+from kube_event_pipe.ring_bloom_filter import RingBloomFilter, blocked_filter_geometry
+
+
+@pytest.mark.parametrize('error_rate', [0.01, 0.001])
+def test_budget_capacity(error_rate: float):
+    """Test that filters sized for the capacity a budget holds fit in the budget."""
+    budget = 10 * 1024 * 1024
+    block_count, _ = blocked_filter_geometry(
+        memory.bloom_filter_capacity(budget, error_rate), error_rate)
+    assert budget - 64 <= block_count * 64 <= budget
+
+    bucket_count, fingerprint_bits, tag_bits = cuckoo_filter_geometry(
+        cuckoo_filter_capacity(budget, error_rate), error_rate)
+    assert budget * 0.99 <= bucket_count * 4 * (fingerprint_bits + tag_bits) / 8 <= budget
+
+
+@pytest.mark.skipif(not memory.PROC_SMAPS.exists(), reason='Needs /proc/self/smaps')
+def test_resident_bytes(tmpdir_path: Path):
+    """Test finding the mapped ring and keeping its head slot resident."""
+    ring: RingBloomFilter[str] = RingBloomFilter(
+        directory=tmpdir_path,
+        filter_capacity=100_000,
+        filter_error_rate=0.01,
+        batch_count=3,
+        batch_duration_sec=3600,
+    )
+    try:
+        # Locking the head slot splits the mapping.
+        ranges = memory.mapped_ranges(ring.path)
+        mapped_bytes = sum(end - start for start, end, _ in ranges)
+        assert mapped_bytes == math.ceil(len(ring.mmap) / mmap.PAGESIZE) * mmap.PAGESIZE
+        assert [file_offset for _, _, file_offset in ranges][0] == 0
+        resident = memory.resident_bytes(ring.paths())
+        # The head slot is locked, at least.
+        assert resident[ring.path.name] >= ring.slot_bytes
+        assert memory.advise(ring.path, memory.MADV_RANDOM)
+    finally:
+        ring.close()
+    assert memory.mapped_ranges(ring.path) == []
+    assert memory.resident_bytes([ring.path]) == {ring.path.name: 0}
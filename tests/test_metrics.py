@@ -0,0 +1,73 @@
+"""In-process tests for pipeline metrics."""
+from pathlib import Path
+from urllib.request import urlopen
+from kube_event_pipe import metrics
+from kube_event_pipe.batched_bloom_filter import BatchedBloomFilter  # type: ignore
+from kube_event_pipe.metrics import Counter, Histogram, GaugeFamily, REGISTRY
+
+
+def test_metric_samples():
+    """Test rendering counters, histograms and gauges."""
+    counter = Counter('test_total', 'Test counter.')
+    histogram = Histogram('test_seconds', 'Test histogram.', [0.1, 1])
+    gauges = GaugeFamily('test_ratio', 'Test gauges.', lambda: [({'name': 'a"b'}, 0.5)])
+    try:
+        counter.inc()
+        counter.inc(2)
+        for value in [0.05, 0.5, 5]:
+            histogram.observe(value)
+
+        assert counter.samples() == ['test_total 3.0']
+        assert histogram.samples() == [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_count 3',
+            'test_seconds_sum 5.55',
+        ]
+        assert gauges.expose() == [
+            '# HELP test_ratio Test gauges.',
+            '# TYPE test_ratio gauge',
+            'test_ratio{name="a\\"b"} 0.5',
+        ]
+    finally:
+        for metric in [counter, histogram, gauges]:
+            REGISTRY.remove(metric)
+
+
+def test_serve_metrics(tmpdir_path: Path):
+    """Test serving metrics, including bloom filter stats."""
+    events_seen: BatchedBloomFilter[str] = BatchedBloomFilter(
+        directory=tmpdir_path,
+        filter_capacity=1000,
+        filter_error_rate=0.01,
+        batch_count=2,
+        batch_duration_sec=3600,
+    )
+    for i in range(1000):
+        events_seen.add(f'event-{i}')
+    metrics.collect_filter_stats(events_seen.filter_stats)
+    metrics.EVENT_LAG.observe(0)
+
+    server = metrics.serve_metrics(0, '127.0.0.1')
+    try:
+        with urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+            lines = response.read().decode().splitlines()
+    finally:
+        server.shutdown()
+        server.server_close()
+        events_seen.close()
+
+    assert 'kube_event_pipe_event_lag_seconds_bucket{le="0.1"} 1' in lines
+    filter_name = f'{events_seen.last_batch_ts}.bloom'
+    fill_ratio, = [
+        float(line.split()[1]) for line in lines
+        if line.startswith(f'kube_event_pipe_filter_fill_ratio{{filter="{filter_name}"}}')
+    ]
+    false_positive_rate, = [
+        float(line.split()[1]) for line in lines
+        if line.startswith(f'kube_event_pipe_filter_false_positive_rate{{filter="{filter_name}"}}')
+    ]
+    assert 0.4 < fill_ratio < 0.6
+    assert 0.005 < false_positive_rate < 0.015
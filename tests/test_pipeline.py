@@ -0,0 +1,377 @@
+"""In-process tests for deduplicating and writing events."""
+import json
+import time
+from pathlib import Path
+from typing import Iterator, List
+import pytest  # type: ignore
+from kube_event_pipe.batched_bloom_filter import BatchedBloomFilter  # type: ignore
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.coalescing import Coalescer
+from kube_event_pipe.destination import Destination, FSYNC_GROUP
+from kube_event_pipe import pipeline
+from kube_event_pipe.pipeline import Deduplicator, AsyncPipeline, run_pipeline
+from kube_event_pipe.shedding import LoadShedder, LEVEL_NONE
+from kube_event_pipe.source import WatchedEvent
+from tests.wait import wait_until
+
+
+def make_events(count: int, repeats: int = 2) -> List[WatchedEvent]:
+    """Make `count` distinct events, each repeated `repeats` times."""
+    events = []
+    for i in range(count * repeats):
+        obj = {
+            'metadata': {'name': f'event-{i % count}', 'resourceVersion': str(i)},
+            'count': 1,
+        }
+        events.append(WatchedEvent('ADDED', obj, None))
+    return events
+
+
+@pytest.fixture
+def deduplicate(tmpdir_path: Path) -> Iterator[Deduplicator]:
+    """Deduplicate against a fresh bloom filter."""
+    events_seen: BatchedBloomFilter[str] = BatchedBloomFilter(
+        directory=tmpdir_path,
+        filter_capacity=10000,
+        filter_error_rate=0.01,
+        batch_count=2,
+        batch_duration_sec=3600,
+    )
+    yield Deduplicator(events_seen)
+    events_seen.close()
+
+
+@pytest.fixture
+def destination(tmpdir_path: Path) -> Iterator[Destination]:
+    """Write to `events.log`."""
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024 * 1024,
+        max_buffered_events=100,
+    )
+    yield destination
+    destination.close()
+
+
+def read_names(destination: Destination) -> List[str]:
+    """Drain the destination and read the names of written events."""
+    destination.flush()
+    with destination.path.open() as f:
+        return [json.loads(line)['metadata']['name'] for line in f]
+
+
+class CountingSet(set):
+    """A set counting membership checks, standing in for bloom filters."""
+
+    lookups = 0
+    syncs = 0
+
+    def __contains__(self, element) -> bool:
+        """Count the lookup."""
+        self.lookups += 1
+        return super().__contains__(element)
+
+    def contains_many(self, elements) -> List[bool]:
+        """Count the lookups."""
+        return [element in self for element in elements]
+
+    def add_many(self, elements):
+        """Add the elements."""
+        self.update(elements)
+
+    def sync(self):
+        """Count the sync."""
+        self.syncs += 1
+
+    def close(self):
+        """Do nothing."""
+
+
+def test_deduplicator_recent_cache():
+    """Test answering recent repeats from the cache, and evicting least recently seen ones."""
+    events_seen = CountingSet()
+    deduplicate = Deduplicator(events_seen, recent_cache_size=2)  # type: ignore
+    events = make_events(3, repeats=1)
+
+    assert [deduplicate(event) is not None for event in events] == [True, True, True]
+    assert events_seen.lookups == 3
+    assert list(deduplicate.recent) == [deduplicate.identity(event.obj) for event in events[1:]]
+
+    # The evicted identity is found in the filters and cached again.
+    assert [deduplicate(event) for event in reversed(events)] == [None, None, None]
+    assert events_seen.lookups == 4
+    assert deduplicate.recent_hits == 2
+    assert list(deduplicate.recent) == [
+        deduplicate.identity(event.obj) for event in [events[1], events[0]]]
+
+
+def test_deduplicator_first_seen_many():
+    """Test looking up a batch of identities, repeated in it, in the cache and in the filters."""
+    events_seen = CountingSet({b'a'})
+    deduplicate = Deduplicator(events_seen, recent_cache_size=10)  # type: ignore
+    assert deduplicate.first_seen_many([b'b']) == [True]
+
+    assert deduplicate.first_seen_many([b'a', b'b', b'c', b'c', b'd']) == [
+        False, False, True, False, True]
+    # Only identities not in the cache are looked up, once each.
+    assert events_seen.lookups == 1 + 3
+    assert events_seen == {b'a', b'b', b'c', b'd'}
+    assert deduplicate.first_seen_many([b'd', b'e']) == [False, True]
+    assert events_seen.lookups == 1 + 3 + 1
+
+
+def test_deduplicator_bookmark():
+    """Test skipping bookmarks, without looking them up."""
+    events_seen = CountingSet()
+    deduplicate = Deduplicator(events_seen)  # type: ignore
+    bookmark = WatchedEvent('BOOKMARK', {'metadata': {'resourceVersion': '5'}}, None)
+    assert deduplicate(bookmark) is None
+    assert events_seen.lookups == 0
+    assert not events_seen
+
+
+def test_deduplicator_legacy_identities():
+    """Test finding events by the identities filters were written with before digests."""
+    events_seen = CountingSet({'event-0-1'})
+    deduplicate = Deduplicator(events_seen, legacy_until=time.time() + 3600)  # type: ignore
+    events = make_events(2, repeats=1)
+    assert [deduplicate(event) is not None for event in events] == [False, True]
+    assert deduplicate.identity(events[1].obj) in events_seen
+    assert 'event-1-1' not in events_seen
+
+    deduplicate.legacy_until = time.time() - 1
+    assert deduplicate(events[0]) is not None
+    assert deduplicate.legacy_until == 0
+
+
+def test_deduplicator_shed():
+    """Test dropping new events without recording them, so they're written if listed again."""
+    events_seen = CountingSet()
+    shed = LoadShedder(lag_sec=10)
+    deduplicate = Deduplicator(events_seen, shed=shed)  # type: ignore
+    [event] = make_events(1, repeats=1)
+    event.obj['type'] = 'Normal'
+    shed.update(100)
+    assert deduplicate(event) is None
+    assert not events_seen
+
+    shed.level = LEVEL_NONE
+    assert deduplicate(event) is not None
+    assert len(events_seen) == 1
+
+
+def test_deduplicator_group_commit(tmpdir_path: Path):
+    """Test adding events to the filters only once they're written out and synced."""
+    events_seen = CountingSet()
+    deduplicate = Deduplicator(events_seen, group_commit=True)  # type: ignore
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024 * 1024,
+        max_buffered_events=3,
+        fsync_policy=FSYNC_GROUP,
+    )
+    destination.on_sync = deduplicate.commit
+    events = make_events(4)
+    try:
+        run_pipeline(iter(events[:6]), deduplicate, destination,
+                     ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600))
+        # Only the flushed batch is committed, repeats of the pending event would be skipped.
+        identities = [deduplicate.identity(event.obj) for event in events[:4]]
+        assert events_seen == set(identities[:3])
+        assert list(deduplicate.pending) == identities[3:]
+        assert deduplicate(events[3]) is None
+
+        assert read_names(destination) == ['event-0', 'event-1', 'event-2', 'event-3']
+        assert events_seen == set(identities)
+        assert events_seen.syncs == 2
+        assert not deduplicate.pending
+    finally:
+        destination.close()
+
+
+def test_run_pipeline_coalesce(tmpdir_path: Path):
+    """Test committing events held by coalescing once their summary is written."""
+    events_seen = CountingSet()
+    deduplicate = Deduplicator(events_seen, group_commit=True)  # type: ignore
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024 * 1024,
+        max_buffered_events=100,
+        fsync_policy=FSYNC_GROUP,
+    )
+    destination.on_sync = deduplicate.commit
+    coalesce = Coalescer(window_sec=3600)
+    try:
+        # Events without an involved object or reason are all about the same one.
+        run_pipeline(iter(make_events(10)), deduplicate, destination,
+                     ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600), coalesce)
+        for data, occurred_at, event_count in coalesce.drain():
+            destination.write(data, occurred_at, event_count)
+        assert read_names(destination) == ['event-0', 'event-9']
+        assert len(events_seen) == 10
+        assert not deduplicate.pending
+    finally:
+        destination.close()
+
+
+def test_run_pipeline_coalesce_hold(tmpdir_path: Path, destination: Destination):
+    """Test marking held events as seen, and checkpointing past them, once they are summarized."""
+    events_seen = CountingSet()
+    coalesce = Coalescer(window_sec=3600)
+    deduplicate = Deduplicator(events_seen, hold=coalesce.hold)  # type: ignore
+    coalesce.on_release = deduplicate.release
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    run_pipeline(iter(make_events(10)), deduplicate, destination, checkpoint, coalesce)
+
+    assert read_names(destination) == ['event-0']
+    # Repeats of held events are skipped, without them being in the filters.
+    assert len(events_seen) == 1
+    assert len(deduplicate.held) == 9
+    assert deduplicate.skipped == 10
+    assert checkpoint.resource_version == '0'
+
+    for data, occurred_at, event_count in coalesce.drain():
+        destination.write(data, occurred_at, event_count)
+    assert read_names(destination) == ['event-0', 'event-9']
+    assert len(events_seen) == 10
+    assert not deduplicate.held
+    assert coalesce.resume_version('19') == '19'
+
+
+def storm_event(name: str, resource_version: int) -> WatchedEvent:
+    """Make an event about the pod its name starts with."""
+    return WatchedEvent('ADDED', {
+        'metadata': {'name': name, 'resourceVersion': str(resource_version)},
+        'involvedObject': {'kind': 'Pod', 'namespace': 'default', 'name': f'pod-{name[0]}'},
+        'reason': 'BackOff',
+        'count': 1,
+    }, None)
+
+
+def test_run_pipeline_coalesce_expire(tmpdir_path: Path, destination: Destination, monkeypatch):
+    """Test writing summaries of windows which ended while no events came."""
+    monkeypatch.setattr(pipeline, 'EXPIRY_INTERVAL_SEC', 0.05)
+
+    def watch() -> Iterator[WatchedEvent]:
+        yield storm_event('a-1', 1)
+        yield storm_event('a-2', 2)
+        wait_until(lambda: len(read_names(destination)) == 2)
+
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    run_pipeline(watch(), Deduplicator(CountingSet()), destination, checkpoint,  # type: ignore
+                 Coalescer(window_sec=0.1))
+
+    assert read_names(destination) == ['a-1', 'a-2']
+
+
+@pytest.mark.parametrize('async_pipeline', [False, True])
+@pytest.mark.parametrize('expiry_interval_sec', [0.05, 3600])
+def test_coalesce_group_commit_order(
+    tmpdir_path: Path, monkeypatch, async_pipeline: bool, expiry_interval_sec: float,
+):
+    """Test only committing written events when a window ends before one, with group commit."""
+    # Windows are closed either in the background, or only before the next event.
+    monkeypatch.setattr(pipeline, 'EXPIRY_INTERVAL_SEC', expiry_interval_sec)
+    events_seen = CountingSet()
+    coalesce = Coalescer(window_sec=0.2)
+    deduplicate = Deduplicator(events_seen, group_commit=True, hold=coalesce.hold)  # type: ignore
+    coalesce.on_release = deduplicate.release
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024 * 1024,
+        max_buffered_events=1,
+        fsync_policy=FSYNC_GROUP,
+    )
+    unwritten: List[str] = []
+
+    def commit(count: int):
+        deduplicate.commit(count)
+        with destination.path.open() as f:
+            written = {json.loads(line)['metadata']['name'] for line in f}
+        unwritten.extend(
+            name for name in ['a-1', 'b-1']
+            if deduplicate.identity(storm_event(name, 0).obj) in events_seen
+            and name not in written)
+
+    def watch() -> Iterator[WatchedEvent]:
+        yield storm_event('a-1', 1)
+        yield storm_event('a-2', 2)
+        time.sleep(0.3)
+        yield storm_event('b-1', 3)
+
+    destination.on_sync = commit
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    try:
+        if async_pipeline:
+            AsyncPipeline(deduplicate, destination, checkpoint, queue_size=10,
+                          log_interval_sec=3600, coalesce=coalesce).run(watch())
+        else:
+            run_pipeline(watch(), deduplicate, destination, checkpoint, coalesce)
+        assert read_names(destination) == ['a-1', 'a-2', 'b-1']
+    finally:
+        destination.close()
+
+    assert unwritten == []
+    assert len(events_seen) == 3
+    assert not deduplicate.pending and not deduplicate.held
+
+
+def test_run_pipeline(tmpdir_path: Path, deduplicate: Deduplicator, destination: Destination):
+    """Test deduplicating and writing events synchronously."""
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    run_pipeline(iter(make_events(10)), deduplicate, destination, checkpoint)
+
+    assert read_names(destination) == [f'event-{i}' for i in range(10)]
+    assert checkpoint.resource_version == '19'
+    assert deduplicate.skipped == 10
+
+
+@pytest.mark.parametrize('queue_size', [1, 1000])
+def test_async_pipeline(
+    tmpdir_path: Path, deduplicate: Deduplicator, destination: Destination, queue_size: int,
+):
+    """Test passing events through the asyncio pipeline, with and without backpressure."""
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    pipeline = AsyncPipeline(
+        deduplicate, destination, checkpoint, queue_size=queue_size, log_interval_sec=3600)
+    pipeline.run(iter(make_events(500)))
+
+    assert read_names(destination) == [f'event-{i}' for i in range(500)]
+    assert checkpoint.resource_version == '999'
+
+
+def test_async_pipeline_watch_error(
+    tmpdir_path: Path, deduplicate: Deduplicator, destination: Destination,
+):
+    """Test that watch errors are raised, after writing events received so far."""
+    def failing_watch() -> Iterator[WatchedEvent]:
+        yield from make_events(3, repeats=1)
+        raise ConnectionError('Watch failed')
+
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    pipeline = AsyncPipeline(
+        deduplicate, destination, checkpoint, queue_size=10, log_interval_sec=3600)
+    with pytest.raises(ConnectionError):
+        pipeline.run(failing_watch())
+
+    assert read_names(destination) == ['event-0', 'event-1', 'event-2']
+
+
+def test_async_pipeline_shed(
+    tmpdir_path: Path, deduplicate: Deduplicator, destination: Destination,
+):
+    """Test shedding events by how long they waited to be deduplicated."""
+    deduplicate.shed = LoadShedder(lag_sec=1e-9)
+    events = make_events(3, repeats=1)
+    for event in events:
+        event.obj['type'] = 'Normal'
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    AsyncPipeline(deduplicate, destination, checkpoint, queue_size=10, log_interval_sec=3600).run(
+        iter(events))
+
+    assert read_names(destination) == []
+    assert deduplicate.shed.shed == {'': 3}
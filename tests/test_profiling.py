@@ -0,0 +1,56 @@
+"""Tests of profiling the pipeline on signals."""
+import os
+import signal
+import time
+from pathlib import Path
+from typing import Iterator
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.destination import Destination
+from kube_event_pipe.pipeline import Deduplicator, run_pipeline
+from kube_event_pipe.profiling import STAGES, STAGE_TIMERS, profile_on_signals
+from kube_event_pipe.source import WatchedEvent
+
+
+def slow_events(count: int) -> Iterator[WatchedEvent]:
+    """Yield distinct events, slowly enough to be sampled."""
+    for i in range(count):
+        time.sleep(0.001)
+        yield WatchedEvent(
+            'ADDED', {'metadata': {'name': f'event-{i}', 'resourceVersion': str(i)}}, None)
+
+
+def test_profile_on_signals(tmpdir_path: Path):
+    """Test sampling stacks and timing stages between SIGUSR1 and SIGUSR2."""
+    handlers = signal.getsignal(signal.SIGUSR1), signal.getsignal(signal.SIGUSR2)
+    profile_on_signals(tmpdir_path)
+    destination = Destination(
+        tmpdir_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024 * 1024,
+        max_buffered_events=100,
+    )
+    try:
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert STAGE_TIMERS.enabled
+        run_pipeline(
+            slow_events(100), Deduplicator(set()), destination,  # type: ignore
+            ResourceVersionCheckpoint(tmpdir_path, 3600))
+        os.kill(os.getpid(), signal.SIGUSR2)
+        assert not STAGE_TIMERS.enabled
+    finally:
+        destination.close()
+        signal.signal(signal.SIGUSR1, handlers[0])
+        signal.signal(signal.SIGUSR2, handlers[1])
+
+    [folded] = tmpdir_path.glob('profile-*.folded')
+    stacks = folded.read_text().splitlines()
+    assert any('slow_events (tests/test_profiling.py:' in stack for stack in stacks)
+    assert sum(int(stack.rsplit(' ', 1)[1]) for stack in stacks) > 0
+
+    lines = folded.with_suffix('.stages').read_text().splitlines()
+    calls = {line.split()[0]: int(line.split()[1]) for line in lines[2:]}
+    assert list(calls) == list(STAGES)
+    assert calls == {
+        'watch_read': 100, 'identity': 100, 'filter_lookup': 100, 'filter_add': 100,
+        'serialize': 100, 'write': 100,
+    }
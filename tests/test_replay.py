@@ -0,0 +1,70 @@
+"""Tests of deduplicating archived events offline."""
+import io
+import json
+from pathlib import Path
+from typing import List
+import pytest  # type: ignore
+from kube_event_pipe.batched_bloom_filter import BatchedBloomFilter  # type: ignore
+from kube_event_pipe.identity import IDENTITY_NAME_COUNT
+from kube_event_pipe.pipeline import Deduplicator
+from kube_event_pipe.replay import Replay, read_chunks
+
+
+def event(name: str, count: int) -> dict:
+    """Make an event object."""
+    return {'metadata': {'name': name, 'uid': name}, 'count': count, 'message': f'{name} happened'}
+
+
+def test_read_chunks():
+    """Test reading JSON lines, JSON arrays and lists like kubectl outputs."""
+    events = [event('a', 1), event('b', 1)]
+    lines = b''.join(json.dumps(e).encode() + b'\n' for e in events)
+    assert [json.loads(line) for chunk in read_chunks(io.BytesIO(b'\n' + lines))
+            for line in chunk] == events
+
+    for document in [
+        json.dumps(events).encode(),
+        json.dumps({'kind': 'List', 'items': events, 'metadata': {}}, indent=4).encode(),
+    ]:
+        assert [json.loads(line) for chunk in read_chunks(io.BytesIO(document))
+                for line in chunk] == events
+
+    assert list(read_chunks(io.BytesIO(b''))) == []
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_replay(tmpdir_path: Path, workers: int):
+    """Test writing new events from files in order, and seeding filters for the next replay."""
+    archive = tmpdir_path / 'events.log'
+    archive.write_bytes(b''.join(
+        json.dumps(e).encode() + b'\n'
+        for e in [event('a', 1), event('b', 1), event('a', 1), event('a', 2)]
+    ) + b'not json\n\n')
+    snapshot = tmpdir_path / 'snapshot.json'
+    snapshot.write_text(json.dumps({'items': [event('b', 1), event('c', 1)]}, indent=2))
+
+    filters_path = tmpdir_path / 'filters'
+    filters_path.mkdir()
+    for expected_written in [['a-1', 'b-1', 'a-2', 'c-1'], []]:
+        events_seen: BatchedBloomFilter[bytes] = BatchedBloomFilter(
+            directory=filters_path,
+            filter_capacity=1000,
+            filter_error_rate=0.001,
+            batch_count=2,
+            batch_duration_sec=3600,
+        )
+        written: List[bytes] = []
+        replay = Replay(Deduplicator(events_seen), written.append, IDENTITY_NAME_COUNT, workers)
+        replay.run([str(archive), str(snapshot)])
+        events_seen.close()
+
+        assert [
+            f"{json.loads(data)['metadata']['name']}-{json.loads(data)['count']}"
+            for data in written
+        ] == expected_written
+        assert replay.events == 6
+        assert replay.duplicates == 6 - len(expected_written)
+        assert replay.invalid == 1
+        if written:
+            # Lines are written as they were read.
+            assert written[0] == json.dumps(event('a', 1)).encode()
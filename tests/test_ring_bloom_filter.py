@@ -0,0 +1,59 @@
+"""In-process tests for RingBloomFilter."""
+from pathlib import Path
+from kube_event_pipe.ring_bloom_filter import RingBloomFilter, RING_FILE_NAME
+
+
+params: dict = {
+    'filter_capacity': 10000,
+    'filter_error_rate': 0.01,
+    'batch_count': 3,
+    'batch_duration_sec': 3600,
+}
+
+
+def test_ring_bloom_filter_error_rate(tmpdir_path: Path):
+    """Test that added elements are found and the false positive rate is about as configured."""
+    ring: RingBloomFilter[str] = RingBloomFilter(directory=tmpdir_path, **params)
+    for i in range(10000):
+        ring.add(f'seen-{i}')
+
+    assert all(f'seen-{i}' in ring for i in range(10000))
+    false_positives = sum(f'unseen-{i}' in ring for i in range(10000))
+    assert false_positives < 200
+    ring.close()
+
+
+def test_ring_bloom_filter_state_load(tmpdir_path: Path):
+    """Test reopening the ring, and discarding it if its geometry changed."""
+    ring: RingBloomFilter[str] = RingBloomFilter(directory=tmpdir_path, **params)
+    ring.add('event-1')
+    created_at = ring.last_batch_ts
+    ring.close()
+
+    ring = RingBloomFilter(directory=tmpdir_path, **params)
+    assert 'event-1' in ring
+    assert ring.last_batch_ts == created_at
+    ring.close()
+
+    ring = RingBloomFilter(directory=tmpdir_path, **dict(params, filter_capacity=20000))
+    assert 'event-1' not in ring
+    ring.close()
+    assert [p.name for p in tmpdir_path.iterdir()] == [RING_FILE_NAME]
+
+
+def test_ring_bloom_filter_rotation(tmpdir_path: Path):
+    """Test that elements are forgotten after their slot is reused."""
+    ring: RingBloomFilter[str] = RingBloomFilter(directory=tmpdir_path, **params)
+    for generation in range(5):
+        ring.add(f'event-{generation}')
+        # Force rotation.
+        ring.timestamps[ring.head] -= 100000
+        ring.rotate_if_needed()
+
+    assert ring.head == 5 % params['batch_count']
+    assert 'event-4' in ring
+    assert 'event-3' in ring
+    # Slots of older generations have been reused.
+    assert 'event-2' not in ring
+    assert 'event-0' not in ring
+    ring.close()
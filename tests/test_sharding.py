@@ -0,0 +1,223 @@
+"""In-process tests for sharding namespaces between worker processes."""
+import os
+import json
+import sys
+import queue
+import signal
+import threading
+from pathlib import Path
+from typing import IO, Iterator, List, Optional, cast
+from multiprocessing import Queue
+import pytest  # type: ignore
+from kube_event_pipe.checkpoint import RESOURCE_VERSION_FILE_NAME, ResourceVersionCheckpoint
+from kube_event_pipe.destination import Destination
+from kube_event_pipe.sharding import (
+    ShardAssignment, ShardCheckpoint, ShardSupervisor, MergedOutput, parse_shard_namespaces,
+    receive_events, shard_destination_path,
+)
+from kube_event_pipe.source import BOOKMARK, WatchedEvent
+from tests.wait import wait_until
+
+
+def test_parse_shard_namespaces():
+    """Test parsing explicit namespace lists."""
+    assert parse_shard_namespaces('kube-system, monitoring;default;') == [
+        ['kube-system', 'monitoring'], ['default'],
+    ]
+    assert parse_shard_namespaces('') == []
+
+
+def test_shard_assignment():
+    """Test assigning namespaces to shards explicitly and by hash."""
+    assignment = ShardAssignment(3, [['a', 'b'], ['c']])
+    assert assignment.shard('a') == assignment.shard('b') == 0
+    assert assignment.shard('c') == 1
+
+    hashed = {assignment.shard(f'namespace-{i}') for i in range(100)}
+    assert hashed == {0, 1, 2}
+    assert ShardAssignment(3).shard('namespace-1') == assignment.shard('namespace-1')
+
+    assert assignment.event_shard({'metadata': {'namespace': 'c'}}) == 1
+    assert assignment.event_shard({'metadata': {}}) == assignment.shard('')
+
+    with pytest.raises(ValueError):
+        ShardAssignment(1, [['a'], ['b']])
+
+
+def test_shard_destination_path():
+    """Test naming per-shard destination files."""
+    assert shard_destination_path(Path('/var/log/events.log'), 2) == Path(
+        '/var/log/events.shard2.log')
+
+
+def test_shard_checkpoint_bookmarks(tmpdir_path: Path):
+    """Test acknowledging bookmarks once processed, covering the ones received before them."""
+    (tmpdir_path / RESOURCE_VERSION_FILE_NAME).write_text('1')
+    output_queue = queue.Queue()  # type: queue.Queue
+    checkpoint = ShardCheckpoint(tmpdir_path, 0, 2, cast(Queue, output_queue))
+    # The supervisor's checkpoint is resumed from.
+    assert checkpoint.resource_version is None
+    checkpoint.update('1')
+    assert output_queue.empty()
+
+    checkpoint.receive_bookmark('2')
+    checkpoint.receive_bookmark('3')
+    checkpoint.update('2')
+    assert output_queue.get_nowait() == (2, '2')
+    checkpoint.receive_bookmark('4')
+    # A resourceVersion held back past a bookmark acknowledges the later one only.
+    checkpoint.update('4')
+    assert output_queue.get_nowait() == (2, '4')
+    assert not checkpoint.bookmarks
+    checkpoint.update('3')
+    assert output_queue.empty()
+
+
+def exit_on_sigterm(signum, frame):
+    """Raise SystemExit."""
+    sys.exit(0)
+
+
+def make_events(count: int) -> List[WatchedEvent]:
+    """Make events of a few namespaces, with increasing resourceVersions, every other peeked at."""
+    events = []
+    for i in range(count):
+        metadata = {'namespace': f'namespace-{i % 8}', 'resourceVersion': str(i)}
+        obj = {'metadata': metadata, 'message': f'Event {i}'}
+        if i % 2:
+            events.append(WatchedEvent('ADDED', obj, None))
+        else:
+            events.append(WatchedEvent('ADDED', {'metadata': metadata}, json.dumps(obj).encode()))
+    return events
+
+
+def write_received(shard: int, input_queue: Queue, output_queue: Queue):
+    """Write the events received through merged output, until the watch ends or terminated."""
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    destination = Destination(
+        Path('/dev/null'),
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024,
+        max_buffered_events=1000,
+        open_file=lambda path: cast(IO[bytes], MergedOutput(output_queue)),
+    )
+    checkpoint = ShardCheckpoint(
+        Path('/dev/null'), 0, shard, output_queue, before_save=destination.flush)
+    try:
+        for event in receive_events(input_queue, checkpoint):
+            if event.type != BOOKMARK:
+                destination.write(b'%d %s' % (shard, event.obj['message'].encode()))
+            checkpoint.update(event.obj['metadata']['resourceVersion'])
+    except SystemExit:
+        pass
+    finally:
+        destination.close()
+
+
+def run_supervisor(
+    persistence_path: Path,
+    events: Iterator[WatchedEvent],
+    terminate_after_sec: Optional[float] = None,
+) -> List[bytes]:
+    """Run the supervisor, with merged output and 2 shards, and return the lines written."""
+    destination = Destination(
+        persistence_path / 'events.log',
+        flush_interval_sec=3600,
+        max_buffered_bytes=1024 * 1024,
+        max_buffered_events=1000,
+    )
+    checkpoint = ResourceVersionCheckpoint(persistence_path, 0, before_save=destination.flush)
+    supervisor = ShardSupervisor(
+        write_received, ShardAssignment(2), destination, checkpoint, queue_size=10)
+    previous_handlers = {
+        signum: signal.getsignal(signum)
+        for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2)
+    }
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    timer = None
+    if terminate_after_sec is not None:
+        timer = threading.Timer(terminate_after_sec, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+    try:
+        supervisor.run(events)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        destination.close()
+    return destination.path.read_bytes().splitlines()
+
+
+def expected_lines(events: List[WatchedEvent]) -> List[bytes]:
+    """Return the lines the shard workers write for events, sorted."""
+    assignment = ShardAssignment(2)
+    return sorted(
+        b'%d %s' % (assignment.event_shard(event.obj), event_message(event).encode())
+        for event in events)
+
+
+def event_message(event: WatchedEvent) -> str:
+    """Return the message of an event, parsing it if it was peeked at."""
+    obj = event.obj if event.data is None else json.loads(event.data)
+    return obj['message']
+
+
+def test_shard_supervisor(tmpdir_path: Path):
+    """Test routing events to shards, and checkpointing them once all workers wrote them out."""
+    events = make_events(100)
+    bookmark = WatchedEvent(BOOKMARK, {'metadata': {'resourceVersion': '100'}}, None)
+    lines = run_supervisor(tmpdir_path, iter(events + [bookmark]))
+
+    assert sorted(lines) == expected_lines(events)
+    assert {line.split()[0] for line in lines} == {b'0', b'1'}
+    assert (tmpdir_path / RESOURCE_VERSION_FILE_NAME).read_text() == '100'
+
+
+def test_shard_supervisor_watch_error(tmpdir_path: Path):
+    """Test raising errors of the watch once workers wrote out the events received before."""
+    events = make_events(10)
+
+    def fail() -> Iterator[WatchedEvent]:
+        yield from events
+        raise OSError('Watch failed')
+
+    with pytest.raises(OSError):
+        run_supervisor(tmpdir_path, fail())
+    assert (tmpdir_path / RESOURCE_VERSION_FILE_NAME).read_text() == '9'
+
+
+def test_shard_supervisor_terminated(tmpdir_path: Path):
+    """Test writing output of all workers, including what they flush when terminated."""
+    events = make_events(10)
+
+    def watch() -> Iterator[WatchedEvent]:
+        yield from events
+        threading.Event().wait()
+
+    with pytest.raises(SystemExit):
+        run_supervisor(tmpdir_path, watch(), terminate_after_sec=3)
+    lines = (tmpdir_path / 'events.log').read_bytes().splitlines()
+    assert sorted(lines) == expected_lines(events)
+
+
+def test_shard_supervisor_signals(tmpdir_path: Path):
+    """Test calling the supervisor's own handler of SIGUSR1, e.g. profiling, and passing it on."""
+    events = make_events(10)
+    caught: List[int] = []
+
+    def watch() -> Iterator[WatchedEvent]:
+        yield from events[:5]
+        # Once both workers acknowledged events, and so handle the signal.
+        wait_until(lambda: (tmpdir_path / RESOURCE_VERSION_FILE_NAME).exists())
+        os.kill(os.getpid(), signal.SIGUSR1)
+        yield from events[5:]
+
+    previous_handler = signal.signal(signal.SIGUSR1, lambda signum, frame: caught.append(signum))
+    try:
+        lines = run_supervisor(tmpdir_path, watch())
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+    assert caught == [signal.SIGUSR1]
+    assert sorted(lines) == expected_lines(events)
@@ -0,0 +1,78 @@
+"""Tests of shedding events while the pipeline lags behind the watch."""
+from typing import List
+import pytest  # type: ignore
+from kube_event_pipe import shedding
+from kube_event_pipe.shedding import (
+    LoadShedder, LEVEL_NONE, LEVEL_NOISY, LEVEL_SAMPLE, LEVEL_NORMAL,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch) -> List[float]:
+    """Control the monotonic time seen by shedding."""
+    now = [1000.0]
+    monkeypatch.setattr(shedding.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def event(reason: str = 'Pulled', type: str = 'Normal') -> dict:
+    """Make an event of the reason and type."""
+    return {'metadata': {'name': 'a'}, 'reason': reason, 'type': type}
+
+
+def test_shedding_levels(clock: List[float], monkeypatch):
+    """Test shedding noisy, then sampled, then all Normal events as the lag grows."""
+    # Each event's lag replaces the smoothed one.
+    monkeypatch.setattr(shedding, 'LAG_SMOOTHING', 1.0)
+    shed = LoadShedder(lag_sec=10, noisy_reasons=frozenset({'Scheduled'}), sample=2)
+    shed.update(5)
+    assert shed.level == LEVEL_NONE
+    assert not shed(event('Scheduled'))
+
+    shed.update(10)
+    assert shed.level == LEVEL_NOISY
+    assert not shed(event('Pulled'))
+    assert shed(event('Scheduled'))
+    assert not shed(event('Scheduled', type='Warning'))
+
+    shed.update(20)
+    assert shed.level == LEVEL_SAMPLE
+    assert [shed(event('Pulled')) for _ in range(4)] == [False, True, False, True]
+
+    shed.update(40)
+    assert shed.level == LEVEL_NORMAL
+    assert shed(event('Pulled'))
+    assert not shed(event('BackOff', type='Warning'))
+    assert shed.shed == {'Scheduled': 1, 'Pulled': 3}
+
+    # Levels are left at half the lag they were entered at.
+    shed.update(20)
+    assert shed.level == LEVEL_NORMAL
+    shed.update(9)
+    assert shed.level == LEVEL_NOISY
+    shed.update(4)
+    assert shed.level == LEVEL_NONE
+
+
+def test_shedding_smoothing(clock: List[float]):
+    """Test that a single event waiting long doesn't start shedding."""
+    shed = LoadShedder(lag_sec=10)
+    shed.update(0)
+    shed.update(100)
+    assert shed.level == LEVEL_NONE
+    for _ in range(20):
+        shed.update(100)
+    assert shed.level == LEVEL_NORMAL
+
+
+def test_shedding_summary(clock: List[float]):
+    """Test resetting counts of shed events once they're logged, periodically."""
+    shed = LoadShedder(lag_sec=10, summary_interval_sec=60)
+    shed.update(50)
+    for _ in range(3):
+        assert shed(event())
+    assert shed.shed == {'Pulled': 3}
+    clock[0] += 60
+    shed.update(50)
+    assert not shed.shed
+    assert shed.summary_at == clock[0] + 60
@@ -0,0 +1,167 @@
+"""In-process tests for the raw event watch."""
+import json
+from http import HTTPStatus
+from itertools import islice
+from pathlib import Path
+from typing import List, Union
+import pytest  # type: ignore
+from kube_event_pipe import source
+from kube_event_pipe.checkpoint import ResourceVersionCheckpoint
+from kube_event_pipe.kube_client import ApiError
+from kube_event_pipe.source import (
+    WatchedEvent, extract_object, iter_lines, parse_event, peek_event, stream_raw,
+)
+
+
+def watch_line(event_type: str, obj: dict) -> bytes:
+    """Encode a watch event the way the API server does."""
+    return json.dumps({'type': event_type, 'object': obj}, separators=(',', ':')).encode()
+
+
+class FakeResponse:
+    """A chunked watch response."""
+
+    def __init__(self, chunks: List[bytes]):
+        """Set up."""
+        self.chunks = chunks
+
+    def read_chunked(self, decode_content):
+        """Return the chunks."""
+        return iter(self.chunks)
+
+    def close(self):
+        """Do nothing."""
+
+    def release_conn(self):
+        """Do nothing."""
+
+
+class FakeApi:
+    """Returns a prepared response, or raises a prepared error, for each watch request."""
+
+    def __init__(self, responses: List[Union[FakeResponse, Exception]]):
+        """Set up, raising the exceptions among responses."""
+        self.responses = responses
+        self.requests: List[dict] = []
+
+    def list_event_for_all_namespaces(self, **kwargs):
+        """Record the request and return the next response."""
+        self.requests.append(kwargs)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_iter_lines():
+    """Test splitting lines spanning chunks."""
+    response = FakeResponse([b'{"a":', b'1}\n{"b":2}\n\n{"c"', b':3}\n'])
+    assert list(iter_lines(response)) == [b'{"a":1}', b'{"b":2}', b'{"c":3}']
+
+
+def test_extract_object():
+    """Test slicing the object out of a watch event line."""
+    obj = {'metadata': {'name': 'x'}, 'count': 2}
+    line = watch_line('ADDED', obj)
+    extracted = extract_object(line, 'ADDED')
+    assert extracted is not None
+    assert json.loads(extracted) == obj
+    assert extract_object(b'{"object":{},"type":"ADDED"}', 'ADDED') is None
+
+
+def test_peek_event():
+    """Test reading the namespace and resourceVersion of a watch event line without parsing it."""
+    obj = {
+        'metadata': {'name': 'x', 'namespace': 'default', 'resourceVersion': '5'},
+        'involvedObject': {'namespace': 'other', 'resourceVersion': '1'},
+    }
+    event = peek_event(watch_line('ADDED', obj))
+    assert event is not None
+    assert event.type == 'ADDED'
+    assert event.obj == {'metadata': {'namespace': 'default', 'resourceVersion': '5'}}
+    assert event.data is not None and parse_event(event.type, event.data).obj == obj
+
+    bookmark = peek_event(watch_line('BOOKMARK', {'metadata': {'resourceVersion': '6'}}))
+    assert bookmark is not None and bookmark.obj == {'metadata': {'resourceVersion': '6'}}
+    # Errors, and lines not encoded like the API server does, are parsed instead.
+    assert peek_event(watch_line('ERROR', {'code': 410})) is None
+    assert peek_event(b'{"object":{},"type":"ADDED"}') is None
+
+
+def test_stream_raw():
+    """Test streaming events, reconnecting from the last resourceVersion, and watch errors."""
+    obj_1 = {'metadata': {'name': 'a', 'resourceVersion': '1'}, 'count': 1}
+    obj_2 = {'metadata': {'name': 'b', 'resourceVersion': '2'}}
+    gone = {'code': HTTPStatus.GONE, 'reason': 'Expired', 'message': 'too old resource version'}
+    api = FakeApi([
+        FakeResponse([watch_line('ADDED', obj_1) + b'\n']),
+        FakeResponse([watch_line('MODIFIED', obj_2) + b'\n' + watch_line('ERROR', gone) + b'\n']),
+    ])
+
+    events = []
+    with pytest.raises(ApiError) as exc_info:
+        for event in stream_raw(api, resource_version=None):
+            events.append(event)
+
+    assert exc_info.value.status == HTTPStatus.GONE
+    assert [r.get('resource_version') for r in api.requests] == [None, '1']
+    assert events == [
+        WatchedEvent('ADDED', obj_1, json.dumps(obj_1, separators=(',', ':')).encode()),
+        WatchedEvent('MODIFIED', obj_2, json.dumps(obj_2, separators=(',', ':')).encode()),
+    ]
+
+
+class FailingResponse(FakeResponse):
+    """A watch response whose connection fails after the chunks."""
+
+    def read_chunked(self, decode_content):
+        """Return the chunks, then fail."""
+        yield from self.chunks
+        raise ConnectionResetError()
+
+
+def test_watch_events_bookmark_reconnect(tmpdir_path: Path, monkeypatch):
+    """Test resuming the watch from a bookmark after the connection fails."""
+    monkeypatch.setattr(source, 'RETRY_DELAY_SEC', 0)
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    checkpoint.update('1')
+    obj_1 = {'metadata': {'name': 'a', 'resourceVersion': '2'}, 'count': 1}
+    bookmark = {'kind': 'Event', 'apiVersion': 'v1', 'metadata': {'resourceVersion': '5'}}
+    obj_2 = {'metadata': {'name': 'b', 'resourceVersion': '6'}, 'count': 1}
+    api = FakeApi([
+        FailingResponse([
+            watch_line('ADDED', obj_1) + b'\n', watch_line('BOOKMARK', bookmark) + b'\n']),
+        FakeResponse([watch_line('ADDED', obj_2) + b'\n']),
+    ])
+
+    events = list(islice(source.watch_events(api, checkpoint, raw=True), 3))
+
+    assert [(event.type, event.obj) for event in events] == [
+        ('ADDED', obj_1), ('BOOKMARK', bookmark), ('ADDED', obj_2)]
+    assert [r['resource_version'] for r in api.requests] == ['1', '5']
+    assert all(r['allow_watch_bookmarks'] for r in api.requests)
+
+
+def test_watch_events_retry(tmpdir_path: Path, monkeypatch):
+    """Test retrying when the API server is overloaded, waiting as long as it asks to."""
+    delays: List[float] = []
+    monkeypatch.setattr(source.time, 'sleep', delays.append)
+    checkpoint = ResourceVersionCheckpoint(tmpdir_path, interval_sec=3600)
+    checkpoint.update('1')
+    obj = {'metadata': {'name': 'a', 'resourceVersion': '2'}, 'count': 1}
+    api = FakeApi([
+        ApiError(HTTPStatus.SERVICE_UNAVAILABLE, 'Service Unavailable'),
+        ApiError(HTTPStatus.TOO_MANY_REQUESTS, 'Too Many Requests', {'retry-after': '7'}),
+        ApiError(HTTPStatus.TOO_MANY_REQUESTS, 'Too Many Requests'),
+        FakeResponse([watch_line('ADDED', obj) + b'\n']),
+        ApiError(HTTPStatus.FORBIDDEN, 'Forbidden'),
+    ])
+
+    events = source.watch_events(api, checkpoint, raw=True)
+    assert next(events).obj == obj
+    with pytest.raises(ApiError) as exc_info:
+        next(events)
+
+    assert exc_info.value.status == HTTPStatus.FORBIDDEN
+    assert delays == [source.RETRY_DELAY_SEC, 7, source.RETRY_DELAY_SEC * 4]
+    assert [r['resource_version'] for r in api.requests] == ['1', '1', '1', '1', '2']
@@ -0,0 +1,111 @@
+"""Tests of inspecting and combining directories of bloom filters."""
+import time
+from pathlib import Path
+import pytest  # type: ignore
+from kube_event_pipe.batched_bloom_filter import BatchedBloomFilter, create_filter  # type: ignore
+from kube_event_pipe.identity import (
+    IDENTITY_NAME_COUNT, IDENTITY_UID_COUNT, read_identity_file, write_identity_file,
+)
+from kube_event_pipe.state import compact, convert, format_reports, inspect, merge
+
+
+params: dict = {
+    'filter_capacity': 1000,
+    'filter_error_rate': 0.01,
+    'batch_count': 3,
+    'batch_duration_sec': 3600,
+}
+
+
+def write_batch(directory: Path, timestamp: int, elements: range, capacity: int = 1000):
+    """Write a batch of one filter, as BatchedBloomFilter would have."""
+    directory.mkdir(exist_ok=True)
+    bf = create_filter(capacity, 0.01, directory / f'{timestamp}.bloom')
+    for i in elements:
+        bf.add(b'event-%d' % i)
+    bf.close()
+
+
+def contains_all(directory: Path, elements: range) -> bool:
+    """Check if filters in the directory contain all the elements."""
+    events_seen: BatchedBloomFilter[bytes] = BatchedBloomFilter(directory=directory, **params)
+    try:
+        return all(b'event-%d' % i in events_seen for i in elements)
+    finally:
+        events_seen.close()
+
+
+def test_inspect(tmpdir_path: Path):
+    """Test reporting the occupancy of filters."""
+    write_batch(tmpdir_path, 100, range(500))
+    [report] = inspect(tmpdir_path)
+    assert report.file == '100.bloom'
+    assert 0.2 < report.fill_ratio < 0.3
+    assert report.false_positive_rate < 0.01
+    assert 450 < report.approx_len < 550
+    header, row = format_reports([report])
+    assert header.split() == [
+        'file', 'capacity', 'error_rate', 'bits', 'hashes', 'fill_ratio', 'est_fpr', 'approx_len']
+    assert row.split()[:3] == ['100.bloom', '1000', '0.01']
+
+
+def test_merge(tmpdir_path: Path):
+    """Test OR-ing compatible filters of batches of the same rank, and chaining others."""
+    shard_0, shard_1, merged = tmpdir_path / 'shard-0', tmpdir_path / 'shard-1', tmpdir_path / 'm'
+    write_batch(shard_0, 100, range(0, 100))
+    write_batch(shard_0, 200, range(100, 200))
+    write_batch(shard_1, 150, range(200, 300))
+    write_batch(shard_1, 250, range(300, 400), capacity=2000)
+    merged.mkdir()
+
+    assert merge([shard_0, shard_1], merged) == 3
+    assert sorted(path.name for path in merged.glob('*.bloom')) == [
+        '150.bloom', '250.1.bloom', '250.bloom']
+    assert contains_all(merged, range(400))
+
+
+def test_merge_identities(tmpdir_path: Path):
+    """Test recording the sources' identity strategy, and refusing to merge different ones."""
+    shard_0, shard_1 = tmpdir_path / 'shard-0', tmpdir_path / 'shard-1'
+    write_batch(shard_0, 100, range(0, 100))
+    write_batch(shard_1, 150, range(100, 200))
+    write_identity_file(shard_0, IDENTITY_NAME_COUNT, 1000.0)
+    write_identity_file(shard_1, IDENTITY_NAME_COUNT)
+    merged = tmpdir_path / 'merged'
+    merged.mkdir()
+    merge([shard_0, shard_1], merged)
+    assert read_identity_file(merged) == (IDENTITY_NAME_COUNT, 1000.0)
+
+    write_identity_file(shard_1, IDENTITY_UID_COUNT)
+    other = tmpdir_path / 'other'
+    other.mkdir()
+    with pytest.raises(ValueError, match='different identities'):
+        merge([shard_0, shard_1], other)
+    assert not list(other.iterdir())
+
+
+def test_compact(tmpdir_path: Path):
+    """Test OR-ing sparse filters into later ones, except into the one written to."""
+    for timestamp in (100, 200, 300, 400):
+        write_batch(tmpdir_path, timestamp, range(timestamp, timestamp + 100))
+
+    assert compact(tmpdir_path) == 2
+    assert sorted(path.name for path in tmpdir_path.glob('*.bloom')) == ['300.bloom', '400.bloom']
+    assert contains_all(tmpdir_path, range(100, 500))
+
+    # Filters would be too full.
+    assert compact(tmpdir_path, max_error_rate=0.0001) == 0
+
+
+def test_convert(tmpdir_path: Path):
+    """Test writing new events to a filter of other parameters, chained to the latest batch."""
+    timestamp = int(time.time())
+    write_batch(tmpdir_path, timestamp, range(100))
+    assert convert(tmpdir_path, 5000, 0.001) == tmpdir_path / f'{timestamp}.1.bloom'
+
+    events_seen: BatchedBloomFilter[bytes] = BatchedBloomFilter(directory=tmpdir_path, **params)
+    try:
+        assert events_seen.recent_filter.capacity == 5000
+        assert b'event-1' in events_seen
+    finally:
+        events_seen.close()